@@ -0,0 +1,1044 @@
+#!/usr/bin/env python3
+# Benchmarks for the Magic Garage hot paths
+# To Run: python3 benchmarks.py [--micro] [--json results file] [--compare previous results file]
+# --micro runs only the microbenchmarks, --json saves their results and --compare fails on any that regressed
+import os
+import sys
+import gc
+import json
+import math
+import time
+import asyncio
+import queue
+import logging
+import random
+import signal
+import platform
+import itertools
+import tempfile
+import statistics
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueListener, RotatingFileHandler
+import magic_garage
+import replay
+import corridor
+import fleet
+from geopy import distance
+
+BENCH_SEED = 42
+GEO_SAMPLES = 20000
+GEO_BATCH_HOMES = 4
+# Largest error allowed between the planar distance and the geopy geodesic within the planar range
+GEO_ACCURACY_TOLERANCE_FT = 1.0
+# Round trip added to every stand-in API request in the startup benchmark
+BENCH_API_LATENCY_SECS = 0.15
+BENCH_STARTUP_RUNS = 5
+DECODE_ITERATIONS = 5000
+DECODE_RETAINED_SAMPLES = 1000
+LOG_RECORDS = 20000
+LOG_SLOW_DISK_RECORDS = 200
+# Time a slow or busy disk (SD card, NFS) takes to write each line in the logging benchmark
+LOG_SLOW_DISK_SECS = 0.002
+# A day of 1Hz samples for this many cars in the history benchmark
+HISTORY_VEHICLES = 4
+HISTORY_DAY_SECS = 24 * 60 * 60
+HISTORY_QUERY_RUNS = 20
+# The streaming benchmark drives a car back and forth between these distances from home, in real time, with its data
+# changing every STREAM_DRIVE_STEP_SECS. It starts on its way in from STREAM_DRIVE_START_FT, inside the arriving geofence
+# where the adaptive schedule polls as fast as it can, so polling is not judged by a car too far out to need it
+STREAM_BENCH_SECS = 30
+STREAM_DRIVE_STEP_SECS = 0.5
+STREAM_DRIVE_SPEED_MPH = 30
+STREAM_DRIVE_NEAR_FT = 500
+STREAM_DRIVE_FAR_FT = 4000
+STREAM_DRIVE_START_FT = 1400
+STREAM_AGE_CHECK_SECS = 0.1
+# The status API benchmark holds this many event stream subscribers open while doors change, then fetches the status
+# from STATUS_CLIENTS clients at once
+STATUS_SUBSCRIBERS = 500
+STATUS_EVENTS = 50
+STATUS_EVENT_INTERVAL_SECS = 0.02
+STATUS_CLIENTS = 50
+STATUS_REQUESTS = 5000
+# The corridor benchmark trains on synthetic trips around a home with a north-south road CORRIDOR_WEST_ROAD_FT to its
+# west and an east-west road CORRIDOR_SOUTH_ROAD_FT to its south that pass near home without stopping
+CORRIDOR_WEST_ROAD_FT = -700
+CORRIDOR_SOUTH_ROAD_FT = -1200
+CORRIDOR_ROAD_END_FT = 3000
+CORRIDOR_TRIPS = {"north arrival": 40, "west arrival": 40, "west road": 120, "south road": 40, "departure": 40}
+CORRIDOR_GPS_NOISE_FT = 10
+CORRIDOR_HEADING_NOISE_DEG = 5
+CORRIDOR_LOOKUPS = 100000
+# Fleet load test: every car is polled this often, so the workers are never waiting on the poll schedule
+FLEET_BENCH_VEHICLES = 240
+FLEET_BENCH_VEHICLES_PER_DOOR = 4
+FLEET_BENCH_POLL_SECS = 0.01
+FLEET_BENCH_WORKER_COUNTS = [1, 2, 4, 8, 16]
+FLEET_BENCH_WARMUP_SECS = 3
+FLEET_BENCH_SECS = 10
+FLEET_BENCH_CHECK_SECS = 0.1
+FLEET_BENCH_TIMEOUT_SECS = 120
+# Scaling is only measured with the cores for at least two worker counts, each worker with a stand-in server process of
+# its own, and the most workers must reach this fraction of linear scaling over one worker
+FLEET_BENCH_MIN_CORES = 4
+FLEET_BENCH_MIN_SCALING = 0.7
+
+# Microbenchmarks: each is timed over MICRO_REPEATS runs of enough calls to take MICRO_MIN_RUN_SECS, and a run compared
+# with a previous one fails on any that got more than MICRO_REGRESSION_THRESHOLD slower
+MICRO_REPEATS = 7
+MICRO_MIN_RUN_SECS = 0.05
+MICRO_REGRESSION_THRESHOLD = 0.1
+MICRO_POSITIONS = 1000
+# The decision step and fleet tick drive cars towards home from MICRO_DRIVE_FAR_FT to MICRO_DRIVE_NEAR_FT and back,
+# one sample a second, staying AWAY so no door command goes out
+MICRO_DRIVE_FAR_FT = 6000
+MICRO_DRIVE_NEAR_FT = 1600
+MICRO_DRIVE_SPEED_MPH = 30
+MICRO_TICK_VEHICLES = 10000
+
+# Returns random (latitude, longitude) positions within max_feet of a home
+def random_positions(home, count, max_feet):
+    positions = []
+    for i in range(count):
+        north = random.uniform(-max_feet, max_feet)
+        east = random.uniform(-max_feet, max_feet)
+        positions.append((home.latitude + north / home.feet_per_degree_north, home.longitude + east / home.feet_per_degree_east))
+    return positions
+
+# Runs a function over every position and returns the results and the time per call in microseconds
+def time_per_call(function, positions):
+    start = time.perf_counter()
+    results = [function(latitude, longitude) for latitude, longitude in positions]
+    return results, 1e6 * (time.perf_counter() - start) / len(positions)
+
+# Checks the planar distance against geopy's geodesic out to the planar range, plus the geodesic fallback beyond it
+def bench_geo_accuracy():
+    home = magic_garage.home_geofence
+    positions = random_positions(home, GEO_SAMPLES, magic_garage.GEO_PLANAR_MAX_FT / 1.5)
+    positions += random_positions(home, GEO_SAMPLES // 10, 4 * magic_garage.GEO_PLANAR_MAX_FT)
+    max_error = 0.0
+    for latitude, longitude in positions:
+        expected = distance.distance(home.point, (latitude, longitude)).feet
+        max_error = max(max_error, abs(home.distance_feet(latitude, longitude) - expected))
+    passed = (max_error <= GEO_ACCURACY_TOLERANCE_FT)
+    print("Geo Accuracy: max error " + str(round(max_error, 4)) + "FT over " + str(len(positions)) + " samples | "
+        + ("PASS" if passed else "FAIL") + " (tolerance " + str(GEO_ACCURACY_TOLERANCE_FT) + "FT)")
+    return passed
+
+# Compares geopy, the planar distance and the NumPy batch API on positions near home
+def bench_geo_throughput():
+    home = magic_garage.home_geofence
+    positions = random_positions(home, GEO_SAMPLES, magic_garage.ARRIVING_GEO_FENCE_FT * 2)
+    geopy_distance = lambda latitude, longitude: distance.distance(home.point, (latitude, longitude)).feet
+    _, geopy_us = time_per_call(geopy_distance, positions)
+    _, planar_us = time_per_call(home.distance_feet, positions)
+    print("Geo Throughput: geopy " + str(round(geopy_us, 2)) + "us/call | planar " + str(round(planar_us, 2)) + "us/call | "
+        + str(round(geopy_us / planar_us, 1)) + "x faster")
+    if (magic_garage.np is not None):
+        homes = [home] + [magic_garage.GeoFence(home.latitude + 0.01 * i, home.longitude) for i in range(1, GEO_BATCH_HOMES)]
+        latitudes = [position[0] for position in positions]
+        longitudes = [position[1] for position in positions]
+        start = time.perf_counter()
+        magic_garage.geofence_distances_feet(latitudes, longitudes, homes)
+        batch_us = 1e6 * (time.perf_counter() - start) / (len(positions) * len(homes))
+        print("Geo Batch: " + str(len(positions)) + " positions x " + str(len(homes)) + " homes | " + str(round(batch_us, 3)) + "us/distance")
+
+# Builds a section of a payload with some made up fields, like the ones the decision logic never reads
+def filler_fields(prefix, count):
+    fields = {}
+    for i in range(count):
+        fields[prefix + "_" + str(i)] = [i * 1.5, "value_" + str(i), (i % 2 == 0), None][i % 4]
+    return fields
+
+# A vehicle_data response, with the full payload or just the sections TESLA_VEHICLE_DATA_ENDPOINTS selects
+def vehicle_data_payload(full):
+    home = magic_garage.home_geofence
+    drive_state = dict(filler_fields("drive", 10), speed=25, shift_state="D", latitude=home.latitude + 0.01, longitude=home.longitude,
+        heading=180, timestamp=1700000000000)
+    data = {"id": 1, "vehicle_id": 2, "state": "online", "drive_state": drive_state,
+        "vehicle_state": dict(filler_fields("vehicle", 60), is_user_present=True),
+        "charge_state": dict(filler_fields("charge", 50), charging_state="Disconnected")}
+    if (full):
+        data.update(climate_state=filler_fields("climate", 40), gui_settings=filler_fields("gui", 10),
+            vehicle_config=filler_fields("config", 40))
+    return json.dumps({"response": data}).encode("utf-8")
+
+# A MyQ device list with a hub, two lamp modules and two garage doors
+def device_list_payload():
+    devices = []
+    for i, family in enumerate(["gateway", "lamp", "lamp", "garagedoor", "garagedoor"]):
+        devices.append({"serial_number": "SERIAL" + str(i), "device_family": family, "name": family + " " + str(i),
+            "state": dict(filler_fields("state", 25), door_state="closed")})
+    return json.dumps({"href": "devices", "count": len(devices), "items": devices}).encode("utf-8")
+
+# How vehicle_data was decoded before the typed samples, for comparison
+def legacy_decode_vehicle_data(content):
+    resp = json.loads(content.decode("utf-8"))
+    data = resp['response']
+    drive_state = data['drive_state']
+    vehicle_state = data.get('vehicle_state') or {}
+    charge_state = data.get('charge_state') or {}
+    return {"driver_present": bool(vehicle_state.get('is_user_present', False)),
+        "charger_connected": ("Disconnected" not in str(charge_state.get('charging_state', "Disconnected"))),
+        "shift_state": magic_garage.shift_state(drive_state['shift_state']), "speed": drive_state['speed'] or 0,
+        "heading": drive_state.get('heading') or 0, "latitude": drive_state['latitude'], "longitude": drive_state['longitude'],
+        "timestamp": time.time()}
+
+# How the device list was decoded before the typed samples, keeping the garage door dicts
+def legacy_decode_doors(content):
+    resp = json.loads(content.decode("utf-8"))
+    return [device for device in resp["items"] if magic_garage.myq_is_garage_door(device)]
+
+# Returns the time per decode in microseconds, the peak bytes allocated while decoding and the bytes each result keeps
+def measure_decode(decode, content):
+    start = time.perf_counter()
+    for i in range(DECODE_ITERATIONS):
+        decode(content)
+    decode_us = 1e6 * (time.perf_counter() - start) / DECODE_ITERATIONS
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start_bytes, _ = tracemalloc.get_traced_memory()
+    decode(content)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    peak_bytes -= start_bytes
+    start_bytes, _ = tracemalloc.get_traced_memory()
+    results = [decode(content) for i in range(DECODE_RETAINED_SAMPLES)]
+    retained_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del results
+    return decode_us, peak_bytes, (retained_bytes - start_bytes) / DECODE_RETAINED_SAMPLES
+
+# Compares decoding each payload the old way with the typed decoders, on the stdlib json and orjson backends
+def bench_decode():
+    payloads = [
+        ("vehicle_data (selected)", vehicle_data_payload(False), legacy_decode_vehicle_data, magic_garage.tesla_decode_vehicle_data),
+        ("vehicle_data (full)", vehicle_data_payload(True), legacy_decode_vehicle_data, magic_garage.tesla_decode_vehicle_data),
+        ("MyQ device list", device_list_payload(), legacy_decode_doors, magic_garage.myq_decode_doors)
+    ]
+    fast_backend = magic_garage.orjson
+    backends = [("json", None)] + ([("orjson", fast_backend)] if (fast_backend is not None) else [])
+    for name, content, legacy_decode, typed_decode in payloads:
+        magic_garage.orjson = None
+        legacy_us, legacy_peak, legacy_retained = measure_decode(legacy_decode, content)
+        results = []
+        for backend_name, backend in backends:
+            magic_garage.orjson = backend
+            typed_us, typed_peak, typed_retained = measure_decode(typed_decode, content)
+            results.append(backend_name + " " + str(round(typed_us, 1)) + "us, " + str(round(typed_peak / 1024, 1)) + "KB peak, "
+                + str(round(typed_retained)) + "B kept (" + str(round(legacy_us / typed_us, 1)) + "x)")
+        print("Decode " + name + " (" + str(len(content)) + "B): legacy " + str(round(legacy_us, 1)) + "us, " + str(round(legacy_peak / 1024, 1))
+            + "KB peak, " + str(round(legacy_retained)) + "B kept | typed " + " | ".join(results))
+    magic_garage.orjson = fast_backend
+    if (fast_backend is None):
+        print("Decode: install orjson to compare the fast JSON backend")
+
+# Rotating log file on a disk that takes LOG_SLOW_DISK_SECS to write each line
+class SlowRotatingFileHandler(RotatingFileHandler):
+    def emit(self, record):
+        time.sleep(LOG_SLOW_DISK_SECS)
+        super().emit(record)
+
+# Logs a Tesla State line, either concatenated up front as before or with lazy %-formatting
+def log_tesla_state(logger, level, lazy, i):
+    if (lazy):
+        logger.log(level, "Tesla State (%s): %s | Driver Present: %s | Charger: %s | Speed: %sMPH | Location: %s | %sFT from Home"
+            + " | Closing: %.1fFT/S", "Car", "DRIVE", "YES", "Disconnected", 25, "North", i, -36.67)
+    else:
+        logger.log(level, "Tesla State (" + "Car" + "): " + "DRIVE" + " | Driver Present: " + "YES" + " | " + "Charger: " + "Disconnected"
+            + " | Speed: " + str(25) + "MPH | " + " Location: " + "North" + " | " + str(i) + "FT from Home"
+            + " | Closing: " + str(round(-36.67, 1)) + "FT/S")
+
+# Returns the calling thread's average, p99 and worst time per log call in microseconds
+def time_log_calls(logger, level, lazy, count):
+    times = []
+    for i in range(count):
+        start = time.perf_counter()
+        log_tesla_state(logger, level, lazy, i)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return 1e6 * statistics.mean(times), 1e6 * times[min(len(times) - 1, int(0.99 * len(times)))], 1e6 * times[-1]
+
+# Sets up a logger that writes to the handler directly as before, or through the app's queue and background writer
+def bench_logger(name, handler, queued):
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s', datefmt='%d-%b-%y %I:%M:%S%p'))
+    logger = logging.getLogger("bench." + name)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    listener = None
+    if (queued):
+        log_queue = queue.Queue()
+        logger.addHandler(magic_garage.LogQueueHandler(log_queue))
+        listener = QueueListener(log_queue, handler)
+        listener.start()
+    else:
+        logger.addHandler(handler)
+    return logger, listener
+
+def format_log_times(times):
+    return str(round(times[0], 1)) + "us avg, p99 " + str(round(times[1], 1)) + "us, max " + str(round(times[2])) + "us"
+
+# Compares how long the caller is held up per log line writing synchronously the old way and through the queue, on a
+# local disk and a slow one, and what a filtered out debug line costs with and without lazy formatting
+def bench_logging():
+    with tempfile.TemporaryDirectory() as log_dir:
+        disks = [("local disk", RotatingFileHandler, LOG_RECORDS),
+            ("slow disk " + str(round(1000 * LOG_SLOW_DISK_SECS)) + "ms/line", SlowRotatingFileHandler, LOG_SLOW_DISK_RECORDS)]
+        for disk, handler_class, count in disks:
+            results = []
+            for queued in [False, True]:
+                name = disk.split()[0] + ("_queued" if queued else "_sync")
+                handler = handler_class(os.path.join(log_dir, name + ".log"), maxBytes=magic_garage.DEBUG_LOG_MAX_SIZE_BYTES)
+                logger, listener = bench_logger(name, handler, queued)
+                results.append(time_log_calls(logger, logging.INFO, queued, count))
+                drain_start = time.perf_counter()
+                if (listener is not None):
+                    listener.stop()
+                drain_secs = time.perf_counter() - drain_start
+                handler.close()
+            print("Logging (" + disk + "): sync " + format_log_times(results[0]) + " | queued " + format_log_times(results[1])
+                + " (" + str(round(results[0][0] / results[1][0], 1)) + "x), writer caught up " + str(round(1000 * drain_secs)) + "ms after")
+        logger, _ = bench_logger("filtered", logging.NullHandler(), False)
+        concatenated = time_log_calls(logger, logging.DEBUG, False, LOG_RECORDS)
+        lazy = time_log_calls(logger, logging.DEBUG, True, LOG_RECORDS)
+        print("Logging (filtered debug line): concatenated " + str(round(concatenated[0], 2)) + "us | lazy " + str(round(lazy[0], 2)) + "us")
+
+# Measures the per-sample cost of appending to the telemetry history, its size on disk, and range queries over a day
+# of 1Hz samples for HISTORY_VEHICLES cars
+def bench_history():
+    if (magic_garage.np is None):
+        print("History: install numpy to query the telemetry history")
+        return
+    home = magic_garage.home_geofence
+    day_start = 1700006400.0
+    with tempfile.TemporaryDirectory() as history_dir:
+        store = magic_garage.HistoryStore(history_dir)
+        magic_garage.history_store = store
+        vehicles = [magic_garage.Vehicle(1000 + i, "Car " + str(i)) for i in range(HISTORY_VEHICLES)]
+        samples = []
+        for i in range(0, HISTORY_DAY_SECS, 60):
+            distance = random.uniform(0, 5000)
+            samples.append(magic_garage.VehicleSample(False, False, "DRIVE", random.uniform(0, 40), random.uniform(0, 360),
+                home.latitude + distance / home.feet_per_degree_north, home.longitude, day_start + i))
+        start = time.perf_counter()
+        appended = 0
+        for second in range(HISTORY_DAY_SECS):
+            sample = samples[second // 60]
+            sample.timestamp = day_start + second
+            for vehicle in vehicles:
+                vehicle.distance_from_home = 100.0
+                magic_garage.history_record_vehicle_sample(vehicle, sample)
+                appended += 1
+        append_us = 1e6 * (time.perf_counter() - start) / appended
+        store.flush()
+        day_bytes = sum(os.path.getsize(os.path.join(history_dir, file_name)) for file_name in os.listdir(history_dir)) / HISTORY_VEHICLES
+        query_times = {}
+        for name, length in [("1 hour", 3600), ("1 day", HISTORY_DAY_SECS)]:
+            start = time.perf_counter()
+            for run in range(HISTORY_QUERY_RUNS):
+                offset = random.uniform(0, HISTORY_DAY_SECS - length)
+                records = store.query("vehicle", vehicles[0].id, day_start + offset, day_start + offset + length)
+            query_times[name] = (1000 * (time.perf_counter() - start) / HISTORY_QUERY_RUNS, len(records))
+        store.close()
+        magic_garage.history_store = None
+    print("History: append " + str(round(append_us, 2)) + "us/sample | " + str(round(day_bytes / 1e6, 2)) + "MB per car per day at 1Hz ("
+        + str(store.formats["vehicle"].size) + "B records) | query " + " | ".join(name + " " + str(round(ms, 2)) + "ms ("
+        + str(count) + " records)" for name, (ms, count) in query_times.items()))
+
+# A car driving back and forth toward home in real time, answering the stand-in servers in place of a trace. Each
+# position it reports is kept with the time it was generated, so the benchmark can tell how old the data it sees is
+class LiveDrive:
+    def __init__(self):
+        self.name = "live drive"
+        self.start = time.time()
+        self.generated_at = {}
+        self.listing = json.dumps({"response": [{"id": 1, "vehicle_id": 101, "display_name": "Bench", "state": "online"}]})
+
+    def lookup(self, key, now):
+        if (key == ("Tesla", "GET", replay.trace_path(magic_garage.TESLA_VEHICLES, {}))):
+            return 200, self.listing
+        if (key != ("Tesla", "GET", replay.trace_path(magic_garage.TESLA_VEHICLE_DATA, {"id": 1}))):
+            return None, None
+        home = magic_garage.home_geofence
+        step = math.floor((time.time() - self.start) / STREAM_DRIVE_STEP_SECS)
+        lap_ft = 2 * (STREAM_DRIVE_FAR_FT - STREAM_DRIVE_NEAR_FT)
+        travelled_ft = (STREAM_DRIVE_FAR_FT - STREAM_DRIVE_START_FT
+            + step * STREAM_DRIVE_STEP_SECS * STREAM_DRIVE_SPEED_MPH * magic_garage.FEET_PER_SECOND_PER_MPH) % lap_ft
+        approaching = travelled_ft < (lap_ft / 2)
+        distance_ft = (STREAM_DRIVE_FAR_FT - travelled_ft) if approaching else (STREAM_DRIVE_NEAR_FT + travelled_ft - lap_ft / 2)
+        latitude = home.latitude + distance_ft / home.feet_per_degree_north
+        self.generated_at.setdefault(latitude, self.start + step * STREAM_DRIVE_STEP_SECS)
+        return 200, json.dumps({"response": {"drive_state": {"speed": STREAM_DRIVE_SPEED_MPH, "shift_state": "D", "latitude": latitude,
+            "longitude": home.longitude, "heading": 180 if approaching else 0, "power": 20},
+            "vehicle_state": {"is_user_present": True}, "charge_state": {"charging_state": "Disconnected"}}})
+
+# Runs one car's poller and decision loop, and its streamer when streaming, for STREAM_BENCH_SECS. Returns the age of
+# the car's data, checked every STREAM_AGE_CHECK_SECS
+async def run_stream_bench_vehicle(vehicle, streaming, drive):
+    magic_garage.event_loop = asyncio.get_running_loop()
+    workers = [magic_garage.Worker("poller", magic_garage.tesla_vehicle_poller, (vehicle,)),
+        magic_garage.Worker("decision_loop", magic_garage.tesla_decision_loop, (vehicle,))]
+    if (streaming):
+        workers.append(magic_garage.Worker("streamer", magic_garage.tesla_vehicle_streamer, (vehicle,)))
+    for worker in workers:
+        worker.start()
+    ages = []
+    end = time.time() + STREAM_BENCH_SECS
+    while (time.time() < end):
+        await asyncio.sleep(STREAM_AGE_CHECK_SECS)
+        if (vehicle.sample is not None):
+            ages.append(time.time() - drive.generated_at[vehicle.sample.latitude])
+    for worker in workers:
+        worker.task.cancel()
+    await asyncio.gather(*[worker.task for worker in workers], return_exceptions=True)
+    return ages
+
+# Compares how old a moving car's data is when the app looks at it, how many of its positions the app sees, and how many
+# vehicle data requests it makes, when polling on the adaptive schedule, polling every second and streaming
+def bench_streaming():
+    if (magic_garage.websockets is None):
+        print("Streaming: install websockets to compare streaming with polling")
+        return
+    results = {}
+    record_vehicle_sample = magic_garage.history_record_vehicle_sample
+    slow_interval = magic_garage.TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_SLOW
+    for name, streaming, fixed in [("adaptive polling", False, False), ("1s polling", False, True), ("streaming", True, False)]:
+        # Capping the slow interval at the fast one polls every second whatever the schedule would choose
+        magic_garage.TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_SLOW = (magic_garage.TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_FAST
+            if fixed else slow_interval)
+        drive = LiveDrive()
+        stand_in = replay.Replay(drive, BENCH_API_LATENCY_SECS)
+        stream_server = replay.ReplayStreamingServer(stand_in)
+        magic_garage.TESLA_STREAMING_URL = stream_server.start()
+        magic_garage.tesla_client.base_url = stand_in.start_server("Tesla")
+        magic_garage.tesla_email = magic_garage.tesla_password = "bench"
+        magic_garage.TOKEN_CACHE_FILE = ""
+        magic_garage.STATE_SNAPSHOT_FILE = ""
+        reset_app_state()
+        magic_garage.tesla_init()
+        vehicle = magic_garage.tesla_vehicles[1]
+        seen = set()
+        magic_garage.history_record_vehicle_sample = lambda vehicle, sample: seen.add(sample.latitude)
+        requests_before = stand_in.api_calls.get(("Tesla", "GET"), 0)
+        try:
+            ages = asyncio.run(run_stream_bench_vehicle(vehicle, streaming, drive))
+        finally:
+            magic_garage.history_record_vehicle_sample = record_vehicle_sample
+        requests = stand_in.api_calls.get(("Tesla", "GET"), 0) - requests_before
+        for server in stand_in.servers:
+            server.shutdown()
+        stream_server.shutdown()
+        results[name] = (statistics.median(ages), sorted(ages)[int(0.95 * len(ages))],
+            len(seen), math.floor(STREAM_BENCH_SECS / STREAM_DRIVE_STEP_SECS) + 1, requests)
+    magic_garage.TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_SLOW = slow_interval
+    print("Streaming (" + str(STREAM_BENCH_SECS) + "s drive, new position every " + str(STREAM_DRIVE_STEP_SECS) + "s, "
+        + str(round(1000 * BENCH_API_LATENCY_SECS)) + "ms latency): " + " | ".join(name + " data age median "
+        + str(round(1000 * median)) + "ms p95 " + str(round(1000 * p95)) + "ms, saw " + str(seen) + "/" + str(generated)
+        + " positions with " + str(requests) + " requests" for name, (median, p95, seen, generated, requests) in results.items()))
+
+# Requests made to Tesla and MyQ so far
+def upstream_requests():
+    return sum(stats["requests"] for client in [magic_garage.tesla_client, magic_garage.myq_client] for stats in client.stats.values())
+
+# Reads one event stream subscriber's events, noting when each event ID arrived
+async def read_status_events(reader, received):
+    event_id = None
+    while (True):
+        line = await reader.readline()
+        if (line == b""):
+            return
+        if (line.startswith(b"id: ")):
+            event_id = int(line[4:])
+        elif ((line == b"\n") and (event_id is not None)):
+            received.setdefault(event_id, []).append(time.perf_counter())
+            event_id = None
+
+# Fetches the status over new connections until STATUS_REQUESTS have been made between all the clients
+async def fetch_status(port, counter):
+    while (counter[0] < STATUS_REQUESTS):
+        counter[0] += 1
+        reader, writer = await asyncio.open_connection(magic_garage.STATUS_API_HOST, port)
+        writer.write(b"GET /status HTTP/1.1\r\nHost: bench\r\n\r\n")
+        await reader.read()
+        writer.close()
+
+async def run_status_api():
+    magic_garage.event_loop = asyncio.get_running_loop()
+    server = await asyncio.start_server(lambda reader, writer: magic_garage.local_http_handle(reader, writer,
+        magic_garage.status_api_routes), magic_garage.STATUS_API_HOST, 0)
+    port = server.sockets[0].getsockname()[1]
+    received = {}
+    connections = []
+    for i in range(STATUS_SUBSCRIBERS):
+        reader, writer = await asyncio.open_connection(magic_garage.STATUS_API_HOST, port)
+        writer.write(b"GET /events HTTP/1.1\r\nHost: bench\r\n\r\n")
+        connections.append((writer, asyncio.ensure_future(read_status_events(reader, received))))
+    while (len(received.get(magic_garage.status_broadcaster.version, [])) < STATUS_SUBSCRIBERS):
+        await asyncio.sleep(0.01)
+    door = magic_garage.GarageDoor("bench", "Garage Door Opener")
+    published = {}
+    for i in range(STATUS_EVENTS):
+        door.state = "opening" if (i % 2 == 0) else "closing"
+        magic_garage.status_publish_door(door)
+        published[magic_garage.status_broadcaster.version] = time.perf_counter()
+        await asyncio.sleep(STATUS_EVENT_INTERVAL_SECS)
+    await asyncio.sleep(0.5)
+    fan_out = [max(received[version]) - published_at for version, published_at in published.items()
+        if (len(received.get(version, [])) == STATUS_SUBSCRIBERS)]
+    counter = [0]
+    start = time.perf_counter()
+    await asyncio.gather(*[fetch_status(port, counter) for i in range(STATUS_CLIENTS)])
+    status_per_sec = STATUS_REQUESTS / (time.perf_counter() - start)
+    dropped = magic_garage.status_broadcaster.subscribers_dropped
+    magic_garage.status_broadcaster.close()
+    await asyncio.gather(*[task for writer, task in connections])
+    for writer, task in connections:
+        writer.close()
+    server.close()
+    return fan_out, status_per_sec, dropped
+
+# Measures how long a change takes to reach every one of STATUS_SUBSCRIBERS event stream subscribers, and how many status
+# requests per second the API answers from its cache
+def bench_status_api():
+    broadcaster = magic_garage.status_broadcaster
+    magic_garage.status_broadcaster = magic_garage.StatusBroadcaster()
+    requests_before = upstream_requests()
+    try:
+        for i in range(HISTORY_VEHICLES):
+            magic_garage.status_publish_vehicle(magic_garage.Vehicle(1000 + i, "Car " + str(i)))
+        fan_out, status_per_sec, dropped = asyncio.run(run_status_api())
+    finally:
+        magic_garage.status_broadcaster = broadcaster
+        magic_garage.event_loop = None
+    upstream = upstream_requests() - requests_before
+    print("Status API: " + str(STATUS_SUBSCRIBERS) + " subscribers got " + str(len(fan_out)) + "/" + str(STATUS_EVENTS)
+        + " events, last subscriber median " + str(round(1000 * statistics.median(fan_out), 1)) + "ms max "
+        + str(round(1000 * max(fan_out), 1)) + "ms after the change, " + str(dropped) + " dropped | status "
+        + str(round(status_per_sec)) + " requests/s from " + str(STATUS_CLIENTS) + " clients | " + str(upstream) + " upstream requests")
+
+# Returns the legs of a synthetic trip as ((east, north) from, (east, north) to, MPH), in feet from home
+def corridor_trip_legs(kind, rng):
+    west = CORRIDOR_WEST_ROAD_FT
+    end = CORRIDOR_ROAD_END_FT
+    side = rng.choice([-1, 1])
+    if (kind == "north arrival"):
+        return [((0, end), (0, 300), rng.uniform(25, 35)), ((0, 300), (0, 0), 10)]
+    if (kind == "west arrival"):
+        return [((west, side * end), (west, 0), rng.uniform(25, 40)), ((west, 0), (0, 0), rng.uniform(15, 25))]
+    if (kind == "west road"):
+        return [((west, side * end), (west, -side * end), rng.uniform(15, 45))]
+    if (kind == "south road"):
+        return [((west, CORRIDOR_SOUTH_ROAD_FT), (end, CORRIDOR_SOUTH_ROAD_FT), rng.uniform(15, 40))]
+    return [((0, 0), (0, 300), 10), ((0, 300), (0, end), rng.uniform(25, 35))]
+
+# Appends a synthetic trip to the history as 1Hz driving samples with GPS noise, ending with a parked sample. Returns
+# the time after the trip
+def record_corridor_trip(store, key, start, legs, rng):
+    home = magic_garage.home_geofence
+    t = start
+    position = legs[0][0]
+    for (east, north), (to_east, to_north), mph in legs:
+        length = math.hypot(to_east - east, to_north - north)
+        heading = math.degrees(math.atan2(to_east - east, to_north - north)) % 360
+        steps = max(math.ceil(length / (mph * magic_garage.FEET_PER_SECOND_PER_MPH)), 1)
+        for step in range(steps):
+            position = (east + (to_east - east) * step / steps, north + (to_north - north) * step / steps)
+            corridor_record_sample(store, key, home, t, position, mph, heading + rng.gauss(0, CORRIDOR_HEADING_NOISE_DEG), "DRIVE", rng)
+            t += 1
+        position = (to_east, to_north)
+    corridor_record_sample(store, key, home, t, position, 0, 0, "PARKED", rng)
+    return t + 1
+
+def corridor_record_sample(store, key, home, t, position, mph, heading, shift, rng):
+    east = position[0] + rng.gauss(0, CORRIDOR_GPS_NOISE_FT)
+    north = position[1] + rng.gauss(0, CORRIDOR_GPS_NOISE_FT)
+    store.append("vehicle", key, (t, round((home.latitude + north / home.feet_per_degree_north) * 1e7),
+        round((home.longitude + east / home.feet_per_degree_east) * 1e7), math.hypot(east, north), round(mph * 10), round(heading) % 360,
+        magic_garage.SHIFT_STATES.index(shift), 0))
+
+# Trains the corridor model on synthetic trips and compares it with the speed check on the held out trips, along with
+# the cost of a lookup
+def bench_corridor():
+    if (magic_garage.np is None):
+        print("Corridor: install numpy to train the corridor model")
+        return
+    rng = random.Random(BENCH_SEED)
+    home = magic_garage.home_geofence
+    kinds = [kind for kind, count in CORRIDOR_TRIPS.items() for i in range(count)]
+    rng.shuffle(kinds)
+    with tempfile.TemporaryDirectory() as history_dir:
+        store = magic_garage.HistoryStore(history_dir)
+        start = 1700006400.0
+        for i, kind in enumerate(kinds):
+            start = record_corridor_trip(store, i % HISTORY_VEHICLES, start, corridor_trip_legs(kind, rng), rng) + 600
+        store.close()
+        trips = [trip for key, records in corridor.load_history(history_dir).items() for trip in corridor.split_trips(key, records)]
+    training, held_out = corridor.holdout_split(trips)
+    grid = corridor.train(training, home)
+    results = {name: corridor.evaluate(held_out, home, rule_grid) for name, rule_grid in [("speed check", None), ("corridor model", grid)]}
+    positions = [(latitude, longitude, rng.uniform(0, 360)) for latitude, longitude in
+        random_positions(home, 1000, corridor.CORRIDOR_RADIUS_FT)]
+    lookup_start = time.perf_counter()
+    for i in range(CORRIDOR_LOOKUPS):
+        grid.probability(*positions[i % len(positions)])
+    lookup_us = 1e6 * (time.perf_counter() - lookup_start) / CORRIDOR_LOOKUPS
+    print("Corridor: " + str(len(trips)) + " trips, " + str(len(held_out)) + " held out | " + " | ".join(name + " precision "
+        + str(round(precision, 3)) + " recall " + str(round(recall, 3)) + " (" + str(false_arrivals) + " false, " + str(missed) + " missed)"
+        for name, (precision, recall, false_arrivals, missed) in results.items()) + " | lookup " + str(round(lookup_us, 2)) + "us | model "
+        + str(len(json.dumps(grid.to_dict()))) + " bytes")
+
+# A fleet of cars at their sites with their drivers in, answering the stand-in servers in place of a trace. Every car
+# stays on the fast poll interval and every poll runs a full decision, but no door ever moves
+class FleetAccount:
+    def __init__(self):
+        self.name = "fleet"
+        self.start = time.time()
+        home = magic_garage.home_geofence
+        self.listing = json.dumps({"response": [{"id": i, "vehicle_id": 1000 + i, "display_name": "Car " + str(i), "state": "online"}
+            for i in range(FLEET_BENCH_VEHICLES)]})
+        self.vehicle_data = json.dumps({"response": {"drive_state": {"speed": 0, "shift_state": "P", "latitude": home.latitude,
+            "longitude": home.longitude, "heading": 0}, "vehicle_state": {"is_user_present": True},
+            "charge_state": {"charging_state": "Disconnected"}}})
+        self.devices = {}
+        for i in range(FLEET_BENCH_VEHICLES // FLEET_BENCH_VEHICLES_PER_DOOR):
+            self.devices["door" + str(i)] = {"serial_number": "door" + str(i), "name": "Door " + str(i), "device_family": "garagedoor",
+                "state": {"door_state": "closed"}}
+        self.device_list = json.dumps({"items": list(self.devices.values())})
+        self.account = json.dumps({"Account": {"Id": "bench"}})
+
+    def lookup(self, key, now):
+        provider, method, path = key
+        if (key == ("Tesla", "GET", replay.trace_path(magic_garage.TESLA_VEHICLES, {}))):
+            return 200, self.listing
+        if ((provider == "Tesla") and path.endswith("/vehicle_data")):
+            return 200, self.vehicle_data
+        if (key == ("MyQ", "GET", replay.trace_path(magic_garage.MYQ_ACCOUNT_ID, {}))):
+            return 200, self.account
+        if (key == ("MyQ", "GET", replay.trace_path(magic_garage.MYQ_DEVICE_LIST, {"account_id": "bench"}))):
+            return 200, self.device_list
+        if ((provider == "MyQ") and (path.rsplit("/", 1)[1] in self.devices)):
+            return 200, json.dumps(self.devices[path.rsplit("/", 1)[1]])
+        return None, None
+
+# Serves a FleetAccount from its own process, so the stand-in servers don't share a GIL with anything else. Runs until
+# the pipe is closed
+def run_fleet_stand_in(conn):
+    stand_in = replay.Replay(FleetAccount())
+    conn.send((stand_in.start_server("Tesla"), stand_in.start_server("MyQ")))
+    # The connections of the worker the benchmark kills are reset, which is expected
+    for server in stand_in.servers:
+        server.handle_error = lambda request, client_address: None
+    try:
+        conn.recv()
+    except EOFError:
+        pass
+
+# Gives every worker its own stand-in server process
+class BenchFleetCoordinator(fleet.FleetCoordinator):
+    def __init__(self, worker_count, settings):
+        super().__init__(worker_count, settings)
+        self.stand_ins = {}
+
+    def worker_base_urls(self, worker):
+        if (worker.index not in self.stand_ins):
+            conn, child_conn = self.context.Pipe()
+            process = self.context.Process(target=run_fleet_stand_in, args=(child_conn,), daemon=True)
+            process.start()
+            child_conn.close()
+            self.stand_ins[worker.index] = (process, conn, conn.recv())
+        return self.stand_ins[worker.index][2]
+
+    def stop(self):
+        super().stop()
+        for process, conn, base_urls in self.stand_ins.values():
+            conn.close()
+            process.join()
+
+# Runs the coordinator's checks until condition() holds, returning how long that took, or None after timeout seconds
+def run_fleet_until(coordinator, condition, timeout):
+    start = time.time()
+    while ((time.time() - start) < timeout):
+        coordinator.check()
+        if (condition()):
+            return time.time() - start
+        time.sleep(FLEET_BENCH_CHECK_SECS)
+    return None
+
+# Whether every car has been polled by a live worker since a time, after being handed to it
+def fleet_all_polled(coordinator, since, vehicle_ids=None):
+    for vehicle_id in (coordinator.vehicle_slots if (vehicle_ids is None) else vehicle_ids):
+        row = coordinator.vehicle_table.read(coordinator.vehicle_slots[vehicle_id])
+        if ((row is None) or (row[0] == fleet.FLEET_NO_OWNER) or (row[5] <= since) or (row[8] == 0)):
+            return False
+    return not coordinator.ring_changed
+
+# Vehicle data requests the workers made so far, from their heartbeat rows
+def fleet_samples(coordinator):
+    rows = [coordinator.worker_table.read(index) for index, worker in coordinator.workers.items() if worker.ready]
+    return sum(row[4] for row in rows if (row is not None))
+
+# Measures the vehicle samples per second the fleet polls, decodes and decides on with a worker count. With the most
+# workers it also kills a worker to time how long its cars go unpolled, and adds one to count the cars that move
+def run_fleet_bench(worker_count, settings, failover):
+    coordinator = BenchFleetCoordinator(worker_count, settings)
+    results = {}
+    try:
+        started_at = time.time()
+        coordinator.start()
+        if (run_fleet_until(coordinator, lambda: fleet_all_polled(coordinator, started_at), FLEET_BENCH_TIMEOUT_SECS) is None):
+            raise RuntimeError("Fleet did not start: " + coordinator.summary())
+        run_fleet_until(coordinator, lambda: False, FLEET_BENCH_WARMUP_SECS)
+        samples_before = fleet_samples(coordinator)
+        start = time.time()
+        run_fleet_until(coordinator, lambda: False, FLEET_BENCH_SECS)
+        results["samples_per_sec"] = (fleet_samples(coordinator) - samples_before) / (time.time() - start)
+        if (failover):
+            victim = coordinator.workers[0]
+            victim_cars = [vehicle_id for vehicle_id, owner in coordinator.owners.items() if (owner == victim.index)]
+            moved_before = coordinator.vehicles_moved
+            killed_at = time.time()
+            os.kill(victim.process.pid, signal.SIGKILL)
+            results["victim_cars"] = len(victim_cars)
+            results["failover_secs"] = run_fleet_until(coordinator, lambda: fleet_all_polled(coordinator, killed_at, victim_cars),
+                FLEET_BENCH_TIMEOUT_SECS)
+            # The killed worker comes back after its backoff and takes its cars back
+            run_fleet_until(coordinator, lambda: victim.ready and fleet_all_polled(coordinator, killed_at), FLEET_BENCH_TIMEOUT_SECS)
+            results["failover_moved"] = coordinator.vehicles_moved - moved_before
+            moved_before = coordinator.vehicles_moved
+            added_at = time.time()
+            added = coordinator.workers[coordinator.add_worker()]
+            run_fleet_until(coordinator, lambda: added.ready and fleet_all_polled(coordinator, added_at), FLEET_BENCH_TIMEOUT_SECS)
+            results["added_moved"] = coordinator.vehicles_moved - moved_before
+    finally:
+        coordinator.stop()
+    return results
+
+# Load test of the fleet daemon against stand-in servers with 1, 2, 4 .. workers. Each worker has a stand-in server
+# process of its own that keeps a core about as busy, so the worker counts go up to half the cores. Returns whether the
+# throughput scaled, or True when there are too few cores to measure it and only the rebalancing is run, on 2 workers
+def bench_fleet():
+    cores = os.cpu_count() or 1
+    scaling = (cores >= FLEET_BENCH_MIN_CORES)
+    counts = [count for count in FLEET_BENCH_WORKER_COUNTS if (count <= (cores // 2))] if scaling else [2]
+    door_map = {"Car " + str(i): "Door " + str(i // FLEET_BENCH_VEHICLES_PER_DOOR) for i in range(FLEET_BENCH_VEHICLES)}
+    stand_in = replay.Replay(FleetAccount())
+    magic_garage.tesla_client.base_url = stand_in.start_server("Tesla")
+    magic_garage.myq_client.base_url = stand_in.start_server("MyQ")
+    magic_garage.tesla_email = magic_garage.tesla_password = magic_garage.myq_email = magic_garage.myq_password = "bench"
+    magic_garage.TOKEN_CACHE_FILE = ""
+    magic_garage.STATE_SNAPSHOT_FILE = ""
+    magic_garage.VEHICLE_DOOR_MAP = door_map
+    reset_app_state()
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        settings = {"TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_FAST": FLEET_BENCH_POLL_SECS, "TESLA_REQUESTS_PER_SEC": 1e6,
+            "TESLA_REQUEST_BURST": 1e6, "MYQ_REQUESTS_PER_SEC": 1e6, "MYQ_REQUEST_BURST": 1e6, "TESLA_POLL_BUDGET_PER_MINUTE": 1e9,
+            "TELEMETRY_HISTORY_DIR": "", "VEHICLE_DOOR_MAP": door_map, "LOG_FILE_NAME": os.path.join(temp_dir, "debug.log")}
+        try:
+            magic_garage.tesla_init()
+            magic_garage.myq_init()
+            magic_garage.myq_get_door_state()
+            for count in counts:
+                results[count] = run_fleet_bench(count, settings, count == counts[-1])
+        finally:
+            for server in stand_in.servers:
+                server.shutdown()
+            magic_garage.VEHICLE_DOOR_MAP = {}
+            reset_app_state()
+    single = results[counts[0]]["samples_per_sec"]
+    print("Fleet (" + str(FLEET_BENCH_VEHICLES) + " cars, " + str(len(door_map) // FLEET_BENCH_VEHICLES_PER_DOOR) + " doors, " + str(cores)
+        + " cores): " + " | ".join(str(count) + " workers " + str(round(result["samples_per_sec"])) + " samples/s"
+        + ((" (" + str(round(result["samples_per_sec"] / single, 2)) + "x)") if scaling else "") for count, result in results.items()))
+    passed = True
+    if (scaling):
+        speedup = results[counts[-1]]["samples_per_sec"] / single
+        passed = (speedup >= FLEET_BENCH_MIN_SCALING * counts[-1])
+        print("Fleet scaling: " + str(counts[-1]) + " workers " + str(round(speedup, 2)) + "x one worker | " + ("PASS" if passed else "FAIL")
+            + " (needs " + str(round(FLEET_BENCH_MIN_SCALING * counts[-1], 2)) + "x)")
+    else:
+        print("Fleet scaling: SKIPPED, needs " + str(FLEET_BENCH_MIN_CORES) + " cores for the workers and their stand-in servers and only "
+            + str(cores) + " here, so only the rebalancing was run")
+    last = results[counts[-1]]
+    failover = "not back" if (last["failover_secs"] is None) else (str(round(last["failover_secs"], 1)) + "s")
+    print("Fleet rebalancing: killed worker's " + str(last["victim_cars"]) + " cars polled again after " + failover + ", "
+        + str(last["failover_moved"]) + " moves out and back | added worker took " + str(last["added_moved"]) + "/" + str(FLEET_BENCH_VEHICLES)
+        + " cars (" + str(round(FLEET_BENCH_VEHICLES / (counts[-1] + 1))) + " for an even share)")
+    return passed
+
+# Builds a trace with one car parked at home and one closed door, for the stand-in servers
+def startup_trace():
+    home = magic_garage.home_geofence
+    vehicle_data = {"response": {"drive_state": {"speed": 0, "shift_state": "P", "latitude": home.latitude, "longitude": home.longitude,
+        "heading": 0}, "vehicle_state": {"is_user_present": False}, "charge_state": {"charging_state": "Disconnected"}}}
+    devices = {"items": [{"serial_number": "bench", "name": "Garage Door Opener", "device_family": "garagedoor",
+        "state": {"door_state": "closed"}}]}
+    entries = [
+        {"t": 0, "p": "Tesla", "m": "GET", "e": magic_garage.TESLA_VEHICLES, "u": {}, "s": 200,
+            "b": json.dumps({"response": [{"id": 1, "display_name": "Bench"}]})},
+        {"t": 0, "p": "Tesla", "m": "GET", "e": magic_garage.TESLA_VEHICLE_DATA, "u": {"id": 1}, "s": 200, "b": json.dumps(vehicle_data)},
+        {"t": 0, "p": "MyQ", "m": "GET", "e": magic_garage.MYQ_ACCOUNT_ID, "u": {}, "s": 200, "b": json.dumps({"Account": {"Id": "bench"}})},
+        {"t": 0, "p": "MyQ", "m": "GET", "e": magic_garage.MYQ_DEVICE_LIST, "u": {"account_id": "bench"}, "s": 200, "b": json.dumps(devices)}
+    ]
+    return replay.Trace("startup", entries)
+
+# Forgets everything a new process would not know
+def reset_app_state():
+    magic_garage.tesla_vehicles.clear()
+    magic_garage.myq_doors.clear()
+    magic_garage.myq_doors_stale = False
+    magic_garage.myq_account_id = ""
+    magic_garage.tesla_client.tokens = magic_garage.TeslaTokenManager()
+    magic_garage.myq_client.tokens = magic_garage.MyQTokenManager()
+    magic_garage.token_cache_salt = None
+    magic_garage.event_loop = None
+
+# Runs the startup sequence up to the first decision. As in the engine, the first vehicle and door polls run side by
+# side, and the decision only waits for the door poll when there is no door yet to decide for
+def start_app(pool):
+    start = time.perf_counter()
+    magic_garage.token_cache_load()
+    magic_garage.state_snapshot_load()
+    magic_garage.tesla_init()
+    magic_garage.myq_init()
+    vehicle = next(iter(magic_garage.tesla_vehicles.values()))
+    vehicle_poll = pool.submit(magic_garage.tesla_get_vehicle_data, vehicle)
+    door_poll = pool.submit(magic_garage.myq_get_door_state)
+    vehicle_poll.result()
+    if (vehicle.door is None):
+        door_poll.result()
+    magic_garage.tesla_check_arriving_leaving(vehicle)
+    elapsed = time.perf_counter() - start
+    door_poll.result()
+    return elapsed
+
+# Compares the time to the first decision from a cold start and from the warm start snapshot
+def bench_startup():
+    stand_in = replay.Replay(startup_trace(), BENCH_API_LATENCY_SECS)
+    magic_garage.tesla_client.base_url = stand_in.start_server("Tesla")
+    magic_garage.myq_client.base_url = stand_in.start_server("MyQ")
+    magic_garage.tesla_email = magic_garage.tesla_password = magic_garage.myq_email = magic_garage.myq_password = "bench"
+    cold_times, warm_times = [], []
+    cold_requests, warm_requests = 0, 0
+    with tempfile.TemporaryDirectory() as temp_dir, ThreadPoolExecutor(max_workers=2) as pool:
+        magic_garage.TOKEN_CACHE_FILE = os.path.join(temp_dir, "token_cache.json")
+        magic_garage.STATE_SNAPSHOT_FILE = os.path.join(temp_dir, "state_snapshot.json")
+        for i in range(BENCH_STARTUP_RUNS):
+            for file_name in [magic_garage.TOKEN_CACHE_FILE, magic_garage.STATE_SNAPSHOT_FILE]:
+                if (os.path.exists(file_name)):
+                    os.remove(file_name)
+            reset_app_state()
+            requests_before = sum(stand_in.api_calls.values())
+            cold_times.append(start_app(pool))
+            cold_requests = sum(stand_in.api_calls.values()) - requests_before
+            magic_garage.state_snapshot_save()
+            reset_app_state()
+            requests_before = sum(stand_in.api_calls.values())
+            warm_times.append(start_app(pool))
+            warm_requests = sum(stand_in.api_calls.values()) - requests_before
+    for server in stand_in.servers:
+        server.shutdown()
+    cold_ms = 1000 * statistics.median(cold_times)
+    warm_ms = 1000 * statistics.median(warm_times)
+    print("Startup: cold " + str(round(cold_ms)) + "ms (" + str(cold_requests) + " requests) | warm " + str(round(warm_ms)) + "ms ("
+        + str(warm_requests) + " requests) | " + str(round(cold_ms / warm_ms, 1)) + "x faster at " + str(round(1000 * BENCH_API_LATENCY_SECS))
+        + "ms per request")
+    if (magic_garage.Fernet is None):
+        print("Startup: install cryptography to cache tokens, warm starts log in again without it")
+
+# Returns the nanoseconds a run of calls takes
+def micro_run(function, calls):
+    start = time.perf_counter_ns()
+    for i in range(calls):
+        function()
+    return time.perf_counter_ns() - start
+
+# Returns the median and best nanoseconds per call over MICRO_REPEATS runs, and the calls in each run. As in timeit, the
+# calls are doubled until a run takes MICRO_MIN_RUN_SECS and the garbage collector is held off while timing
+def micro_time(function):
+    gc.disable()
+    try:
+        calls = 1
+        while (micro_run(function, calls) < MICRO_MIN_RUN_SECS * 1e9):
+            calls *= 2
+        times = [micro_run(function, calls) / calls for i in range(MICRO_REPEATS)]
+    finally:
+        gc.enable()
+    return statistics.median(times), min(times), calls
+
+def format_ns(ns):
+    if (ns >= 1e6):
+        return str(round(ns / 1e6, 2)) + "ms"
+    if (ns >= 1e3):
+        return str(round(ns / 1e3, 2)) + "us"
+    return str(round(ns)) + "ns"
+
+# Positions a lap apart along a drive north to home from MICRO_DRIVE_FAR_FT out to MICRO_DRIVE_NEAR_FT, one second apart
+def micro_drive_lap(home):
+    step_ft = MICRO_DRIVE_SPEED_MPH * magic_garage.FEET_PER_SECOND_PER_MPH
+    steps = int((MICRO_DRIVE_FAR_FT - MICRO_DRIVE_NEAR_FT) / step_ft)
+    return [(home.latitude - (MICRO_DRIVE_FAR_FT - i * step_ft) / home.feet_per_degree_north, home.longitude) for i in range(steps)]
+
+# A car with a closed door to decide for
+def micro_vehicle(vehicle_id, door):
+    vehicle = magic_garage.Vehicle(vehicle_id, "Micro " + str(vehicle_id))
+    vehicle.door = door
+    return vehicle
+
+def micro_door(serial):
+    door = magic_garage.GarageDoor(serial, "Micro Door " + serial)
+    door.state = "closed"
+    return door
+
+# Applies the next sample of a car's drive, as the poller does once it has the response decoded
+def micro_apply_drive_sample(vehicle, lap, timestamp):
+    latitude, longitude = lap[(timestamp + vehicle.id) % len(lap)]
+    magic_garage.tesla_apply_sample(vehicle, magic_garage.VehicleSample(True, False, "DRIVE", MICRO_DRIVE_SPEED_MPH, 0, latitude,
+        longitude, timestamp))
+
+# One full decision for one car: apply a new sample, update its state and schedule its next poll
+def micro_decision_step():
+    lap = micro_drive_lap(magic_garage.home_geofence)
+    vehicle = micro_vehicle(1, micro_door("micro"))
+    magic_garage.tesla_vehicles[vehicle.id] = vehicle
+    clock = itertools.count(int(time.time()))
+
+    def step():
+        micro_apply_drive_sample(vehicle, lap, next(clock))
+        magic_garage.tesla_decide(vehicle)
+    return step
+
+# A new sample and decision for every car of a MICRO_TICK_VEHICLES fleet, each one scheduling its next poll against the
+# fleet's poll budget as its decision loop does
+def micro_fleet_tick():
+    lap = micro_drive_lap(magic_garage.home_geofence)
+    vehicles = []
+    for i in range(MICRO_TICK_VEHICLES):
+        if ((i % FLEET_BENCH_VEHICLES_PER_DOOR) == 0):
+            door = micro_door("micro" + str(i))
+        vehicles.append(micro_vehicle(i, door))
+        magic_garage.tesla_vehicles[i] = vehicles[-1]
+    clock = itertools.count(int(time.time()))
+
+    def tick():
+        timestamp = next(clock)
+        for vehicle in vehicles:
+            micro_apply_drive_sample(vehicle, lap, timestamp)
+            magic_garage.tesla_decide(vehicle)
+    return tick
+
+# The microbenchmarks as (name, setup), where setup returns the function to time. Logging stays at the default WARNING
+# level, so the decisions don't format their INFO records
+def micro_benchmarks():
+    home = magic_garage.home_geofence
+    positions = itertools.cycle(random_positions(home, MICRO_POSITIONS, magic_garage.AWAY_GEO_FENCE_FT))
+    vehicle = micro_vehicle(0, None)
+    vehicle.distance_from_home = MICRO_DRIVE_FAR_FT
+    vehicle_data = vehicle_data_payload(False)
+    full_vehicle_data = vehicle_data_payload(True)
+    devices = device_list_payload()
+    benchmarks = [
+        ("geo.distance_feet", lambda: lambda: home.distance_feet(*next(positions))),
+        ("geo.vehicle_distance", lambda: lambda: magic_garage.calculate_current_distance_from_home_feet(vehicle, *next(positions))),
+        ("geo.relative_location", lambda: lambda: magic_garage.tesla_get_relative_location(vehicle)),
+        ("decode.vehicle_data", lambda: lambda: magic_garage.tesla_decode_vehicle_data(vehicle_data)),
+        ("decode.vehicle_data_full", lambda: lambda: magic_garage.tesla_decode_vehicle_data(full_vehicle_data)),
+        ("decode.device_list", lambda: lambda: magic_garage.myq_decode_doors(devices)),
+        ("decision.step", micro_decision_step),
+        ("tick." + str(MICRO_TICK_VEHICLES) + "_vehicles", micro_fleet_tick)
+    ]
+    if (magic_garage.np is not None):
+        latitudes, longitudes = zip(*random_positions(home, MICRO_TICK_VEHICLES, magic_garage.AWAY_GEO_FENCE_FT))
+        benchmarks.insert(3, ("geo.batch_distances_" + str(MICRO_TICK_VEHICLES),
+            lambda: lambda: magic_garage.geofence_distances_feet(latitudes, longitudes, [home])))
+    stacks = {}
+    benchmarks.append(("profiler.sample", lambda: lambda: magic_garage.profiler.sample(stacks)))
+    return benchmarks
+
+# Times the microbenchmarks, returning their results with what they ran on
+def bench_micro():
+    results = {}
+    for name, setup in micro_benchmarks():
+        reset_app_state()
+        median_ns, best_ns, calls = micro_time(setup())
+        results[name] = {"median_ns": median_ns, "best_ns": best_ns, "calls": calls}
+        print("Micro " + name + ": " + format_ns(median_ns) + " median | " + format_ns(best_ns) + " best | " + str(calls) + " calls x "
+            + str(MICRO_REPEATS) + " runs")
+    reset_app_state()
+    return {"python": platform.python_implementation() + " " + platform.python_version(), "machine": platform.machine(),
+        "cpus": os.cpu_count(), "orjson": (magic_garage.orjson is not None), "numpy": (magic_garage.np is not None),
+        "time": time.time(), "results": results}
+
+# Reports each microbenchmark's change from a previous run, returning the names of the ones that got more than
+# MICRO_REGRESSION_THRESHOLD slower. Best times are compared, since other work on the machine only ever adds time
+def micro_compare(run, previous):
+    for field in ["python", "machine", "cpus", "orjson", "numpy"]:
+        if (run[field] != previous.get(field)):
+            print("Compare: " + field + " was " + str(previous.get(field)) + " and is now " + str(run[field]) + ", so the times may not compare")
+    regressions = []
+    for name, result in run["results"].items():
+        before = previous["results"].get(name)
+        if (before is None):
+            print("Compare " + name + ": new")
+            continue
+        change = result["best_ns"] / before["best_ns"] - 1
+        regressed = (change > MICRO_REGRESSION_THRESHOLD)
+        if (regressed):
+            regressions.append(name)
+        print("Compare " + name + ": " + format_ns(before["best_ns"]) + " -> " + format_ns(result["best_ns"]) + " ("
+            + ("+" if (change >= 0) else "") + str(round(100 * change, 1)) + "%)" + (" REGRESSED" if regressed else ""))
+    print("Compare: " + (str(len(regressions)) + " regressed over " if regressions else "no regressions over ")
+        + str(round(100 * MICRO_REGRESSION_THRESHOLD)) + "%")
+    return regressions
+
+# Returns the value given for a command line option, or None if it was not given
+def option_value(option):
+    if (option not in sys.argv):
+        return None
+    index = sys.argv.index(option) + 1
+    if (index >= len(sys.argv)):
+        print("Usage: python3 benchmarks.py [--micro] [--json results file] [--compare previous results file]")
+        sys.exit(1)
+    return sys.argv[index]
+
+# Runs the full suite, or only the microbenchmarks with --micro, returning whether the checks passed and the
+# microbenchmark results
+def run_benchmarks():
+    passed = True
+    if ("--micro" not in sys.argv):
+        passed = bench_geo_accuracy()
+        bench_geo_throughput()
+        bench_decode()
+        bench_logging()
+        bench_history()
+        bench_corridor()
+        bench_startup()
+        bench_streaming()
+        bench_status_api()
+        passed = bench_fleet() and passed
+    return passed, bench_micro()
+
+def main():
+    random.seed(BENCH_SEED)
+    results_file = option_value("--json")
+    compare_file = option_value("--compare")
+    previous = None
+    if (compare_file is not None):
+        with open(compare_file) as file:
+            previous = json.load(file)
+    try:
+        passed, run = run_benchmarks()
+    except SystemExit as e:
+        # The app exits through print_error_and_exit with no error code, which must not pass for a finished run
+        if (e.code in (None, 0)):
+            print("Benchmarks: aborted before finishing")
+            sys.exit(1)
+        raise
+    if (results_file is not None):
+        magic_garage.write_file_atomic(results_file, json.dumps(run, indent=1))
+        print("Micro: results written to " + results_file)
+    regressions = [] if (previous is None) else micro_compare(run, previous)
+    if ((not passed) or (len(regressions) > 0)):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
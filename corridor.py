@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# Trains the approach corridor model from the telemetry history and reports how it does on held-out trips
+# To Run: python3 corridor.py [history dir] [model file]
+# The model is written to magic_garage's CORRIDOR_MODEL_FILE by default, and the app loads it on its next start
+
+import os
+import sys
+import math
+import json
+import random
+import magic_garage
+from magic_garage import np
+
+CORRIDOR_CELL_FT = 100
+CORRIDOR_HEADING_BINS = 8
+CORRIDOR_RADIUS_FT = magic_garage.ARRIVING_GEO_FENCE_FT + 500
+# Cells and headings fewer trips than this went through are left to the speed check
+CORRIDOR_MIN_TRIPS = 3
+# A trip is a run of driving samples with no gap longer than this, and it ends at home if it stops this close to it
+TRIP_GAP_SECS = 5 * 60
+TRIP_END_HOME_FT = 200
+HOLDOUT_FRACTION = 0.2
+HOLDOUT_SEED = 7
+
+# A single drive, as NumPy arrays
+class Trip:
+    def __init__(self, vehicle, t, latitude, longitude, speed, heading):
+        self.vehicle = vehicle
+        self.t = t
+        self.latitude = latitude
+        self.longitude = longitude
+        self.speed = speed
+        self.heading = heading
+
+    # Distances in feet from a home for every sample
+    def distances(self, home):
+        east, north = home.local_feet(self.latitude, self.longitude)
+        return np.hypot(east, north)
+
+    def ends_at(self, home):
+        return (home.distance_feet(self.latitude[-1], self.longitude[-1]) <= TRIP_END_HOME_FT)
+
+# Reads every car's samples from the history day files, returning {vehicle key: records sorted by time}
+def load_history(directory):
+    dtype = np.dtype(magic_garage.TELEMETRY_HISTORY_FIELDS["vehicle"])
+    files = {}
+    for file_name in sorted(os.listdir(directory)):
+        if (file_name.startswith("vehicle-") and file_name.endswith(".bin")):
+            files.setdefault(file_name[len("vehicle-"):-len("-YYYYMMDD.bin")], []).append(os.path.join(directory, file_name))
+    history = {}
+    for key, paths in files.items():
+        parts = [np.fromfile(path, dtype=dtype, count=os.path.getsize(path) // dtype.itemsize) for path in paths]
+        records = np.concatenate(parts)
+        history[key] = records[np.argsort(records["t"], kind="stable")]
+    return history
+
+# Splits a car's records into trips. A trip runs from the first sample out of park to the first parked sample after
+# it, which is where it ended
+def split_trips(vehicle, records):
+    trips = []
+    driving = records["shift"] != magic_garage.SHIFT_STATES.index("PARKED")
+    start = None
+    for i in range(len(records)):
+        gap = (i > 0) and ((records["t"][i] - records["t"][i - 1]) > TRIP_GAP_SECS)
+        if ((start is not None) and gap):
+            trips.append((start, i))
+            start = None
+        if ((start is None) and driving[i]):
+            start = i
+        elif ((start is not None) and not driving[i]):
+            trips.append((start, i + 1))
+            start = None
+    if (start is not None):
+        trips.append((start, len(records)))
+    return [Trip(vehicle, records["t"][first:last], records["lat"][first:last] / 1e7, records["lon"][first:last] / 1e7,
+        records["speed"][first:last] / 10, records["heading"][first:last].astype(np.float64))
+        for first, last in trips if ((last - first) >= 2)]
+
+# Builds a home's corridor grid from trips. Each trip counts once for every cell and heading it passes through
+def train(trips, home):
+    cells_per_side = math.ceil(2 * CORRIDOR_RADIUS_FT / CORRIDOR_CELL_FT)
+    size = (cells_per_side ** 2) * CORRIDOR_HEADING_BINS
+    total = np.zeros(size, dtype=np.int64)
+    at_home = np.zeros(size, dtype=np.int64)
+    for trip in trips:
+        east, north = home.local_feet(trip.latitude, trip.longitude)
+        columns = np.floor((east + CORRIDOR_RADIUS_FT) / CORRIDOR_CELL_FT).astype(np.int64)
+        rows = np.floor((north + CORRIDOR_RADIUS_FT) / CORRIDOR_CELL_FT).astype(np.int64)
+        headings = np.floor((trip.heading % 360) * CORRIDOR_HEADING_BINS / 360).astype(np.int64) % CORRIDOR_HEADING_BINS
+        inside = (columns >= 0) & (rows >= 0) & (columns < cells_per_side) & (rows < cells_per_side)
+        indexes = np.unique((rows[inside] * cells_per_side + columns[inside]) * CORRIDOR_HEADING_BINS + headings[inside])
+        total[indexes] += 1
+        if (trip.ends_at(home)):
+            at_home[indexes] += 1
+    # Smoothed towards even odds, so a cell a handful of trips went through does not read as certain
+    probabilities = np.round(magic_garage.CORRIDOR_PROBABILITY_SCALE * (at_home + 1) / (total + 2)).astype(np.uint8)
+    probabilities[total < CORRIDOR_MIN_TRIPS] = magic_garage.CORRIDOR_UNKNOWN
+    return magic_garage.CorridorGrid(home.latitude, home.longitude, CORRIDOR_CELL_FT, CORRIDOR_HEADING_BINS, CORRIDOR_RADIUS_FT,
+        probabilities.tobytes())
+
+# Returns whether a trip would have been taken for an arrival: some sample inside the arriving geofence closing in
+# on home faster than TESLA_MIN_RANGE_RATE_FPS that the rule accepts. Without a grid the rule is the speed check alone
+def predicts_arrival(trip, home, grid):
+    distances = trip.distances(home)
+    for i in range(1, len(distances)):
+        elapsed = trip.t[i] - trip.t[i - 1]
+        if ((distances[i] < magic_garage.HOME_GEO_FENCE_FT) or (distances[i] > magic_garage.ARRIVING_GEO_FENCE_FT) or (elapsed <= 0)
+            or (((distances[i - 1] - distances[i]) / elapsed) <= magic_garage.TESLA_MIN_RANGE_RATE_FPS)):
+            continue
+        probability = None if (grid is None) else grid.probability(trip.latitude[i], trip.longitude[i], trip.heading[i])
+        if (probability is not None):
+            if (probability >= magic_garage.CORRIDOR_ARRIVAL_PROBABILITY):
+                return True
+        elif (trip.speed[i] <= magic_garage.TESLA_ARRIVING_MAX_SPEED_MPH):
+            return True
+    return False
+
+# Returns (precision, recall, false arrivals, missed arrivals) of the arrival rule over trips that came near home
+def evaluate(trips, home, grid):
+    true_positives = false_positives = false_negatives = 0
+    for trip in trips:
+        if (trip.distances(home).min() > magic_garage.ARRIVING_GEO_FENCE_FT):
+            continue
+        predicted = predicts_arrival(trip, home, grid)
+        actual = trip.ends_at(home)
+        true_positives += int(predicted and actual)
+        false_positives += int(predicted and not actual)
+        false_negatives += int(actual and not predicted)
+    precision = true_positives / max(true_positives + false_positives, 1)
+    recall = true_positives / max(true_positives + false_negatives, 1)
+    return precision, recall, false_positives, false_negatives
+
+# Holds out a fraction of the trips for evaluation, returning (training, held out)
+def holdout_split(trips):
+    shuffled = list(trips)
+    random.Random(HOLDOUT_SEED).shuffle(shuffled)
+    held_out = max(1, round(HOLDOUT_FRACTION * len(shuffled))) if (len(shuffled) > 1) else 0
+    return shuffled[held_out:], shuffled[:held_out]
+
+# The homes the cars drive to: HOME_LOCATION and every door's home location
+def corridor_homes():
+    homes = [magic_garage.home_geofence]
+    for latitude, longitude in magic_garage.DOOR_HOME_LOCATIONS.values():
+        homes.append(magic_garage.GeoFence(latitude, longitude))
+    return homes
+
+# Trains a grid for every home on the training trips, reporting the speed check and the model on the held out trips
+def train_and_report(trips, homes):
+    training, held_out = holdout_split(trips)
+    grids = []
+    for home in homes:
+        grid = train(training, home)
+        grids.append(grid)
+        covered = sum(1 for value in grid.probabilities if (value != magic_garage.CORRIDOR_UNKNOWN))
+        print("Home " + str(round(home.latitude, 6)) + "," + str(round(home.longitude, 6)) + ": " + str(covered) + "/"
+            + str(len(grid.probabilities)) + " cells and headings covered, " + str(len(grid.to_dict()["probabilities"])) + " bytes encoded")
+        for name, rule_grid in [("speed check", None), ("corridor model", grid)]:
+            precision, recall, false_arrivals, missed = evaluate(held_out, home, rule_grid)
+            print("  " + name + ": precision " + str(round(precision, 3)) + " | recall " + str(round(recall, 3)) + " | "
+                + str(false_arrivals) + " false arrivals | " + str(missed) + " missed arrivals on " + str(len(held_out)) + " held out trips")
+    return grids
+
+def save_model(grids, file_name):
+    magic_garage.write_file_atomic(file_name, json.dumps({"grids": [grid.to_dict() for grid in grids]}, separators=(",", ":")))
+
+def main():
+    if (np is None):
+        print("NumPy is required to train the corridor model")
+        sys.exit(1)
+    directory = sys.argv[1] if (len(sys.argv) > 1) else magic_garage.TELEMETRY_HISTORY_DIR
+    model_file = sys.argv[2] if (len(sys.argv) > 2) else magic_garage.CORRIDOR_MODEL_FILE
+    if (not os.path.isdir(directory)):
+        print("Usage: python3 corridor.py [history dir] [model file]")
+        sys.exit(1)
+    trips = []
+    for vehicle, records in load_history(directory).items():
+        trips.extend(split_trips(vehicle, records))
+    if (len(trips) < 2):
+        print("Not enough trips in " + directory + " to train the corridor model")
+        sys.exit(1)
+    print("Trips: " + str(len(trips)) + " from " + directory)
+    grids = train_and_report(trips, corridor_homes())
+    save_model(grids, model_file)
+    print("Corridor model written to " + model_file)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,712 @@
+#!/usr/bin/env python3
+# Runs Magic Garage for a whole fleet of cars and doors across several sites, with a coordinator process and a pool of
+# worker processes. Each worker runs the app's pollers and decision loops for its share of the cars
+# To Run: python3 fleet.py tesla_email tesla_password myq_email myq_password [workers]
+# Send SIGUSR2 to the coordinator to add a worker
+import os
+import sys
+import time
+import struct
+import signal
+import bisect
+import hashlib
+import logging
+import asyncio
+import threading
+import multiprocessing
+import requests
+from multiprocessing import shared_memory
+import magic_garage
+from magic_garage import Worker
+
+FLEET_WORKERS = os.cpu_count() or 1
+FLEET_MAX_WORKERS = 64
+# Points each worker gets on the hash ring. More points spread the cars more evenly
+FLEET_RING_REPLICAS = 128
+FLEET_CHECK_SECS = 1
+# Workers write their cars' and doors' rows and their own heartbeat row this often
+FLEET_PUBLISH_SECS = 0.5
+# A worker that is not ready this long after starting, or whose heartbeat is this old, is killed and restarted
+FLEET_START_TIMEOUT_SECS = 30
+FLEET_WORKER_STALL_SECS = 30
+# How long a worker has to hand over its cars before it is killed so another can take them
+FLEET_HANDOFF_TIMEOUT_SECS = 10
+FLEET_STOP_TIMEOUT_SECS = 5
+# Only the coordinator logs in. A worker whose token was rejected waits this long for the coordinator to send a new one
+FLEET_TOKEN_WAIT_SECS = 30
+FLEET_READ_ATTEMPTS = 1000
+# Account wide request limits, split evenly between the workers with the smallest share each gets
+FLEET_SHARED_LIMITS = {"TESLA_REQUESTS_PER_SEC": 0, "TESLA_REQUEST_BURST": 1, "MYQ_REQUESTS_PER_SEC": 0, "MYQ_REQUEST_BURST": 1,
+    "TESLA_POLL_BUDGET_PER_MINUTE": 1}
+
+# Shared State Table Rows
+# Each row starts with a sequence number, followed by the row's fields
+FLEET_SEQUENCE = struct.Struct("<Q")
+# Owner, state, shift state, awake, state since, updated at, distance from home (ft), speed (MPH), polls
+FLEET_VEHICLE_ROW = struct.Struct("<iBBBdddfI")
+# Owner, door state, state changed at, updated at
+FLEET_DOOR_ROW = struct.Struct("<iBdd")
+# PID, cars, doors, heartbeat at, vehicle data requests made
+FLEET_WORKER_ROW = struct.Struct("<iIIdQ")
+FLEET_VEHICLE_STATES = [None, magic_garage.VEHICLE_STATE_PARKED_HOME, magic_garage.VEHICLE_STATE_LEAVING, magic_garage.VEHICLE_STATE_AWAY,
+    magic_garage.VEHICLE_STATE_APPROACHING, magic_garage.VEHICLE_STATE_ARRIVING]
+FLEET_NO_OWNER = -1
+
+# Consistent Hashing
+# Positions on the ring come from a digest, since Python's own string hash differs between processes
+def fleet_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+# Maps keys to workers so that adding or removing a worker only moves the keys that worker gains or loses
+class HashRing:
+    def __init__(self, replicas):
+        self.replicas = replicas
+        self.hashes = []
+        self.nodes = []
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = fleet_hash(str(node) + "#" + str(replica))
+            i = bisect.bisect_left(self.hashes, point)
+            self.hashes.insert(i, point)
+            self.nodes.insert(i, node)
+
+    def remove(self, node):
+        points = [(point, owner) for point, owner in zip(self.hashes, self.nodes) if (owner != node)]
+        self.hashes = [point for point, owner in points]
+        self.nodes = [owner for point, owner in points]
+
+    # Returns the node owning a key, or None if the ring is empty
+    def owner(self, key):
+        if (len(self.hashes) == 0):
+            return None
+        return self.nodes[bisect.bisect_right(self.hashes, fleet_hash(key)) % len(self.hashes)]
+
+# Shared State Table
+# Fixed size rows in shared memory, each written by one process at a time and read by any. A row's sequence number is
+# odd while the row is being written, so a reader retries a row that changed under it instead of taking a lock that a
+# crashed worker could leave held
+class SharedStateTable:
+    def __init__(self, row, slots, name=None):
+        self.row = row
+        self.slots = slots
+        self.stride = FLEET_SEQUENCE.size + row.size
+        self.created = (name is None)
+        if (self.created):
+            self.memory = shared_memory.SharedMemory(create=True, size=max(self.stride * slots, 1))
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.name = self.memory.name
+
+    def write(self, slot, values):
+        offset = slot * self.stride
+        # A writer that died mid write left the sequence odd, and the next write carries on from there
+        sequence = FLEET_SEQUENCE.unpack_from(self.memory.buf, offset)[0] | 1
+        FLEET_SEQUENCE.pack_into(self.memory.buf, offset, sequence)
+        self.row.pack_into(self.memory.buf, offset + FLEET_SEQUENCE.size, *values)
+        FLEET_SEQUENCE.pack_into(self.memory.buf, offset, sequence + 1)
+
+    # Returns a row's fields, or None if it was never written or did not hold still long enough to read
+    def read(self, slot):
+        offset = slot * self.stride
+        for attempt in range(FLEET_READ_ATTEMPTS):
+            before = FLEET_SEQUENCE.unpack_from(self.memory.buf, offset)[0]
+            if ((before & 1) == 0):
+                values = self.row.unpack_from(self.memory.buf, offset + FLEET_SEQUENCE.size)
+                if (FLEET_SEQUENCE.unpack_from(self.memory.buf, offset)[0] == before):
+                    return values if (before > 0) else None
+            time.sleep(0)
+        return None
+
+    # Detaches from the table. The coordinator that created it also removes it
+    def close(self):
+        self.memory.close()
+        if (self.created):
+            self.memory.unlink()
+
+def fleet_vehicle_row(owner, vehicle, updated_at):
+    return (owner, FLEET_VEHICLE_STATES.index(vehicle.state), magic_garage.SHIFT_STATES.index(vehicle.shift_state), int(vehicle.awake),
+        vehicle.state_since, updated_at, vehicle.distance_from_home, vehicle.speed, vehicle.poll_count)
+
+def fleet_door_row(owner, door, updated_at):
+    return (owner, magic_garage.history_door_state_code(door.state), door.state_changed_at, updated_at)
+
+# Picks up where a car's previous worker left off, if its row is recent enough
+def fleet_restore_vehicle(vehicle, row):
+    if ((row is None) or ((time.time() - row[5]) > magic_garage.STATE_SNAPSHOT_MAX_AGE_SECS)):
+        return False
+    owner, state, shift, awake, state_since, updated_at, distance_from_home, speed, polls = row
+    vehicle.state = FLEET_VEHICLE_STATES[state]
+    vehicle.state_since = state_since
+    vehicle.shift_state = magic_garage.SHIFT_STATES[shift]
+    vehicle.awake = bool(awake)
+    vehicle.distance_from_home = distance_from_home
+    vehicle.speed = speed
+    return True
+
+# Takes a door's state from its row if the previous worker saw it change more recently
+def fleet_restore_door(door, row):
+    if ((row is None) or (row[2] <= door.state_changed_at)):
+        return
+    door.state = magic_garage.TELEMETRY_HISTORY_DOOR_STATES[row[1]]
+    door.state_changed_at = row[2]
+
+# Loads the tokens the coordinator renewed
+def fleet_load_tokens(tokens):
+    for client in [magic_garage.tesla_client, magic_garage.myq_client]:
+        if (client.tokens.provider in tokens):
+            client.tokens.load_cache(tokens[client.tokens.provider])
+
+# Sends a message to the coordinator. The pipe is shared by the event loop and the poll threads renewing tokens
+fleet_worker_send_lock = threading.Lock()
+
+def fleet_worker_send(conn, message, args):
+    with fleet_worker_send_lock:
+        conn.send((message, args))
+
+# A worker's auth token. Renewing it, after a 401 or once it ran out, asks the coordinator to renew the rejected token and
+# waits for the tokens it sends back, so the coordinator stays the one process that logs in and hands out tokens
+class FleetTokenManager(magic_garage.TokenManager):
+    def __init__(self, provider, conn):
+        super().__init__(provider, 0, self.renew_from_coordinator)
+        self.conn = conn
+        self.delivered = threading.Condition()
+        self.deliveries = 0
+        self.delivered_tokens = None
+
+    # The coordinator answers with its current tokens once it has dealt with the rejected one
+    def renew_from_coordinator(self):
+        with self.delivered:
+            deliveries = self.deliveries
+            fleet_worker_send(self.conn, "renew_tokens", (self.provider, self.access_token))
+            if (not self.delivered.wait_for(lambda: (self.deliveries > deliveries), FLEET_TOKEN_WAIT_SECS)):
+                raise magic_garage.AuthError("The Fleet Coordinator did not renew the " + self.provider + " Auth Token")
+            tokens = self.delivered_tokens
+        return {"access_token": tokens["access_token"], "refresh_token": tokens["refresh_token"],
+            "expires_in": tokens["expires_at"] - time.time()}
+
+    # Hands the coordinator's tokens to a renewal waiting on them before taking them as usual. Deliveries are loaded on
+    # the event loop's executor and can finish out of order, so the newest one is the one taken
+    def load_cache(self, cached):
+        with self.delivered:
+            self.deliveries += 1
+            self.delivered_tokens = cached
+            self.delivered.notify_all()
+        super().load_cache(self.delivered_tokens)
+
+# Fleet Worker
+# A worker process's share of the fleet. The coordinator hands cars over with acquire and release commands on the
+# worker's pipe, and the worker writes its cars' and doors' rows to the shared tables
+class FleetShard:
+    def __init__(self, index, config, conn):
+        self.index = index
+        self.conn = conn
+        self.vehicles = config["vehicles"]
+        self.door_slots = config["door_slots"]
+        self.vehicle_table = SharedStateTable(FLEET_VEHICLE_ROW, len(self.vehicles), config["tables"]["vehicle"])
+        self.door_table = SharedStateTable(FLEET_DOOR_ROW, len(self.door_slots), config["tables"]["door"])
+        self.worker_table = SharedStateTable(FLEET_WORKER_ROW, FLEET_MAX_WORKERS, config["tables"]["worker"])
+        self.stopped = asyncio.Event()
+
+    def start(self):
+        magic_garage.event_loop.add_reader(self.conn.fileno(), self.receive)
+        self.publish()
+        fleet_worker_send(self.conn, "ready", os.getpid())
+
+    def receive(self):
+        try:
+            while ((not self.stopped.is_set()) and self.conn.poll()):
+                command, args = self.conn.recv()
+                if (command == "acquire"):
+                    self.acquire(args)
+                elif (command == "release"):
+                    self.release(args)
+                    fleet_worker_send(self.conn, "released", args)
+                elif (command == "tokens"):
+                    # A poll thread renewing a token holds its lock until these tokens reach it, so they are not
+                    # loaded on the event loop
+                    magic_garage.event_loop.run_in_executor(None, fleet_load_tokens, args)
+                elif (command == "stop"):
+                    self.stop()
+        except (EOFError, OSError):
+            logging.error("Lost the Fleet Coordinator, stopping")
+            self.stop()
+
+    # Starts polling and deciding for cars, warm started from their rows
+    def acquire(self, vehicle_ids):
+        vehicles = dict(magic_garage.tesla_vehicles)
+        acquired = []
+        for vehicle_id in vehicle_ids:
+            slot, name, stream_id, door_serial = self.vehicles[vehicle_id]
+            vehicle = magic_garage.Vehicle(vehicle_id, name)
+            vehicle.stream_id = stream_id
+            vehicle.door = magic_garage.myq_doors.get(door_serial)
+            fleet_restore_vehicle(vehicle, self.vehicle_table.read(slot))
+            if ((vehicle.door is not None) and (door_serial in self.door_slots)):
+                fleet_restore_door(vehicle.door, self.door_table.read(self.door_slots[door_serial]))
+            vehicles[vehicle_id] = vehicle
+            acquired.append(vehicle)
+        # The registry is replaced rather than changed, since the poll and door threads iterate over it
+        magic_garage.tesla_vehicles = vehicles
+        for vehicle in acquired:
+            for worker in magic_garage.tesla_vehicle_workers(vehicle):
+                magic_garage.supervisor_add(worker)
+        magic_garage.tesla_apply_poll_budget()
+        magic_garage.update_myq_door_thread_interval()
+        logging.info("Fleet Worker " + str(self.index) + " took over " + str(len(acquired)) + " cars, now has " + str(len(vehicles)))
+
+    # Stops polling and deciding for cars, leaving their last state in their rows for the next worker
+    def release(self, vehicle_ids):
+        vehicles = dict(magic_garage.tesla_vehicles)
+        released = [vehicles.pop(vehicle_id) for vehicle_id in vehicle_ids if (vehicle_id in vehicles)]
+        magic_garage.tesla_vehicles = vehicles
+        now = time.time()
+        kept_doors = {vehicle.door.serial for vehicle in vehicles.values() if (vehicle.door is not None)}
+        for vehicle in released:
+            for name, worker in list(magic_garage.supervisor_workers.items()):
+                if (worker.args == (vehicle,)):
+                    magic_garage.supervisor_remove(name)
+            self.vehicle_table.write(self.vehicles[vehicle.id][0], fleet_vehicle_row(FLEET_NO_OWNER, vehicle, now))
+            if (magic_garage.history_store is not None):
+                magic_garage.history_store.release("vehicle", vehicle.id)
+            door = vehicle.door
+            if ((door is not None) and (door.serial not in kept_doors) and (door.serial in self.door_slots)):
+                self.door_table.write(self.door_slots[door.serial], fleet_door_row(FLEET_NO_OWNER, door, now))
+                if (magic_garage.history_store is not None):
+                    magic_garage.history_store.release("door", door.serial)
+        magic_garage.tesla_apply_poll_budget()
+        magic_garage.update_myq_door_thread_interval()
+        logging.info("Fleet Worker " + str(self.index) + " handed over " + str(len(released)) + " cars, now has " + str(len(vehicles)))
+
+    # Writes the rows of this worker's cars, their doors and its heartbeat
+    def publish(self):
+        now = time.time()
+        vehicles = magic_garage.tesla_vehicles
+        doors = {}
+        for vehicle in vehicles.values():
+            self.vehicle_table.write(self.vehicles[vehicle.id][0], fleet_vehicle_row(self.index, vehicle, now))
+            if ((vehicle.door is not None) and (vehicle.door.serial in self.door_slots)):
+                doors[vehicle.door.serial] = vehicle.door
+        for door in doors.values():
+            self.door_table.write(self.door_slots[door.serial], fleet_door_row(self.index, door, now))
+        self.worker_table.write(self.index, (os.getpid(), len(vehicles), len(doors), now, magic_garage.tesla_requests_made))
+
+    def stop(self):
+        if (not self.stopped.is_set()):
+            magic_garage.event_loop.remove_reader(self.conn.fileno())
+            self.stopped.set()
+
+    def close(self):
+        for table in [self.vehicle_table, self.door_table, self.worker_table]:
+            table.close()
+
+async def fleet_publisher(shard, worker):
+    while (True):
+        worker.beat(magic_garage.SUPERVISOR_WORK_TIMEOUT_SECS)
+        shard.publish()
+        await asyncio.sleep(FLEET_PUBLISH_SECS)
+
+async def fleet_worker_loop(index, config, conn):
+    magic_garage.event_loop = asyncio.get_running_loop()
+    magic_garage.profiler_install()
+    shard = FleetShard(index, config, conn)
+    workers = [Worker("door_poller", magic_garage.myq_door_poller), Worker("housekeeping", magic_garage.housekeeping_loop),
+        Worker("fleet_publisher", fleet_publisher, (shard,))]
+    supervisor_task = asyncio.ensure_future(magic_garage.supervisor(workers))
+    shard.start()
+    try:
+        await shard.stopped.wait()
+    finally:
+        supervisor_task.cancel()
+        for name in list(magic_garage.supervisor_workers):
+            magic_garage.supervisor_remove(name)
+        # Polls and door commands still running report back to the event loop, so it stays up until they finish
+        for executor in [magic_garage.tesla_poll_executor, magic_garage.myq_door_executor]:
+            await asyncio.to_thread(executor.shutdown)
+        shard.close()
+
+# Entry point of a worker process. The coordinator's settings are applied before anything reads them, and the worker
+# starts with no cars until the coordinator hands some over
+def fleet_worker_main(index, config, conn):
+    # Ctrl-C reaches the whole process group, and the coordinator stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for name, value in config["settings"].items():
+        setattr(magic_garage, name, value)
+    magic_garage.logging_init()
+    logging.info("Starting Magic Garage Fleet Worker " + str(index) + "...")
+    magic_garage.tesla_email, magic_garage.tesla_password, magic_garage.myq_email, magic_garage.myq_password = config["credentials"]
+    # Built again to take this worker's share of the request limits
+    magic_garage.tesla_client = magic_garage.TeslaClient()
+    magic_garage.myq_client = magic_garage.MyQClient()
+    magic_garage.tesla_client.base_url, magic_garage.myq_client.base_url = config["base_urls"]
+    magic_garage.tesla_client.tokens = FleetTokenManager("Tesla", conn)
+    magic_garage.myq_client.tokens = FleetTokenManager("MyQ", conn)
+    fleet_load_tokens(config["tokens"])
+    magic_garage.myq_account_id = config["account_id"]
+    for serial, name, state, state_changed_at in config["doors"]:
+        door = magic_garage.GarageDoor(serial, name)
+        door.state = state
+        door.state_changed_at = state_changed_at
+        magic_garage.myq_doors[serial] = door
+    magic_garage.history_init()
+    magic_garage.corridor_init()
+    try:
+        asyncio.run(fleet_worker_loop(index, config, conn))
+    finally:
+        if (magic_garage.history_store is not None):
+            magic_garage.history_store.close()
+        magic_garage.logging_shutdown()
+
+# Fleet Coordinator
+# The coordinator's handle on a worker process
+class FleetWorker:
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.ready = False
+        self.started_at = 0.0
+        self.restart_at = 0.0
+        self.failures = 0
+        self.restarts = 0
+        self.released = set()
+
+    def name(self):
+        return "worker-" + str(self.index)
+
+# Splits the cars across the worker processes by consistent hashing and moves them when a worker dies or is added.
+# A car is hashed by the door it opens, so every car of a door, and the door's polls, stay in one worker. Cars without
+# a door are hashed on their own
+class FleetCoordinator:
+    def __init__(self, worker_count, settings={}):
+        self.worker_count = worker_count
+        self.settings = settings
+        self.context = multiprocessing.get_context("spawn")
+        self.lock = threading.Lock()
+        vehicle_ids = sorted(magic_garage.tesla_vehicles)
+        self.vehicle_slots = {vehicle_id: slot for slot, vehicle_id in enumerate(vehicle_ids)}
+        self.door_slots = {serial: slot for slot, serial in enumerate(sorted(magic_garage.myq_doors))}
+        self.shard_keys = {}
+        for vehicle in magic_garage.tesla_vehicles.values():
+            self.shard_keys[vehicle.id] = ("door:" + str(vehicle.door.serial)) if (vehicle.door is not None) else ("vehicle:" + str(vehicle.id))
+        self.vehicle_table = SharedStateTable(FLEET_VEHICLE_ROW, len(vehicle_ids))
+        self.door_table = SharedStateTable(FLEET_DOOR_ROW, len(self.door_slots))
+        self.worker_table = SharedStateTable(FLEET_WORKER_ROW, FLEET_MAX_WORKERS)
+        self.ring = HashRing(FLEET_RING_REPLICAS)
+        self.ring_changed = False
+        self.workers = {}
+        self.owners = {vehicle_id: None for vehicle_id in vehicle_ids}
+        self.add_requests = 0
+        self.tokens_sent = None
+        self.rebalances = 0
+        self.vehicles_moved = 0
+
+    def start(self):
+        for i in range(self.worker_count):
+            self.add_worker()
+
+    # Starts a worker on the lowest free index. It gets cars once it reports ready
+    def add_worker(self):
+        index = next((i for i in range(FLEET_MAX_WORKERS) if (i not in self.workers)), None)
+        if (index is None):
+            logging.error("Fleet already has " + str(FLEET_MAX_WORKERS) + " workers")
+            return None
+        worker = FleetWorker(index)
+        self.workers[index] = worker
+        self.start_worker(worker)
+        return index
+
+    # Asks for a worker to be added on the next check. Safe to call from a signal handler
+    def request_worker(self):
+        self.add_requests += 1
+
+    def start_worker(self, worker):
+        parent_conn, child_conn = self.context.Pipe()
+        worker.process = self.context.Process(target=fleet_worker_main, args=(worker.index, self.worker_config(worker), child_conn),
+            name="magic_garage_" + worker.name(), daemon=True)
+        worker.process.start()
+        child_conn.close()
+        worker.conn = parent_conn
+        worker.ready = False
+        worker.released = set()
+        worker.started_at = time.time()
+        logging.info("Started Fleet Worker " + str(worker.index) + " (PID " + str(worker.process.pid) + ")")
+
+    # The Tesla and MyQ base URLs a worker sends its requests to
+    def worker_base_urls(self, worker):
+        return magic_garage.tesla_client.base_url, magic_garage.myq_client.base_url
+
+    # The app settings for a worker: the coordinator's overrides, its own log file, none of the files and endpoints only
+    # one process can own, and its share of the account's request limits
+    def worker_settings(self, worker):
+        settings = dict(self.settings)
+        log_root, log_extension = os.path.splitext(settings.get("LOG_FILE_NAME", magic_garage.LOG_FILE_NAME))
+        settings.update({"LOG_FILE_NAME": log_root + "-" + worker.name() + log_extension, "TELEMETRY_LOG_FILE": "", "METRICS_PORT": 0,
+            "STATUS_API_PORT": 0, "TOKEN_CACHE_FILE": "", "STATE_SNAPSHOT_FILE": "", "TRACE_RECORD_FILE": "",
+            "VEHICLE_DOOR_MAP": settings.get("VEHICLE_DOOR_MAP", magic_garage.VEHICLE_DOOR_MAP)})
+        # Shared by the configured pool size, so an added worker takes the fleet over the limits by one share
+        for name, minimum in FLEET_SHARED_LIMITS.items():
+            settings[name] = max(self.settings.get(name, getattr(magic_garage, name)) / self.worker_count, minimum)
+        return settings
+
+    def worker_config(self, worker):
+        vehicles = {}
+        for vehicle in magic_garage.tesla_vehicles.values():
+            vehicles[vehicle.id] = (self.vehicle_slots[vehicle.id], vehicle.name, vehicle.stream_id,
+                None if (vehicle.door is None) else vehicle.door.serial)
+        return {
+            "settings": self.worker_settings(worker),
+            "credentials": (magic_garage.tesla_email, magic_garage.tesla_password, magic_garage.myq_email, magic_garage.myq_password),
+            "base_urls": self.worker_base_urls(worker),
+            "tokens": self.tokens(),
+            "account_id": magic_garage.myq_account_id,
+            "doors": [(door.serial, door.name, door.state, door.state_changed_at) for door in magic_garage.myq_doors.values()],
+            "vehicles": vehicles,
+            "door_slots": self.door_slots,
+            "tables": {"vehicle": self.vehicle_table.name, "door": self.door_table.name, "worker": self.worker_table.name}
+        }
+
+    def tokens(self):
+        return {client.tokens.provider: client.tokens.to_cache() for client in [magic_garage.tesla_client, magic_garage.myq_client]}
+
+    def send(self, worker, command, args):
+        try:
+            worker.conn.send((command, args))
+        except (OSError, ValueError) as e:
+            logging.error("Failed to send " + command + " to Fleet Worker " + str(worker.index) + ": " + str(e))
+
+    # Handles the messages a worker sent
+    def receive(self, worker):
+        try:
+            while (worker.conn.poll()):
+                message, args = worker.conn.recv()
+                if (message == "ready"):
+                    worker.ready = True
+                    self.ring.add(worker.index)
+                    self.ring_changed = True
+                    self.send(worker, "tokens", self.tokens())
+                    logging.info("Fleet Worker " + str(worker.index) + " is ready")
+                elif (message == "released"):
+                    worker.released.update(args)
+                elif (message == "renew_tokens"):
+                    self.renew_tokens(worker, *args)
+        except (EOFError, OSError):
+            pass
+
+    # Renews a token a worker's provider rejected, unless that was already done, and sends the worker the current tokens
+    def renew_tokens(self, worker, provider, rejected_token):
+        for client in [magic_garage.tesla_client, magic_garage.myq_client]:
+            if (client.tokens.provider == provider):
+                try:
+                    client.tokens.reauthenticate(rejected_token)
+                except (magic_garage.AuthError, magic_garage.RequestThrottled, requests.RequestException, ValueError, KeyError) as e:
+                    logging.error("Failed to renew the " + provider + " Auth Token for Fleet Worker " + str(worker.index) + ": " + str(e))
+        self.send(worker, "tokens", self.tokens())
+
+    # Checks on the workers, restarting the ones that died or stalled, and moves cars to match the ring
+    def check(self):
+        with self.lock:
+            now = time.time()
+            for worker in list(self.workers.values()):
+                if (worker.process is None):
+                    if (now >= worker.restart_at):
+                        worker.restarts += 1
+                        self.start_worker(worker)
+                    continue
+                self.receive(worker)
+                heartbeat = self.worker_table.read(worker.index)
+                if (not worker.process.is_alive()):
+                    self.worker_failed(worker, "exited with code " + str(worker.process.exitcode))
+                elif ((not worker.ready) and ((now - worker.started_at) > FLEET_START_TIMEOUT_SECS)):
+                    self.worker_failed(worker, "did not start in time")
+                elif (worker.ready and ((heartbeat is None) or ((now - heartbeat[3]) > FLEET_WORKER_STALL_SECS))):
+                    self.worker_failed(worker, "stalled")
+            while (self.add_requests > 0):
+                self.add_requests -= 1
+                self.add_worker()
+            if (self.ring_changed):
+                self.rebalance()
+            tokens = self.tokens()
+            if (tokens != self.tokens_sent):
+                for worker in self.workers.values():
+                    if (worker.ready):
+                        self.send(worker, "tokens", tokens)
+                self.tokens_sent = tokens
+
+    # Kills a worker that died, stalled or would not hand over its cars. Its cars go to the other workers on the next
+    # rebalance without waiting for a handover, and it is restarted with the supervisor's backoff
+    def worker_failed(self, worker, reason):
+        if (worker.process.is_alive()):
+            worker.process.kill()
+        worker.process.join(FLEET_STOP_TIMEOUT_SECS)
+        worker.conn.close()
+        worker.process = None
+        if (worker.ready):
+            self.ring.remove(worker.index)
+            self.ring_changed = True
+        worker.ready = False
+        for vehicle_id, owner in self.owners.items():
+            if (owner == worker.index):
+                self.owners[vehicle_id] = None
+        now = time.time()
+        if ((now - worker.started_at) >= magic_garage.SUPERVISOR_HEALTHY_SECS):
+            worker.failures = 0
+        worker.failures += 1
+        backoff = min(magic_garage.SUPERVISOR_RESTART_BACKOFF_BASE_SECS * (2 ** (worker.failures - 1)),
+            magic_garage.SUPERVISOR_RESTART_BACKOFF_MAX_SECS)
+        worker.restart_at = now + backoff
+        logging.error("Fleet Worker " + str(worker.index) + " " + reason + ", restarting in " + str(backoff) + "s")
+
+    # Moves every car whose owner on the ring changed, in two phases. The old owners first hand their cars over and
+    # write out their last state, then the new owners take them, so two workers never poll or decide for the same car
+    def rebalance(self):
+        self.ring_changed = False
+        start = time.time()
+        moves = {}
+        for vehicle_id, key in self.shard_keys.items():
+            owner = self.ring.owner(key)
+            if (owner != self.owners[vehicle_id]):
+                moves[vehicle_id] = owner
+        if (len(moves) == 0):
+            return
+        releasing = {}
+        for vehicle_id in moves:
+            if (self.owners[vehicle_id] is not None):
+                releasing.setdefault(self.owners[vehicle_id], []).append(vehicle_id)
+        for index, vehicle_ids in releasing.items():
+            self.send(self.workers[index], "release", vehicle_ids)
+        deadline = time.time() + FLEET_HANDOFF_TIMEOUT_SECS
+        for index, vehicle_ids in releasing.items():
+            worker = self.workers[index]
+            if (not self.wait_for_release(worker, vehicle_ids, deadline)):
+                self.worker_failed(worker, "did not hand over its cars")
+        # A worker that failed to hand over changed the ring, so the cars are placed again on the next check
+        if (self.ring_changed):
+            return
+        acquiring = {}
+        for vehicle_id, owner in moves.items():
+            self.owners[vehicle_id] = owner
+            if (owner is not None):
+                acquiring.setdefault(owner, []).append(vehicle_id)
+        for index, vehicle_ids in acquiring.items():
+            self.send(self.workers[index], "acquire", vehicle_ids)
+        self.rebalances += 1
+        self.vehicles_moved += len(moves)
+        logging.info("Fleet Rebalanced: moved " + str(len(moves)) + " cars in " + str(round(1000 * (time.time() - start))) + "ms | "
+            + self.summary())
+
+    def wait_for_release(self, worker, vehicle_ids, deadline):
+        while (not worker.released.issuperset(vehicle_ids)):
+            remaining = deadline - time.time()
+            if ((remaining <= 0) or not worker.process.is_alive()):
+                return False
+            if (worker.conn.poll(min(remaining, FLEET_CHECK_SECS))):
+                self.receive(worker)
+        worker.released.difference_update(vehicle_ids)
+        return True
+
+    # Returns a one line summary of the workers and their cars
+    def summary(self):
+        counts = {}
+        for owner in self.owners.values():
+            counts[owner] = counts.get(owner, 0) + 1
+        return ("Workers: " + ", ".join(str(index) + (" (" + str(counts.get(index, 0)) + " cars)" if worker.ready else " (starting)")
+            for index, worker in sorted(self.workers.items())) + " | Unassigned cars: " + str(counts.get(None, 0)))
+
+    # Mirrors the workers' rows into the coordinator's registry and status API. Door changes go through
+    # myq_update_door_state, so a status API door command waiting on its door sees it move
+    def publish_status(self):
+        for vehicle_id, slot in self.vehicle_slots.items():
+            row = self.vehicle_table.read(slot)
+            vehicle = magic_garage.tesla_vehicles[vehicle_id]
+            if (row is None):
+                continue
+            owner, state, shift, awake, state_since, updated_at, distance_from_home, speed, polls = row
+            magic_garage.status_broadcaster.publish("vehicle", vehicle_id, {
+                "id": vehicle_id,
+                "name": vehicle.name,
+                "state": FLEET_VEHICLE_STATES[state],
+                "state_since": state_since,
+                "arriving": FLEET_VEHICLE_STATES[state] in (magic_garage.VEHICLE_STATE_APPROACHING, magic_garage.VEHICLE_STATE_ARRIVING),
+                "leaving": FLEET_VEHICLE_STATES[state] == magic_garage.VEHICLE_STATE_LEAVING,
+                "distance_ft": round(distance_from_home),
+                "shift_state": magic_garage.SHIFT_STATES[shift],
+                "awake": bool(awake),
+                "door": None if (vehicle.door is None) else vehicle.door.name,
+                "worker": None if (owner == FLEET_NO_OWNER) else owner
+            })
+        for serial, slot in self.door_slots.items():
+            row = self.door_table.read(slot)
+            if (row is not None):
+                magic_garage.myq_update_door_state(magic_garage.myq_doors[serial], magic_garage.TELEMETRY_HISTORY_DOOR_STATES[row[1]])
+
+    # Stops every worker, killing the ones that do not stop in time, and removes the shared tables
+    def stop(self):
+        with self.lock:
+            for worker in self.workers.values():
+                if (worker.process is not None):
+                    self.send(worker, "stop", None)
+            for worker in self.workers.values():
+                if (worker.process is not None):
+                    worker.process.join(FLEET_STOP_TIMEOUT_SECS)
+                    if (worker.process.is_alive()):
+                        worker.process.kill()
+                        worker.process.join()
+                    worker.conn.close()
+                    worker.process = None
+            for table in [self.vehicle_table, self.door_table, self.worker_table]:
+                table.close()
+
+async def fleet_monitor(coordinator, worker):
+    while (True):
+        worker.beat(magic_garage.SUPERVISOR_WORK_TIMEOUT_SECS)
+        await asyncio.to_thread(coordinator.check)
+        worker.beat(FLEET_CHECK_SECS + magic_garage.SUPERVISOR_HEARTBEAT_GRACE_SECS)
+        await asyncio.sleep(FLEET_CHECK_SECS)
+
+async def fleet_status_publisher(coordinator, worker):
+    while (True):
+        worker.beat(magic_garage.SUPERVISOR_WORK_TIMEOUT_SECS)
+        coordinator.publish_status()
+        await asyncio.sleep(FLEET_PUBLISH_SECS)
+
+async def fleet_main_loop(coordinator):
+    magic_garage.event_loop = asyncio.get_running_loop()
+    magic_garage.event_loop.add_signal_handler(signal.SIGUSR2, coordinator.request_worker)
+    magic_garage.profiler_install()
+    coordinator.start()
+    workers = [Worker("fleet_monitor", fleet_monitor, (coordinator,)), Worker("fleet_status", fleet_status_publisher, (coordinator,)),
+        Worker("token_refresher", magic_garage.token_refresher), Worker("state_snapshot_writer", magic_garage.state_snapshot_writer)]
+    if (magic_garage.METRICS_PORT > 0):
+        workers.append(Worker("metrics_server", magic_garage.metrics_server, heartbeats=False))
+    if (magic_garage.STATUS_API_PORT > 0):
+        workers.append(Worker("status_api", magic_garage.status_api_server, heartbeats=False))
+    await magic_garage.supervisor(workers)
+
+# The coordinator logs in, lists the cars and discovers the doors once, then hands the cars out to the workers
+def main():
+    magic_garage.logging_init()
+    logging.info("Starting Magic Garage Fleet...")
+    magic_garage.parse_input_parameters()
+    worker_count = FLEET_WORKERS
+    if (len(sys.argv) > 5):
+        if ((not sys.argv[5].isdigit()) or not (1 <= int(sys.argv[5]) <= FLEET_MAX_WORKERS)):
+            magic_garage.print_error_and_exit("The worker count must be between 1 and " + str(FLEET_MAX_WORKERS))
+        worker_count = int(sys.argv[5])
+    magic_garage.token_cache_load()
+    magic_garage.state_snapshot_load()
+    magic_garage.tesla_init()
+    magic_garage.myq_init()
+    if (len(magic_garage.myq_doors) == 0):
+        magic_garage.myq_get_door_state()
+    coordinator = FleetCoordinator(worker_count)
+    logging.info("Fleet: " + str(len(magic_garage.tesla_vehicles)) + " cars and " + str(len(magic_garage.myq_doors)) + " doors across "
+        + str(worker_count) + " workers")
+    try:
+        asyncio.run(fleet_main_loop(coordinator))
+    finally:
+        coordinator.stop()
+        magic_garage.logging_shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,101 @@
 #!/home/patrick/src/Magic-Garage/.env/bin/python3
 import json
 import sys
+import gzip
 import configparser
 import requests
 import time
 import pytz
 import os
 import threading
+import asyncio
+import signal
 import logging
-from os.path import getsize
+import queue
+import math
+import random
+import email.utils
+import base64
+import hashlib
+import hmac
+import bisect
+import zlib
+import struct
+import urllib.parse
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from http import HTTPStatus
 from datetime import datetime
 from geopy import distance, location
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import websockets
+except ImportError:
+    websockets = None
 
 # Home location GPS Coordinates
 HOME_LOCATION = location.Point(33.812671, -117.920392)
+# Per-door home locations as (latitude, longitude) keyed by door name, for doors that are not at HOME_LOCATION
+DOOR_HOME_LOCATIONS = {}
 # App Constants
+# Log records are written by a background thread. The debug log rolls over to debug.log.1 .. debug.log.N at this size
 LOG_FILE_NAME = "debug.log"
 DEBUG_LOG_MAX_SIZE_BYTES = 5000000
-TESLA_TOKEN_EXPIRE_CHECK_SECS = 24 * 60 * 60
+DEBUG_LOG_BACKUP_COUNT = 5
+# Set TELEMETRY_LOG_FILE for a compact JSON lines stream of vehicle samples, state changes and door events, kept apart
+# from the debug log
+TELEMETRY_LOG_FILE = ""
+TELEMETRY_LOG_MAX_SIZE_BYTES = 20000000
+TELEMETRY_LOG_BACKUP_COUNT = 5
+TELEMETRY_LOGGER_NAME = "magic_garage.telemetry"
 TESLA_LOCATION_DELAY_SECS = 2
+# Bounds of the adaptive vehicle data poll interval
 TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_FAST = 1
 TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_SLOW = 10 * 60
+# Cars away from home are polled again after this fraction of the shortest time they could take to reach the arriving
+# geofence, assuming at least the idle speed since a parked car can drive off
+TESLA_POLL_BOUNDARY_FRACTION = 0.5
+TESLA_POLL_IDLE_SPEED_MPH = 15
+# Vehicle data requests per minute allowed across the whole fleet. Intervals are stretched in steps of
+# TESLA_POLL_BUDGET_STRETCH_STEP, so the small changes each decision makes to the fleet's total leave the other cars alone
+TESLA_POLL_BUDGET_PER_MINUTE = 120
+TESLA_POLL_BUDGET_STRETCH_STEP = 1.1
+# Cars the vehicle listing reports asleep or offline are not sent data requests, which would only come back 408 and could
+# keep them awake. Their polls check the listing instead, which one request answers for every car
+TESLA_ASLEEP_POLL_INTERVAL_SECS = 20
+TESLA_ONLINE_STATE_MAX_AGE_SECS = 10
+# The vehicle listing at startup is tried this many times, backing off between tries, before the app gives up
+TESLA_GET_VEHICLES_ATTEMPTS = 5
 TESLA_STALE_DATA_THRESHOLD_SECS = 2 * TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_SLOW
 TESLA_PULL_OUT_GARAGE_DELAY_SECS = 3
+# How long a car can stay LEAVING, APPROACHING or ARRIVING before falling back to AWAY, as long as the old monitor loops ran
+TESLA_MONITOR_TIMEOUT_SECS = 20 * TESLA_LOCATION_DELAY_SECS
+# Leaving from the west can give the impression the car is arriving due to the roads, so arrivals also need a slow car
+TESLA_ARRIVING_MAX_SPEED_MPH = 25
+# Motion estimator tuning. The GPS location can vary by up to 15 feet
+TESLA_SAMPLE_HISTORY_SIZE = 64
+TESLA_GPS_NOISE_FT = 15
+TESLA_RADIAL_SPEED_NOISE_FPS = 4
+TESLA_MOTION_ACCEL_NOISE_FPS2 = 6
+TESLA_MOTION_INITIAL_RATE_NOISE_FPS = 30
+TESLA_MOTION_RESET_SECS = 30
+TESLA_MIN_RANGE_RATE_FPS = 2
+FEET_PER_SECOND_PER_MPH = 5280 / 3600
+SHIFT_STATES = ["PARKED", "DRIVE", "REVERSE", "NEUTRAL"]
 HOME_GEO_FENCE_FT = 30
 AWAY_GEO_FENCE_FT = 2000
 FAR_AWAY_GEO_FENCE_FT = 26400
@@ -30,12 +103,54 @@ ARRIVING_GEO_FENCE_FT = 1500
 OPEN_DOOR_GEO_FENCE_FT = 400
 MYQ_DOOR_STATE_POLL_INTERVAL_SECS = 2
 MYQ_DOOR_CLOSE_RETRY_SECS = 60
+# Door commands wait up to this long for the door to finish opening or closing
 MYQ_DOOR_STATE_POLL_TIMEOUT_SECS = 30
 MYQ_DOOR_STATE_CHECK_SECS = 60
 MYQ_LOGIN_TIMEOUT_SECS = 60 * 60
-WATCHDOG_TIMEOUT_SECS = 5 * 60
-WATCHDOG_RESET_SECS = 60
-watch_dog_last_update = time.time()
+# Auth tokens are renewed in the background this long before they expire. MyQ has no refresh API or expiry, so its
+# token is treated as lasting MYQ_LOGIN_TIMEOUT_SECS and renewed with a new login
+TOKEN_EXPIRE_CHECK_SECS = 60
+TESLA_TOKEN_REFRESH_AHEAD_SECS = 24 * 60 * 60
+MYQ_TOKEN_REFRESH_AHEAD_SECS = 5 * 60
+# Tokens are cached here encrypted with a key derived from the account passwords, so a restart can skip the logins.
+# Caching needs the cryptography package, without it tokens are only kept in memory. An empty name disables the cache
+TOKEN_CACHE_FILE = "token_cache.json"
+TOKEN_CACHE_KDF_ITERATIONS = 200000
+# Warm start snapshot of the vehicles, doors, account and recent trajectories, so a restarted app skips the startup
+# requests and decides from where it left off. Tokens stay in the encrypted token cache. An empty name disables it
+STATE_SNAPSHOT_FILE = "state_snapshot.json"
+STATE_SNAPSHOT_INTERVAL_SECS = 10
+# Trajectories and vehicle states older than this are dropped on load, the vehicle and door lists are kept for longer
+STATE_SNAPSHOT_MAX_AGE_SECS = 5 * 60
+STATE_SNAPSHOT_IDENTITY_MAX_AGE_SECS = 24 * 60 * 60
+# Predictive opening times the open command so the door is fully open when the car is predicted to reach home,
+# instead of opening it at OPEN_DOOR_GEO_FENCE_FT. Door timings start from these defaults until they are measured
+MYQ_PREDICTIVE_OPEN = True
+MYQ_PREDICTIVE_OPEN_MARGIN_SECS = 1
+MYQ_PREDICTIVE_FALLBACK_FT = 100
+MYQ_DEFAULT_DOOR_TRAVEL_SECS = 12
+MYQ_DEFAULT_COMMAND_LATENCY_SECS = 1.5
+MYQ_TIMING_SMOOTHING = 0.3
+# Supervisor. Each worker loop reports a heartbeat along with when its next one is due. A worker that crashes, or misses
+# a heartbeat that follows a sleep by SUPERVISOR_HEARTBEAT_GRACE_SECS or one that follows work by SUPERVISOR_WORK_TIMEOUT_SECS,
+# is restarted on its own, backing off exponentially if it keeps failing
+SUPERVISOR_CHECK_SECS = 5
+SUPERVISOR_HEARTBEAT_GRACE_SECS = 60
+SUPERVISOR_WORK_TIMEOUT_SECS = 2 * 60
+SUPERVISOR_RESTART_BACKOFF_BASE_SECS = 1
+SUPERVISOR_RESTART_BACKOFF_MAX_SECS = 5 * 60
+# A worker that ran this long before failing starts its backoff over
+SUPERVISOR_HEALTHY_SECS = 10 * 60
+# Restarting workers can't help an event loop that stopped running, so the app exits if it stalls this long
+SUPERVISOR_LOOP_STALL_SECS = 5 * 60
+# Housekeeping (stale data and log checks) still runs this often when no new data arrives
+DECISION_IDLE_CHECK_SECS = 60
+# Distances up to this far from home use the local planar projection, beyond it the full geodesic is used
+GEO_PLANAR_MAX_FT = FAR_AWAY_GEO_FENCE_FT
+# WGS84 ellipsoid
+WGS84_A_METERS = 6378137.0
+WGS84_E2 = (1 / 298.257223563) * (2 - (1 / 298.257223563))
+FEET_PER_METER = 1 / 0.3048
 
 # Tesla Configs (Original API Reference from Tim Dorr: https://tesla-api.timdorr.com/)
 TESLA_CLIENT_ID = "81527cff06843c8634fdc09e8ac0abefb46ac849f38fe1e431c2ef2106796384"
@@ -47,6 +162,20 @@ TESLA_VEHICLES = "/api/1/vehicles"
 TESLA_VEHICLE_DATA = "/api/1/vehicles/{id}/vehicle_data"
 TESLA_VEHICLE_STATE = "/api/1/vehicles/{id}/data_request/vehicle_state"
 TESLA_DRIVE_STATE = "/api/1/vehicles/{id}/data_request/drive_state"
+# Sections of vehicle_data fetched in the single request made each tick. An empty list fetches the full payload
+TESLA_VEHICLE_DATA_ENDPOINTS = ["drive_state", "vehicle_state", "charge_state"]
+# Number of requests per tick the consolidated fetch replaces (vehicle_state, vehicle_data and drive_state)
+TESLA_LEGACY_REQUESTS_PER_TICK = 3
+# Set TESLA_STREAMING to have awake cars push their drive data over the streaming websocket, which needs the websockets
+# package. Polls are skipped while a car's stream is live and take over again once it has been quiet for QUIET_SECS
+TESLA_STREAMING = False
+TESLA_STREAMING_URL = "wss://streaming.vn.teslamotors.com/streaming/"
+TESLA_STREAMING_COLUMNS = ["speed", "est_lat", "est_lng", "heading", "power", "shift_state"]
+TESLA_STREAMING_QUIET_SECS = 10
+TESLA_STREAMING_CONNECT_TIMEOUT_SECS = 10
+TESLA_STREAMING_RECONNECT_BASE_SECS = 1
+TESLA_STREAMING_RECONNECT_MAX_SECS = 60
+TESLA_STREAMING_IDLE_CHECK_SECS = 30
 
 # MyQ Configs (Original Reference from Jordan Chanomie: https://github.com/chanomie/homebridge-myq/blob/025b7a1cb4a6cf0cc0a37506b1f87ecae7c71996/README.md)
 MYQ_BASE_API_URL = "https://api.myqdevice.com"
@@ -54,68 +183,1286 @@ MYQ_LOCALE = "en"
 MYQ_LOGIN = "/api/v5/Login"
 MYQ_ACCOUNT_ID = "/api/v5/My?expand=account"
 MYQ_DEVICE_LIST = "/api/v5.1/Accounts/{account_id}/Devices"
+MYQ_DEVICE = "/api/v5.1/Accounts/{account_id}/Devices/{device_id}"
 MYQ_DEVICE_SET = "/api/v5.1/Accounts/{account_id}/Devices/{device_id}/actions"
 MYQ_APP_ID = "Vj8pQggXLhLy0WHahglCD4N1nAkkXQtGYpq2HrHD7H1nvmbT55KqtN6RSF4ILB/i"
 
+# HTTP Client Configs, timeouts are (connect, read) in seconds
+HTTP_POOL_CONNECTIONS = 2
+HTTP_POOL_MAXSIZE = 8
+HTTP_RETRY_TOTAL = 2
+HTTP_RETRY_BACKOFF_FACTOR = 0.3
+HTTP_RETRY_STATUS_CODES = [500, 502, 503, 504]
+HTTP_DEFAULT_TIMEOUT_SECS = (3.05, 10)
+HTTP_STATS_LOG_INTERVAL_SECS = 60 * 60
+# Outbound request scheduler. Each provider's requests share a token bucket, with a reserve only door commands and logins
+# can use. Failing endpoints back off exponentially with jitter, and repeated failures open the provider's circuit breaker
+TESLA_REQUESTS_PER_SEC = 3
+TESLA_REQUEST_BURST = 10
+MYQ_REQUESTS_PER_SEC = 2
+MYQ_REQUEST_BURST = 5
+HTTP_PRIORITY_RESERVE = 1
+HTTP_PRIORITY_MAX_WAIT_SECS = 5
+HTTP_BACKOFF_BASE_SECS = 1
+HTTP_BACKOFF_MAX_SECS = 5 * 60
+HTTP_CIRCUIT_FAILURE_THRESHOLD = 5
+HTTP_CIRCUIT_OPEN_SECS = 30
+TESLA_ENDPOINT_TIMEOUTS = {
+    TESLA_AQUIRE_TOKEN: (3.05, 10),
+    TESLA_REFRESH_TOKEN: (3.05, 10),
+    TESLA_VEHICLES: (3.05, 10),
+    TESLA_VEHICLE_DATA: (3.05, 5)
+}
+MYQ_ENDPOINT_TIMEOUTS = {
+    MYQ_LOGIN: (3.05, 10),
+    MYQ_ACCOUNT_ID: (3.05, 10),
+    MYQ_DEVICE_LIST: (3.05, 5),
+    MYQ_DEVICE: (3.05, 5),
+    MYQ_DEVICE_SET: (3.05, 5)
+}
+
+# Fleet Configs
+# Maps a vehicle (display name or ID) to the name of the garage door it opens. Vehicles that are not listed use the
+# first garage door found on the MyQ account
+VEHICLE_DOOR_MAP = {}
+# Upper bound on the number of vehicle data requests in flight at once
+TESLA_MAX_CONCURRENT_POLLS = 8
+MYQ_MAX_CONCURRENT_DOOR_COMMANDS = 4
+
+# Trace Recording Configs. Set TRACE_RECORD_FILE to record every Tesla and MyQ response the app sees to a gzipped
+# JSON lines trace that replay.py can serve back. Token responses are never recorded
+TRACE_RECORD_FILE = ""
+TRACE_FLUSH_SECS = 10
+TRACE_REDACTED_ENDPOINTS = [TESLA_AQUIRE_TOKEN, TESLA_REFRESH_TOKEN, MYQ_LOGIN]
+
+# Metrics Configs. Prometheus text format metrics are served at http://METRICS_HOST:METRICS_PORT/metrics, set
+# METRICS_PORT to 0 to turn the endpoint off
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+METRICS_HTTP_BUCKETS_SECS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+METRICS_LOOP_BUCKETS_SECS = [0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+METRICS_DECISION_BUCKETS_SECS = [0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005]
+METRICS_DOOR_BUCKETS_SECS = [0.5, 1, 2, 3, 5, 7.5, 10, 15, 30]
+METRICS_RECOVERY_BUCKETS_SECS = [1, 5, 10, 30, 60, 120, 300, 600]
+# Profiler Configs. Sending the app PROFILE_SIGNAL starts a sampling profiler without a restart, and sending it again
+# stops it and writes the profile to PROFILE_DIR in the collapsed stack format flame graph tools read. A profile nobody
+# stops ends on its own after PROFILE_MAX_SECS
+PROFILE_SIGNAL = signal.SIGUSR1
+PROFILE_DIR = "profiles"
+PROFILE_INTERVAL_SECS = 0.01
+PROFILE_MAX_SECS = 10 * 60
+# Door states that show a door has started moving after an open or close command
+MYQ_DOOR_MOVING_STATES = {"open": ("opening", "open"), "close": ("closing", "closed")}
+
+# Local HTTP Server Configs, shared by the local endpoints
+LOCAL_HTTP_READ_TIMEOUT_SECS = 10
+LOCAL_HTTP_MAX_HEADERS = 100
+LOCAL_HTTP_MAX_BODY_BYTES = 64 * 1024
+
+# Status API Configs. The vehicle and door state the app already keeps is served at http://STATUS_API_HOST:STATUS_API_PORT
+# without any requests to Tesla or MyQ: GET /status for the current state and GET /events for a server-sent event stream
+# of changes. POST /doors/command opens or closes a door and needs STATUS_API_TOKEN as a bearer token, an empty token
+# turns door commands off. Set STATUS_API_PORT to 0 to turn the API off
+STATUS_API_HOST = "127.0.0.1"
+STATUS_API_PORT = 9465
+STATUS_API_TOKEN = ""
+STATUS_API_MAX_SUBSCRIBERS = 1000
+# Event subscribers that fall this many events behind are disconnected, they get the current state again on reconnect
+STATUS_API_SUBSCRIBER_QUEUE_SIZE = 64
+STATUS_API_KEEPALIVE_SECS = 15
+STATUS_API_RETRY_MILLIS = 5000
+
+# Telemetry History Configs. Vehicle samples and door events are appended as fixed width binary records to one file per
+# vehicle or door per UTC day in TELEMETRY_HISTORY_DIR, and read back memory mapped. Set it to "" to turn the history off
+TELEMETRY_HISTORY_DIR = "history"
+TELEMETRY_HISTORY_FLUSH_SECS = 10
+TELEMETRY_HISTORY_RETENTION_DAYS = 90
+# Record fields as (name, NumPy type). Positions are stored in 1e-7 degrees and speeds in 0.1 MPH. A vehicle sample is
+# 26 bytes, so a car sampled every second fills 2.2MB a day
+TELEMETRY_HISTORY_FIELDS = {
+    "vehicle": [("t", "<f8"), ("lat", "<i4"), ("lon", "<i4"), ("distance_ft", "<f4"), ("speed", "<u2"), ("heading", "<u2"),
+        ("shift", "u1"), ("door", "u1")],
+    "door": [("t", "<f8"), ("state", "u1"), ("action", "u1")]
+}
+TELEMETRY_HISTORY_DOOR_STATES = ["", "open", "closed", "opening", "closing", "stopped", "transition", "autoreverse", "unknown"]
+TELEMETRY_HISTORY_DOOR_ACTIONS = ["", "open", "close"]
+
+# Approach Corridor Model Configs. corridor.py trains a grid of cells and heading bins around each home from the telemetry
+# history, giving the chance a car in a cell heading that way ends its trip at home. With a model, a car closing in on
+# home is only approaching if its cell and heading reach CORRIDOR_ARRIVAL_PROBABILITY. Cells and headings too few trips
+# covered fall back to the TESLA_ARRIVING_MAX_SPEED_MPH check. An empty name or a missing file turns the model off
+CORRIDOR_MODEL_FILE = "corridor_model.json"
+CORRIDOR_ARRIVAL_PROBABILITY = 0.5
+# Probabilities are stored as bytes from 0 to CORRIDOR_PROBABILITY_SCALE, with CORRIDOR_UNKNOWN for uncovered cells
+CORRIDOR_PROBABILITY_SCALE = 254
+CORRIDOR_UNKNOWN = 255
+
+# Vehicle arrival/departure states
+VEHICLE_STATE_PARKED_HOME = "PARKED_HOME"
+VEHICLE_STATE_LEAVING = "LEAVING"
+VEHICLE_STATE_AWAY = "AWAY"
+VEHICLE_STATE_APPROACHING = "APPROACHING"
+VEHICLE_STATE_ARRIVING = "ARRIVING"
+
 # Tesla Global Variables
 tesla_email = ""
 tesla_password = ""
-tesla_auth_token = ""
-tesla_refresh_token = ""
-tesla_token_timeout = ""
-tesla_token_start_time = time.time()
-tesla_last_data_update = time.time()
-tesla_auth_header = {}
-tesla_vehicle_ids = []
-distance_from_home = 0.0
-tesla_shift_state = "PARKED"
-tesla_last_set_interval = 0
-tesla_charger_connected = False
-tesla_driver_present = False
-tesla_awake = True
-tests_speed = 0
-tesla_vehicle_thread_sleep = TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_FAST
-vehicle_thread_interval_changed = False
+tesla_vehicles = {}
+tesla_requests_made = 0
+tesla_requests_saved = 0
+tesla_requests_avoided = 0
+tesla_408s_eliminated = 0
+tesla_408s_received = 0
+tesla_online_checks = 0
+tesla_online_checked_at = 0.0
+tesla_online_state_lock = threading.Lock()
+# Polls per minute the cars' desired intervals add up to, kept up to date as each car's changes. They are counted again
+# from scratch whenever the cars in tesla_vehicles change
+tesla_poll_budget_lock = threading.RLock()
+tesla_poll_budget_fleet = None
+tesla_poll_budget_count = 0
+tesla_urgent_polls_per_minute = 0.0
+tesla_relaxed_polls_per_minute = 0.0
+tesla_poll_budget_stretch = 1.0
 
 # MyQ Variables
 myq_email = ""
 myq_password = ""
-myq_auth_token = ""
-myq_auth_header = {}
 myq_account_id = ""
-myq_device_id = ""
-myq_door_state = ""
-myq_last_set_interval  = 0
+# Device registry of garage doors by serial number, discovered once from the account's device list
+myq_doors = {}
+myq_doors_stale = False
 myq_door_thread_sleep = MYQ_DOOR_STATE_CHECK_SECS
-myq_door_thread_interval_changed = False
-myq_last_login = 0
+
+# Logging Variables
+log_listener = None
+telemetry_logger = None
+
+# HTTP Client Variables
+http_stats_last_log = time.time()
+trace_recorder = None
+history_store = None
+# Corridor grids by home (latitude, longitude) rounded to CORRIDOR_HOME_DIGITS
+corridor_grids = {}
+CORRIDOR_HOME_DIGITS = 6
+
+# Token Cache Variables
+token_cache_lock = threading.Lock()
+token_cache_salt = None
+token_cache_fernet = None
+
+# Supervisor Variables
+supervisor_workers = {}
+supervisor_checked_at = 0.0
+
+# Asyncio Engine Variables
+event_loop = None
+tesla_poll_executor = ThreadPoolExecutor(max_workers=TESLA_MAX_CONCURRENT_POLLS, thread_name_prefix="tesla_poll")
+myq_door_executor = ThreadPoolExecutor(max_workers=MYQ_MAX_CONCURRENT_DOOR_COMMANDS, thread_name_prefix="myq_door")
+myq_door_interval_changed_event = asyncio.Event()
+
+# Fleet Model
+# State of a single Tesla, filled in by its poller and read by its decision loop
+class Vehicle:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self.door = None
+        self.sample = None
+        self.has_data = False
+        self.distance_from_home = 0.0
+        self.shift_state = "PARKED"
+        self.speed = 0
+        self.charger_connected = False
+        self.driver_present = False
+        self.awake = True
+        self.online_state = None
+        self.stream_id = None
+        self.streamed_at = 0.0
+        self.last_data_update = time.time()
+        self.poll_interval = TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_FAST
+        self.desired_poll_interval = TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_FAST
+        self.last_poll = 0.0
+        self.first_poll_at = 0.0
+        self.poll_count = 0
+        self.door_poll_interval = MYQ_DOOR_STATE_CHECK_SECS
+        self.state = None
+        self.state_since = time.time()
+        self.history = SampleRing(TESLA_SAMPLE_HISTORY_SIZE)
+        self.motion = RangeFilter()
+        self.open_door_timer = None
+        self.interval_changed_event = asyncio.Event()
+        self.new_data_event = asyncio.Event()
+
+# The fields of one vehicle_data response the decision logic uses
+class VehicleSample:
+    __slots__ = ("driver_present", "charger_connected", "shift_state", "speed", "heading", "latitude", "longitude", "timestamp")
+
+    def __init__(self, driver_present, charger_connected, shift_state, speed, heading, latitude, longitude, timestamp):
+        self.driver_present = driver_present
+        self.charger_connected = charger_connected
+        self.shift_state = shift_state
+        self.speed = speed
+        self.heading = heading
+        self.latitude = latitude
+        self.longitude = longitude
+        self.timestamp = timestamp
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, fields):
+        return cls(*[fields[field] for field in cls.__slots__])
+
+# The fields of one garage door in a MyQ device list response
+class DoorSample:
+    __slots__ = ("serial", "name", "door_state")
+
+    def __init__(self, serial, name, door_state):
+        self.serial = serial
+        self.name = name
+        self.door_state = door_state
+
+# State of a single MyQ garage door. The command lock keeps two vehicles from commanding the same door at once
+class GarageDoor:
+    def __init__(self, serial, name):
+        self.serial = serial
+        self.name = name
+        self.state = ""
+        self.state_changed_at = time.time()
+        self.command_lock = threading.Lock()
+        # Notified on every state change, for door commands waiting on the door to finish moving
+        self.state_changed = threading.Condition()
+        self.state_waiters = 0
+        self.home = home_geofence
+        # Measured timings, smoothed over past commands and opening -> open transitions
+        self.travel_secs = MYQ_DEFAULT_DOOR_TRAVEL_SECS
+        self.command_latency_secs = MYQ_DEFAULT_COMMAND_LATENCY_SECS
+        self.opened_at = 0.0
+        self.open_command_at = 0.0
+        self.vehicle_arrived_at = 0.0
+        self.arrivals = 0
+        self.car_waited_secs = 0.0
+        self.open_early_secs = 0.0
+        # Decision time and action of the last command, until the door is seen moving
+        self.command_decided_at = 0.0
+        self.pending_action = ""
+        if (name in DOOR_HOME_LOCATIONS):
+            self.home = GeoFence(*DOOR_HOME_LOCATIONS[name])
+
+# Geofence Distance Engine
+# Home location with a precomputed local east/north (ENU) projection. Within a few miles of home the planar distance
+# is within a fraction of a foot of the ellipsoidal one at a fraction of the cost
+class GeoFence:
+    def __init__(self, latitude, longitude):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.point = location.Point(latitude, longitude)
+        latitude_rad = math.radians(latitude)
+        w = math.sqrt(1 - WGS84_E2 * math.sin(latitude_rad) ** 2)
+        meridian_radius = WGS84_A_METERS * (1 - WGS84_E2) / (w ** 3)
+        prime_vertical_radius = WGS84_A_METERS / w
+        self.feet_per_degree_north = math.radians(meridian_radius) * FEET_PER_METER
+        self.feet_per_degree_east = math.radians(prime_vertical_radius * math.cos(latitude_rad)) * FEET_PER_METER
+        # The east scale shrinks with latitude, so scale it to the midpoint latitude between home and the sample
+        self.east_scale_per_degree_north = -math.tan(latitude_rad) * math.radians(1) / 2
+
+    # Returns the (east, north) offset in feet of a position from home
+    def local_feet(self, latitude, longitude):
+        delta_latitude = latitude - self.latitude
+        north = delta_latitude * self.feet_per_degree_north
+        east = (longitude - self.longitude) * self.feet_per_degree_east * (1 + self.east_scale_per_degree_north * delta_latitude)
+        return (east, north)
+
+    # Returns the distance in feet of a position from home
+    def distance_feet(self, latitude, longitude):
+        east, north = self.local_feet(latitude, longitude)
+        planar = math.hypot(east, north)
+        if (planar <= GEO_PLANAR_MAX_FT):
+            return planar
+        return distance.distance(self.point, (latitude, longitude)).feet
+
+# Returns an (N positions x M homes) NumPy array of distances in feet, for fleet ticks and trace replay
+def geofence_distances_feet(latitudes, longitudes, geofences):
+    if (np is None):
+        raise ImportError("NumPy is required for batch geofence distances")
+    latitudes = np.asarray(latitudes, dtype=np.float64)[:, np.newaxis]
+    longitudes = np.asarray(longitudes, dtype=np.float64)[:, np.newaxis]
+    home_latitudes = np.array([geofence.latitude for geofence in geofences])[np.newaxis, :]
+    home_longitudes = np.array([geofence.longitude for geofence in geofences])[np.newaxis, :]
+    feet_per_degree_north = np.array([geofence.feet_per_degree_north for geofence in geofences])[np.newaxis, :]
+    feet_per_degree_east = np.array([geofence.feet_per_degree_east for geofence in geofences])[np.newaxis, :]
+    east_scale = np.array([geofence.east_scale_per_degree_north for geofence in geofences])[np.newaxis, :]
+    delta_latitudes = latitudes - home_latitudes
+    north = delta_latitudes * feet_per_degree_north
+    east = (longitudes - home_longitudes) * feet_per_degree_east * (1 + east_scale * delta_latitudes)
+    distances = np.hypot(east, north)
+    for i, j in zip(*np.nonzero(distances > GEO_PLANAR_MAX_FT)):
+        distances[i, j] = distance.distance(geofences[j].point, (latitudes[i, 0], longitudes[i, 0])).feet
+    return distances
+
+home_geofence = GeoFence(HOME_LOCATION.latitude, HOME_LOCATION.longitude)
+
+# Approach Corridor Model
+# A square grid of cell_ft cells centered on home, each split into heading_bins headings, holding the chance a car there
+# ends its trip at home. Looking up a position is a planar offset and an index into the flat byte array
+class CorridorGrid:
+    def __init__(self, latitude, longitude, cell_ft, heading_bins, radius_ft, probabilities):
+        self.home = GeoFence(latitude, longitude)
+        self.cell_ft = cell_ft
+        self.heading_bins = heading_bins
+        self.radius_ft = radius_ft
+        self.cells_per_side = math.ceil(2 * radius_ft / cell_ft)
+        self.probabilities = probabilities
+        if (len(probabilities) != (self.cells_per_side ** 2) * heading_bins):
+            raise ValueError("Corridor grid has " + str(len(probabilities)) + " entries, expected "
+                + str((self.cells_per_side ** 2) * heading_bins))
+
+    # Returns the index of a position and heading in the flat array, or -1 outside the grid
+    def index(self, latitude, longitude, heading):
+        east, north = self.home.local_feet(latitude, longitude)
+        column = math.floor((east + self.radius_ft) / self.cell_ft)
+        row = math.floor((north + self.radius_ft) / self.cell_ft)
+        if ((column < 0) or (row < 0) or (column >= self.cells_per_side) or (row >= self.cells_per_side)):
+            return -1
+        heading_bin = math.floor((heading % 360) * self.heading_bins / 360) % self.heading_bins
+        return (row * self.cells_per_side + column) * self.heading_bins + heading_bin
+
+    # Returns the chance a car at the position and heading ends its trip at home, or None if no model covers it
+    def probability(self, latitude, longitude, heading):
+        index = self.index(latitude, longitude, heading)
+        if ((index < 0) or (self.probabilities[index] == CORRIDOR_UNKNOWN)):
+            return None
+        return self.probabilities[index] / CORRIDOR_PROBABILITY_SCALE
+
+    def to_dict(self):
+        return {"latitude": self.home.latitude, "longitude": self.home.longitude, "cell_ft": self.cell_ft,
+            "heading_bins": self.heading_bins, "radius_ft": self.radius_ft,
+            "probabilities": base64.b64encode(zlib.compress(bytes(self.probabilities), 9)).decode("ascii")}
+
+    @classmethod
+    def from_dict(cls, fields):
+        return cls(fields["latitude"], fields["longitude"], fields["cell_ft"], fields["heading_bins"], fields["radius_ft"],
+            zlib.decompress(base64.b64decode(fields["probabilities"])))
+
+def corridor_home_key(latitude, longitude):
+    return (round(latitude, CORRIDOR_HOME_DIGITS), round(longitude, CORRIDOR_HOME_DIGITS))
+
+# Loads the corridor grids trained by corridor.py, if there are any
+def corridor_init():
+    if ((len(CORRIDOR_MODEL_FILE) == 0) or not os.path.exists(CORRIDOR_MODEL_FILE)):
+        return
+    try:
+        with open(CORRIDOR_MODEL_FILE) as model_file:
+            model = json.load(model_file)
+        for fields in model["grids"]:
+            grid = CorridorGrid.from_dict(fields)
+            corridor_grids[corridor_home_key(grid.home.latitude, grid.home.longitude)] = grid
+    except (OSError, ValueError, KeyError, zlib.error) as e:
+        logging.error("Unable to load the corridor model: " + str(e))
+        corridor_grids.clear()
+        return
+    logging.info("Loaded Corridor Model: " + str(len(corridor_grids)) + " homes from " + CORRIDOR_MODEL_FILE)
+
+# Returns the chance a car's last sample ends its trip at its home, or None if no model covers it
+def corridor_arrival_probability(vehicle):
+    home = tesla_vehicle_home(vehicle)
+    grid = corridor_grids.get(corridor_home_key(home.latitude, home.longitude))
+    if ((grid is None) or (vehicle.sample is None)):
+        return None
+    return grid.probability(vehicle.sample.latitude, vehicle.sample.longitude, vehicle.sample.heading)
+
+# Motion Estimator
+# Fixed-size array-backed ring buffer of a car's most recent samples
+class SampleRing:
+    def __init__(self, size):
+        self.size = size
+        self.count = 0
+        self.next = 0
+        self.timestamps = array('d', bytes(8 * size))
+        self.latitudes = array('d', bytes(8 * size))
+        self.longitudes = array('d', bytes(8 * size))
+        self.speeds = array('f', bytes(4 * size))
+        self.headings = array('f', bytes(4 * size))
+        self.shift_states = array('b', bytes(size))
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, latitude, longitude, speed, heading, shift_state):
+        i = self.next
+        self.timestamps[i] = timestamp
+        self.latitudes[i] = latitude
+        self.longitudes[i] = longitude
+        self.speeds[i] = speed
+        self.headings[i] = heading
+        self.shift_states[i] = SHIFT_STATES.index(shift_state)
+        self.next = (i + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    # Returns the samples as (timestamp, latitude, longitude, speed, heading, shift state) tuples, oldest first
+    def samples(self):
+        start = (self.next - self.count) % self.size
+        for n in range(self.count):
+            i = (start + n) % self.size
+            yield (self.timestamps[i], self.latitudes[i], self.longitudes[i], self.speeds[i], self.headings[i], SHIFT_STATES[self.shift_states[i]])
+
+    def to_snapshot(self):
+        return list(self.samples())
+
+    def load_snapshot(self, samples):
+        for sample in samples[-self.size:]:
+            self.append(*sample)
+
+# Constant-velocity Kalman filter of a car's range from home. It fuses the GPS range with the radial component of the
+# reported speed and heading, so the range rate is known from a single sample and smoothed over the GPS jitter
+class RangeFilter:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.initialized = False
+        self.timestamp = 0.0
+        self.range = 0.0
+        self.range_rate = 0.0
+        self.p_range = 0.0
+        self.p_cross = 0.0
+        self.p_rate = 0.0
+
+    def predict(self, timestamp):
+        dt = timestamp - self.timestamp
+        self.timestamp = timestamp
+        if (dt <= 0):
+            return
+        q = TESLA_MOTION_ACCEL_NOISE_FPS2 ** 2
+        self.range += self.range_rate * dt
+        self.p_range += dt * (2 * self.p_cross + dt * self.p_rate) + q * dt ** 4 / 4
+        self.p_cross += dt * self.p_rate + q * dt ** 3 / 2
+        self.p_rate += q * dt ** 2
+
+    def update_range(self, measured_range):
+        r = TESLA_GPS_NOISE_FT ** 2
+        innovation = measured_range - self.range
+        s = self.p_range + r
+        gain_range = self.p_range / s
+        gain_rate = self.p_cross / s
+        self.range += gain_range * innovation
+        self.range_rate += gain_rate * innovation
+        self.p_rate -= gain_rate * self.p_cross
+        self.p_cross -= gain_rate * self.p_range
+        self.p_range -= gain_range * self.p_range
+
+    def update_range_rate(self, measured_rate):
+        r = TESLA_RADIAL_SPEED_NOISE_FPS ** 2
+        innovation = measured_rate - self.range_rate
+        s = self.p_rate + r
+        gain_range = self.p_cross / s
+        gain_rate = self.p_rate / s
+        self.range += gain_range * innovation
+        self.range_rate += gain_rate * innovation
+        self.p_range -= gain_range * self.p_cross
+        self.p_cross -= gain_range * self.p_rate
+        self.p_rate -= gain_rate * self.p_rate
+
+    # Adds a sample, starting over if the previous one is too old to predict from
+    def add_sample(self, timestamp, measured_range, measured_rate):
+        if ((not self.initialized) or ((timestamp - self.timestamp) > TESLA_MOTION_RESET_SECS)):
+            self.initialized = True
+            self.timestamp = timestamp
+            self.range = measured_range
+            self.range_rate = 0.0
+            self.p_range = TESLA_GPS_NOISE_FT ** 2
+            self.p_cross = 0.0
+            self.p_rate = TESLA_MOTION_INITIAL_RATE_NOISE_FPS ** 2
+        else:
+            self.predict(timestamp)
+            self.update_range(measured_range)
+        if (measured_rate is not None):
+            self.update_range_rate(measured_rate)
+
+    def range_rate_noise(self):
+        return math.sqrt(max(self.p_rate, 0.0))
+
+    def to_snapshot(self):
+        return {"initialized": self.initialized, "timestamp": self.timestamp, "range": self.range, "range_rate": self.range_rate,
+            "p_range": self.p_range, "p_cross": self.p_cross, "p_rate": self.p_rate}
+
+    def load_snapshot(self, snapshot):
+        for key, value in snapshot.items():
+            setattr(self, key, value)
+
+# Returns the home a car's distances are measured from
+def tesla_vehicle_home(vehicle):
+    if (vehicle.door is not None):
+        return vehicle.door.home
+    return home_geofence
+
+# Records a new sample in the car's ring buffer and updates its range filter
+def tesla_update_motion(vehicle, sample):
+    vehicle.history.append(sample.timestamp, sample.latitude, sample.longitude, sample.speed, sample.heading, sample.shift_state)
+    # The radial part of the car's velocity, positive when moving away from home. Too close to home the direction to
+    # home is meaningless, so only the range is used there
+    measured_rate = None
+    if (vehicle.distance_from_home > HOME_GEO_FENCE_FT):
+        east, north = tesla_vehicle_home(vehicle).local_feet(sample.latitude, sample.longitude)
+        heading = math.radians(sample.heading)
+        speed_fps = sample.speed * FEET_PER_SECOND_PER_MPH
+        measured_rate = speed_fps * (math.sin(heading) * east + math.cos(heading) * north) / math.hypot(east, north)
+    vehicle.motion.add_sample(sample.timestamp, vehicle.distance_from_home, measured_rate)
+
+# Smoothed rate in feet per second the car is closing in on home, negative when it is moving away
+def tesla_closing_speed(vehicle):
+    return -vehicle.motion.range_rate
+
+# Determines if the car is clearly moving towards home, rather than GPS jitter
+def tesla_is_closing_in(vehicle):
+    return (tesla_closing_speed(vehicle) > max(TESLA_MIN_RANGE_RATE_FPS, 2 * vehicle.motion.range_rate_noise()))
+
+# Determines if a car away from home is coming in to it. Roads to the west pass close to home heading its way, so where
+# the corridor model covers the car's cell and heading the model decides, elsewhere the car also has to be slow
+def tesla_is_arriving_home(vehicle):
+    if ((vehicle.distance_from_home < HOME_GEO_FENCE_FT) or (vehicle.distance_from_home > ARRIVING_GEO_FENCE_FT)
+        or not tesla_is_closing_in(vehicle)):
+        return False
+    probability = corridor_arrival_probability(vehicle)
+    if (probability is not None):
+        return (probability >= CORRIDOR_ARRIVAL_PROBABILITY)
+    return (vehicle.speed <= TESLA_ARRIVING_MAX_SPEED_MPH)
+
+# Determines if the car is clearly moving away from home, rather than GPS jitter
+def tesla_is_moving_away(vehicle):
+    return (-tesla_closing_speed(vehicle) > max(TESLA_MIN_RANGE_RATE_FPS, 2 * vehicle.motion.range_rate_noise()))
+
+# Returns the estimated seconds until the car crosses a geofence, or infinity if it is not heading towards it
+def tesla_time_to_geofence(vehicle, geofence_ft):
+    offset = vehicle.motion.range - geofence_ft
+    rate = vehicle.motion.range_rate
+    if ((offset > 0) and (rate < 0)) or ((offset < 0) and (rate > 0)):
+        return abs(offset / rate)
+    return math.inf
 
 # General Functions
-# Initialize debug logging
+# Queues log records as they are, so their messages are only formatted by the background writer. Log arguments have to
+# be values that won't change before they are written
+class LogQueueHandler(QueueHandler):
+    def prepare(self, record):
+        return record
+
+# Formats a telemetry record as one compact JSON object
+class TelemetryFormatter(logging.Formatter):
+    def format(self, record):
+        fields = {"t": round(record.created, 3), "event": record.msg}
+        fields.update(record.telemetry)
+        return json.dumps(fields, separators=(",", ":"))
+
+# Initialize debug logging. Records are queued and written to the rotating debug log and the telemetry stream from a
+# background thread, so log I/O never holds up a poll or a decision
 def logging_init():
-    logging.basicConfig(filename=LOG_FILE_NAME, filemode='a', level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s', datefmt='%d-%b-%y %I:%M:%S%p')
-
-# Clears the logfile it it gets too large
-def check_log_file_size():
-    if (getsize(LOG_FILE_NAME) > DEBUG_LOG_MAX_SIZE_BYTES):
-        os.remove(LOG_FILE_NAME)
-        logging.info("***** Debug Log Cleared *****")
-
-# Logs any catastrophic error and terminates the script
+    global log_listener
+    global telemetry_logger
+
+    log_queue = queue.Queue()
+    debug_handler = RotatingFileHandler(LOG_FILE_NAME, maxBytes=DEBUG_LOG_MAX_SIZE_BYTES, backupCount=DEBUG_LOG_BACKUP_COUNT)
+    debug_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s', datefmt='%d-%b-%y %I:%M:%S%p'))
+    handlers = [debug_handler]
+    if (len(TELEMETRY_LOG_FILE) > 0):
+        telemetry_handler = RotatingFileHandler(TELEMETRY_LOG_FILE, maxBytes=TELEMETRY_LOG_MAX_SIZE_BYTES, backupCount=TELEMETRY_LOG_BACKUP_COUNT)
+        telemetry_handler.setFormatter(TelemetryFormatter())
+        # Both streams share the queue, so each handler only takes its own records
+        telemetry_handler.addFilter(lambda record: record.name == TELEMETRY_LOGGER_NAME)
+        debug_handler.addFilter(lambda record: record.name != TELEMETRY_LOGGER_NAME)
+        handlers.append(telemetry_handler)
+        telemetry_logger = logging.getLogger(TELEMETRY_LOGGER_NAME)
+        telemetry_logger.propagate = False
+        telemetry_logger.setLevel(logging.INFO)
+        telemetry_logger.addHandler(LogQueueHandler(log_queue))
+    logging.basicConfig(level=logging.INFO, handlers=[LogQueueHandler(log_queue)])
+    log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+
+# Writes out the queued log records before the app exits
+def logging_shutdown():
+    global log_listener
+
+    if (log_listener is not None):
+        log_listener.stop()
+        log_listener = None
+
+# Adds an event to the telemetry stream, if there is one
+def telemetry_log(event, **fields):
+    if (telemetry_logger is not None):
+        telemetry_logger.info(event, extra={"telemetry": fields})
+
+# Logs any catastrophic error, saves the state for the next start and terminates the script
 def print_error_and_exit(message):
     logging.error(message)
+    if (len(tesla_vehicles) > 0):
+        state_snapshot_save()
+    if (history_store is not None):
+        history_store.close()
+    logging_shutdown()
     exit()
 
-# Watchdog timer to kill the app in case it goes off the rails
-def watchdog():
-    global watch_dog_last_update
+# Replaces a file in one step so a crash never leaves it half written, creating it readable by the owner only
+def write_file_atomic(file_name, text):
+    temp_file_name = file_name + ".tmp"
+    with os.fdopen(os.open(temp_file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as temp_file:
+        temp_file.write(text)
+    os.replace(temp_file_name, file_name)
+
+# Sets an engine event, either from the event loop itself or from a worker thread
+def wake_event(event):
+    if ((event_loop is None) or event_loop.is_closed()):
+        return
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    if (running_loop is event_loop):
+        event.set()
+    else:
+        event_loop.call_soon_threadsafe(event.set)
 
+# Sleeps until a poller's next poll is due. A changed interval wakes the poller right away to work out the new due time,
+# and the worker's heartbeat is pushed out to match
+async def wait_for_next_poll(event, next_poll_time, worker):
     while (True):
-        if ((time.time() - watch_dog_last_update) >= WATCHDOG_TIMEOUT_SECS):
-            print_error_and_exit("Watchdog Timer Expired")
+        remaining = next_poll_time() - time.time()
+        if (remaining <= 0):
+            return
+        worker.beat(remaining + SUPERVISOR_HEARTBEAT_GRACE_SECS)
+        try:
+            await asyncio.wait_for(event.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+        event.clear()
+
+# Supervisor
+# A supervised worker loop, run as run(*args, worker). The supervisor restarts it on its own if it crashes or misses a
+# heartbeat, so the app's state, sessions and tokens carry over. A worker without heartbeats is only restarted if it crashes
+class Worker:
+    def __init__(self, name, run, args=(), heartbeats=True):
+        self.name = name
+        self.run = run
+        self.args = args
+        self.heartbeats = heartbeats
+        self.task = None
+        self.due_at = math.inf
+        self.started_at = 0.0
+        self.ended_at = 0.0
+        self.failed_at = 0.0
+        self.restart_at = 0.0
+        self.failures = 0
+        self.recoveries = 0
+        self.recovery_secs = 0.0
+
+    def start(self):
+        self.started_at = time.time()
+        self.due_at = (self.started_at + SUPERVISOR_WORK_TIMEOUT_SECS) if self.heartbeats else math.inf
+        self.task = asyncio.ensure_future(self.run(*self.args, self))
+        self.task.add_done_callback(self.task_ended)
+        if (not self.heartbeats):
+            self.beat(math.inf)
+
+    def task_ended(self, task):
+        self.ended_at = time.time()
+
+    # Records a heartbeat, with the next one due within due_in_secs. The first one after a failure marks the recovery
+    def beat(self, due_in_secs):
+        now = time.time()
+        self.due_at = now + due_in_secs
+        if (self.failed_at > 0):
+            recovery_secs = now - self.failed_at
+            self.recoveries += 1
+            self.recovery_secs += recovery_secs
+            self.failed_at = 0.0
+            metrics_worker_recovery_seconds.observe((self.name,), recovery_secs)
+            logging.info("Worker Recovered (" + self.name + ") after " + str(round(recovery_secs, 1)) + "s")
+
+    def running(self):
+        return ((self.task is not None) and not self.task.done())
+
+    # Restarts a crashed or stalled worker once its backoff is up. A worker that returned on its own is left stopped
+    def check(self, now):
+        if (self.task is None):
+            if (now >= self.restart_at):
+                logging.info("Restarting Worker: " + self.name)
+                self.start()
+        elif (self.task.done()):
+            if (self.task.cancelled()):
+                self.fail(now, self.ended_at, "cancelled")
+            elif (self.task.exception() is not None):
+                logging.error("Worker Crashed (" + self.name + ")", exc_info=self.task.exception())
+                self.fail(now, self.ended_at, "crashed")
+            else:
+                logging.info("Worker Finished: " + self.name)
+                self.task = None
+                self.restart_at = math.inf
+        elif (now > self.due_at):
+            logging.error("Worker Stalled (" + self.name + "): heartbeat overdue by " + str(round(now - self.due_at, 1)) + "s")
+            self.restart("stalled")
+
+    # Stops the worker for good, for a worker the app no longer needs
+    def stop(self):
+        if (self.task is not None):
+            self.task.cancel()
+        self.task = None
+        self.restart_at = math.inf
+
+    # Stops the worker so it is started again after its backoff
+    def restart(self, reason):
+        if (self.task is None):
+            return
+        self.task.cancel()
+        now = time.time()
+        self.fail(now, now if (reason != "stalled") else self.due_at, reason)
+
+    def fail(self, now, failed_at, reason):
+        if ((now - self.started_at) >= SUPERVISOR_HEALTHY_SECS):
+            self.failures = 0
+        self.failures += 1
+        backoff = min(SUPERVISOR_RESTART_BACKOFF_BASE_SECS * (2 ** (self.failures - 1)), SUPERVISOR_RESTART_BACKOFF_MAX_SECS)
+        # Keep the time of the first failure if the worker fails again before it recovers
+        if (self.failed_at == 0):
+            self.failed_at = failed_at
+        self.task = None
+        self.restart_at = now + backoff
+        metrics_worker_restarts.inc((self.name, reason))
+        logging.info("Worker " + self.name + " " + reason + ", restarting in " + str(backoff) + "s")
+
+# Starts the workers and keeps them running
+async def supervisor(workers):
+    global supervisor_checked_at
+
+    for worker in workers:
+        supervisor_add(worker)
+    supervisor_checked_at = time.time()
+    threading.Thread(target=supervisor_loop_watchdog, name="loop_watchdog", daemon=True).start()
+    while (True):
+        await asyncio.sleep(SUPERVISOR_CHECK_SECS)
+        supervisor_checked_at = time.time()
+        for worker in list(supervisor_workers.values()):
+            worker.check(supervisor_checked_at)
+
+# Starts a worker and keeps it running. Workers can be added and removed while the supervisor runs, e.g. when a fleet
+# worker takes over a car
+def supervisor_add(worker):
+    supervisor_workers[worker.name] = worker
+    worker.start()
+
+# Stops a worker for good and stops supervising it
+def supervisor_remove(name):
+    worker = supervisor_workers.pop(name, None)
+    if (worker is not None):
+        worker.stop()
+
+# Exits if the event loop stops running the supervisor, saving the state for the next start. This is the one failure a
+# worker restart can't fix
+def supervisor_loop_watchdog():
+    while (True):
+        time.sleep(SUPERVISOR_CHECK_SECS)
+        stalled_secs = time.time() - supervisor_checked_at
+        if (stalled_secs > SUPERVISOR_LOOP_STALL_SECS):
+            logging.error("Event Loop Stalled for " + str(round(stalled_secs)) + "s. Exiting...")
+            if (len(tesla_vehicles) > 0):
+                state_snapshot_save()
+            if (history_store is not None):
+                history_store.close()
+            logging_shutdown()
+            os._exit(1)
+
+# Name of the worker polling a car's data
+def tesla_vehicle_poller_name(vehicle):
+    return "vehicle_poller[" + vehicle.name + "]"
+
+# Metrics
+# A counter, gauge or histogram with its series kept by label values, rendered in the Prometheus text format. Updates
+# come from the poll and door threads, so each metric has its own lock
+class Metric:
+    def __init__(self, name, kind, help_text, label_names=(), buckets=None):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+    def set(self, labels, value):
+        with self.lock:
+            self.series[labels] = value
+
+    # Histogram series hold a count per bucket plus one past the last bucket, then the sum of the observations
+    def observe(self, labels, value):
+        with self.lock:
+            series = self.series.get(labels)
+            if (series is None):
+                series = [0] * (len(self.buckets) + 2)
+                self.series[labels] = series
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def clear(self):
+        with self.lock:
+            self.series.clear()
+
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.help_text, "# TYPE " + self.name + " " + self.kind]
+        with self.lock:
+            series = sorted(self.series.items())
+        for labels, value in series:
+            if (self.kind != "histogram"):
+                lines.append(self.name + metrics_labels(self.label_names, labels) + " " + metrics_value(value))
+                continue
+            count = 0
+            for bound, bucket_count in zip(self.buckets + ["+Inf"], value[:-1]):
+                count += bucket_count
+                lines.append(self.name + "_bucket" + metrics_labels(self.label_names + ("le",), labels + (metrics_value(bound),))
+                    + " " + str(count))
+            lines.append(self.name + "_sum" + metrics_labels(self.label_names, labels) + " " + metrics_value(value[-1]))
+            lines.append(self.name + "_count" + metrics_labels(self.label_names, labels) + " " + str(count))
+        return lines
+
+# Holds the app's metrics and the collectors that update the current value gauges right before a scrape
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help_text, label_names=()):
+        return self.add(Metric(name, "counter", help_text, label_names))
+
+    def gauge(self, name, help_text, label_names=()):
+        return self.add(Metric(name, "gauge", help_text, label_names))
+
+    def histogram(self, name, help_text, label_names, buckets):
+        return self.add(Metric(name, "histogram", help_text, label_names, buckets))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+def metrics_labels(label_names, labels):
+    if (len(label_names) == 0):
+        return ""
+    pairs = []
+    for name, value in zip(label_names, labels):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(name + "=\"" + value + "\"")
+    return "{" + ",".join(pairs) + "}"
+
+def metrics_value(value):
+    if (isinstance(value, str)):
+        return value
+    if (isinstance(value, float) and value.is_integer()):
+        return str(int(value))
+    return repr(value)
+
+# Sets the worker gauges before a scrape
+def metrics_collect_workers():
+    for worker in list(supervisor_workers.values()):
+        metrics_worker_up.set((worker.name,), 1 if worker.running() else 0)
+        if (worker.recoveries > 0):
+            metrics_worker_mttr.set((worker.name,), worker.recovery_secs / worker.recoveries)
+
+# Sets the gauges for the current poll intervals before a scrape
+def metrics_collect_poll_intervals():
+    metrics_vehicle_poll_interval.clear()
+    for vehicle in list(tesla_vehicles.values()):
+        metrics_vehicle_poll_interval.set((vehicle.name,), vehicle.poll_interval)
+    metrics_door_poll_interval.set((), myq_door_thread_sleep)
+
+async def metrics_handler(request):
+    return 200, METRICS_CONTENT_TYPE, metrics_registry.render()
+
+# Serves the metrics until the app exits
+async def metrics_server(worker):
+    await local_http_server("Metrics", METRICS_HOST, METRICS_PORT, {("GET", "/metrics"): metrics_handler})
+
+metrics_registry = MetricsRegistry()
+metrics_registry.collectors.append(metrics_collect_poll_intervals)
+metrics_registry.collectors.append(metrics_collect_workers)
+metrics_http_request_seconds = metrics_registry.histogram("magic_garage_http_request_duration_seconds",
+    "Time from sending an API request to its response, by endpoint", ("client", "method", "endpoint"), METRICS_HTTP_BUCKETS_SECS)
+metrics_http_responses = metrics_registry.counter("magic_garage_http_responses_total",
+    "API responses by endpoint and status code. Status is error for failed requests and throttled for ones the scheduler held back",
+    ("client", "method", "endpoint", "status"))
+metrics_vehicle_polls = metrics_registry.counter("magic_garage_vehicle_polls_total",
+    "Vehicle polls by result: requested fetched vehicle_data, asleep/offline were answered by the vehicle listing, streamed were"
+    + " skipped for a live stream", ("vehicle", "result"))
+metrics_vehicle_stream_samples = metrics_registry.counter("magic_garage_vehicle_stream_samples_total",
+    "Vehicle samples received over the streaming websocket", ("vehicle",))
+metrics_vehicle_stream_connects = metrics_registry.counter("magic_garage_vehicle_stream_connects_total",
+    "Streaming websocket connection attempts by result: subscribed, failed, disconnected or quiet", ("vehicle", "result"))
+metrics_door_polls = metrics_registry.counter("magic_garage_door_polls_total", "Door polls by kind: discovery or device", ("kind",))
+metrics_vehicle_poll_interval = metrics_registry.gauge("magic_garage_vehicle_poll_interval_seconds", "Current vehicle data poll interval",
+    ("vehicle",))
+metrics_door_poll_interval = metrics_registry.gauge("magic_garage_door_poll_interval_seconds", "Current MyQ door poll interval")
+metrics_decision_seconds = metrics_registry.histogram("magic_garage_decision_duration_seconds",
+    "Time spent in tesla_check_arriving_leaving per decision", ("vehicle",), METRICS_DECISION_BUCKETS_SECS)
+metrics_loop_seconds = metrics_registry.histogram("magic_garage_loop_iteration_duration_seconds",
+    "Time each iteration of a monitor loop spends working, not counting its sleep", ("loop",), METRICS_LOOP_BUCKETS_SECS)
+metrics_door_command_seconds = metrics_registry.histogram("magic_garage_door_command_latency_seconds",
+    "Time from deciding to open or close a door to seeing it move", ("door", "action"), METRICS_DOOR_BUCKETS_SECS)
+metrics_worker_up = metrics_registry.gauge("magic_garage_worker_up", "Whether a supervised worker is running", ("worker",))
+metrics_worker_restarts = metrics_registry.counter("magic_garage_worker_restarts_total",
+    "Supervised worker restarts by reason: crashed, stalled, stale_data or cancelled", ("worker", "reason"))
+metrics_worker_recovery_seconds = metrics_registry.histogram("magic_garage_worker_recovery_seconds",
+    "Time from a worker failing to its first heartbeat after the restart", ("worker",), METRICS_RECOVERY_BUCKETS_SECS)
+metrics_worker_mttr = metrics_registry.gauge("magic_garage_worker_mttr_seconds", "Mean time to recover of a supervised worker",
+    ("worker",))
+
+# Sampling Profiler
+# Samples the stack of every thread from a background thread, counting each distinct stack. It costs nothing until it
+# is started, and as a wall clock profile it shows threads waiting on the network or a lock along with the ones running
+class SamplingProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stop_event = None
+
+    def running(self):
+        return (self.stop_event is not None)
+
+    # Starts profiling, or stops it and writes out the profile. Called from the PROFILE_SIGNAL handler, so it never waits
+    # on the profile being written
+    def toggle(self):
+        with self.lock:
+            if (self.stop_event is None):
+                self.stop_event = threading.Event()
+                threading.Thread(target=self.run, args=(self.stop_event,), name="profiler", daemon=True).start()
+                logging.info("Profiler Started, sampling every " + str(PROFILE_INTERVAL_SECS) + "s")
+            else:
+                self.stop_event.set()
+                self.stop_event = None
+
+    def run(self, stop_event):
+        started_at = time.time()
+        stacks = {}
+        samples = 0
+        while ((not stop_event.wait(PROFILE_INTERVAL_SECS)) and ((time.time() - started_at) < PROFILE_MAX_SECS)):
+            self.sample(stacks)
+            samples += 1
+        with self.lock:
+            if (self.stop_event is stop_event):
+                self.stop_event = None
+        try:
+            file_name = self.write(stacks, started_at)
+            logging.info("Profiler Stopped, " + str(samples) + " samples over " + str(round(time.time() - started_at, 1))
+                + "s written to " + file_name)
+        except OSError as e:
+            logging.error("Profile Write Failed: " + str(e))
+
+    # Adds the current stack of every other thread to the counts, root first and keyed by the thread's name without the
+    # pool number, so a pool's threads add up together
+    def sample(self, stacks):
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if (thread_id == own_id):
+                continue
+            frames = []
+            while (frame is not None):
+                code = frame.f_code
+                frames.append(code.co_name + " (" + os.path.basename(code.co_filename) + ":" + str(code.co_firstlineno) + ")")
+                frame = frame.f_back
+            frames.append(names.get(thread_id, "thread").rstrip("0123456789_"))
+            stack = ";".join(reversed(frames))
+            stacks[stack] = stacks.get(stack, 0) + 1
+
+    # Writes the stacks as "frame;frame;frame count" lines, most sampled first, to a file named for the process and start
+    # time so fleet workers never write over each other
+    def write(self, stacks, started_at):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        file_name = os.path.join(PROFILE_DIR, "profile-" + str(os.getpid()) + "-"
+            + time.strftime("%Y%m%d-%H%M%S", time.localtime(started_at)) + ".txt")
+        lines = [stack + " " + str(count) for stack, count in sorted(stacks.items(), key=lambda item: item[1], reverse=True)]
+        write_file_atomic(file_name, "\n".join(lines) + "\n")
+        return file_name
+
+profiler = SamplingProfiler()
+
+# Lets PROFILE_SIGNAL start and stop the profiler on the running event loop
+def profiler_install():
+    event_loop.add_signal_handler(PROFILE_SIGNAL, profiler.toggle)
+
+# Local HTTP Server
+# A small HTTP/1.1 server on asyncio streams for the local endpoints. Routes map (method, path) to a coroutine that takes
+# the request and returns (status, content type, body) with optional extra headers, or None if it wrote its own response. Connections are closed
+# after each response
+class LocalHttpRequest:
+    def __init__(self, method, path, query, headers, body, writer):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+        self.writer = writer
+
+# Reads a line of the request head, or None if it runs past the stream's limit
+async def local_http_read_line(reader):
+    try:
+        return await reader.readline()
+    except (asyncio.LimitOverrunError, ValueError):
+        return None
+
+# Reads a request off a connection. A malformed request returns 400, and one that is too large returns 431 for its
+# request line or headers and 413 for its body, as the status to answer with
+async def local_http_read_request(reader, writer):
+    line = await local_http_read_line(reader)
+    if (line is None):
+        return 431
+    request_line = line.decode("latin-1").split()
+    if (len(request_line) != 3):
+        return 400
+    method, target, _ = request_line
+    headers = {}
+    while (True):
+        line = await local_http_read_line(reader)
+        if (line is None):
+            return 431
+        if (line in (b"\r\n", b"\n", b"")):
+            break
+        if (len(headers) >= LOCAL_HTTP_MAX_HEADERS):
+            return 431
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", "0"))
+    except ValueError:
+        return 400
+    if (length < 0):
+        return 400
+    if (length > LOCAL_HTTP_MAX_BODY_BYTES):
+        return 413
+    body = (await reader.readexactly(length)) if (length > 0) else b""
+    path, _, query_string = target.partition("?")
+    return LocalHttpRequest(method, path, urllib.parse.parse_qs(query_string), headers, body, writer)
+
+# Builds the bytes of a complete response
+def local_http_response(status, content_type, body, headers={}):
+    if (isinstance(body, str)):
+        body = body.encode("utf-8")
+    lines = ["HTTP/1.1 " + str(status) + " " + HTTPStatus(status).phrase, "Content-Type: " + content_type,
+        "Content-Length: " + str(len(body)), "Connection: close"]
+    for name, value in headers.items():
+        lines.append(name + ": " + value)
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+async def local_http_handle(reader, writer, routes):
+    try:
+        request = await asyncio.wait_for(local_http_read_request(reader, writer), LOCAL_HTTP_READ_TIMEOUT_SECS)
+        if (isinstance(request, int)):
+            response = (request, "text/plain", HTTPStatus(request).phrase + "\n")
+        elif ((request.method, request.path) in routes):
+            try:
+                response = await routes[(request.method, request.path)](request)
+            except Exception:
+                logging.exception("Local HTTP request failed: " + request.method + " " + request.path)
+                response = (500, "text/plain", "Internal Server Error\n")
+        elif (any(path == request.path for _, path in routes)):
+            response = (405, "text/plain", "Method Not Allowed\n")
+        else:
+            response = (404, "text/plain", "Not Found\n")
+        if (response is not None):
+            writer.write(local_http_response(*response))
+            await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+# Serves the routes on a local port until the app exits. A port that is already taken only loses its endpoint
+async def local_http_server(name, host, port, routes):
+    try:
+        server = await asyncio.start_server(lambda reader, writer: local_http_handle(reader, writer, routes), host, port)
+    except OSError as e:
+        logging.error("Unable to start the " + name + " endpoint on " + host + ":" + str(port) + ": " + str(e))
+        return
+    logging.info(name + " endpoint listening on http://" + host + ":" + str(port))
+    async with server:
+        await server.serve_forever()
+
+# Status API
+# The last published status of every vehicle and door. Changes are encoded once as a server-sent event and queued for
+# every subscriber, and the JSON of the whole status is cached until the next change, so subscribers and status requests
+# cost nothing upstream. Publishing is safe from any thread, changes are applied on the event loop
+class StatusBroadcaster:
+    def __init__(self):
+        self.status = {"vehicle": {}, "door": {}}
+        self.version = 0
+        self.body = None
+        self.subscribers = set()
+        self.events_sent = 0
+        self.subscribers_dropped = 0
+
+    # Publishes the fields of a vehicle or door, or None once it is gone. Unchanged fields are not sent out again. Changes
+    # are applied on the spot when there is no running event loop to hand them to, before the engine starts or after it stops
+    def publish(self, kind, key, fields):
+        if ((event_loop is None) or event_loop.is_closed() or not event_loop.is_running()):
+            self.apply(kind, key, fields)
+            return
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if (running_loop is event_loop):
+            self.apply(kind, key, fields)
+        else:
+            event_loop.call_soon_threadsafe(self.apply, kind, key, fields)
+
+    def apply(self, kind, key, fields):
+        if (self.status[kind].get(key) == fields):
+            return
+        if (fields is None):
+            del self.status[kind][key]
+            data = {"key": key, "removed": True}
         else:
-            watch_dog_last_update = time.time()
-        time.sleep(WATCHDOG_RESET_SECS)
+            self.status[kind][key] = fields
+            data = fields
+        self.version += 1
+        self.body = None
+        self.broadcast(status_event(self.version, kind, data))
+
+    # Queues an event for every subscriber, dropping the ones too far behind to take it
+    def broadcast(self, event):
+        for subscriber in list(self.subscribers):
+            if (subscriber.full()):
+                self.drop(subscriber)
+            else:
+                subscriber.put_nowait(event)
+                self.events_sent += 1
+
+    # Disconnects a subscriber, replacing its oldest queued event with the end of stream marker if it is full
+    def drop(self, subscriber):
+        self.subscribers.discard(subscriber)
+        self.subscribers_dropped += 1
+        if (subscriber.full()):
+            subscriber.get_nowait()
+        subscriber.put_nowait(None)
+
+    # Ends every event stream
+    def close(self):
+        for subscriber in list(self.subscribers):
+            self.drop(subscriber)
+
+    # Returns the cached JSON of the whole status
+    def status_body(self):
+        if (self.body is None):
+            self.body = json.dumps({"version": self.version, "vehicles": list(self.status["vehicle"].values()),
+                "doors": list(self.status["door"].values())}, separators=(",", ":")).encode("utf-8")
+        return self.body
+
+    def subscribe(self):
+        subscriber = asyncio.Queue(STATUS_API_SUBSCRIBER_QUEUE_SIZE)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+# Encodes a server-sent event
+def status_event(version, kind, data):
+    return ("id: " + str(version) + "\nevent: " + kind + "\ndata: " + json.dumps(data, separators=(",", ":")) + "\n\n").encode("utf-8")
+
+def status_publish_vehicle(vehicle):
+    status_broadcaster.publish("vehicle", vehicle.id, {
+        "id": vehicle.id,
+        "name": vehicle.name,
+        "state": vehicle.state,
+        "state_since": vehicle.state_since,
+        "arriving": vehicle.state in (VEHICLE_STATE_APPROACHING, VEHICLE_STATE_ARRIVING),
+        "leaving": vehicle.state == VEHICLE_STATE_LEAVING,
+        "location": tesla_get_relative_location(vehicle) if vehicle.has_data else None,
+        "shift_state": vehicle.shift_state,
+        "driver_present": vehicle.driver_present,
+        "charger_connected": vehicle.charger_connected,
+        "awake": vehicle.awake,
+        "online_state": vehicle.online_state,
+        "door": None if (vehicle.door is None) else vehicle.door.name
+    })
+
+def status_publish_door(door):
+    status_broadcaster.publish("door", door.serial, {"serial": door.serial, "name": door.name, "state": door.state,
+        "state_changed_at": door.state_changed_at})
+
+async def status_handler(request):
+    return 200, "application/json", status_broadcaster.status_body()
+
+# Streams the current status as a snapshot event followed by every change, with comments to keep idle connections open
+async def status_events_handler(request):
+    if (len(status_broadcaster.subscribers) >= STATUS_API_MAX_SUBSCRIBERS):
+        return 503, "text/plain", "Too Many Subscribers\n"
+    subscriber = status_broadcaster.subscribe()
+    writer = request.writer
+    try:
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n"
+            + ("retry: " + str(STATUS_API_RETRY_MILLIS) + "\n").encode("latin-1")
+            + ("id: " + str(status_broadcaster.version) + "\nevent: snapshot\ndata: ").encode("latin-1")
+            + status_broadcaster.status_body() + b"\n\n")
+        await writer.drain()
+        while (True):
+            try:
+                event = await asyncio.wait_for(subscriber.get(), STATUS_API_KEEPALIVE_SECS)
+            except asyncio.TimeoutError:
+                event = b": keepalive\n\n"
+            if (event is None):
+                break
+            writer.write(event)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        status_broadcaster.unsubscribe(subscriber)
+    return None
+
+# Opens or closes a door through the same path as the cars' door commands. The body is {"door": name or serial,
+# "action": "open" or "close"}, and the door's progress shows up on the event stream
+async def status_door_command_handler(request):
+    if (len(STATUS_API_TOKEN) == 0):
+        return 403, "text/plain", "Door Commands Disabled\n"
+    authorization = request.headers.get("authorization", "")
+    if (not hmac.compare_digest(authorization.encode("utf-8"), ("Bearer " + STATUS_API_TOKEN).encode("utf-8"))):
+        return 401, "text/plain", "Unauthorized\n", {"WWW-Authenticate": "Bearer"}
+    try:
+        command = json.loads(request.body)
+    except ValueError:
+        return 400, "text/plain", "Bad Request\n"
+    if ((not isinstance(command, dict)) or (not isinstance(command.get("door"), str)) or (not isinstance(command.get("action"), str))):
+        return 400, "text/plain", "Bad Request\n"
+    door_name = command["door"]
+    action = command["action"]
+    door = myq_doors.get(door_name) or next((door for door in list(myq_doors.values()) if (door.name == door_name)), None)
+    if (door is None):
+        return 404, "text/plain", "Unknown Door\n"
+    if (action not in MYQ_DOOR_MOVING_STATES):
+        return 400, "text/plain", "Unknown Action\n"
+    if (door.state in MYQ_DOOR_MOVING_STATES[action]):
+        return 409, "application/json", json.dumps({"door": door.name, "action": action, "state": door.state})
+    logging.info("Status API Door Command (" + door.name + "): " + action)
+    myq_dispatch_door_command(myq_open_door if (action == "open") else myq_close_door, door)
+    return 202, "application/json", json.dumps({"door": door.name, "action": action, "state": door.state})
+
+# Serves the status API until the app exits
+async def status_api_server(worker):
+    await local_http_server("Status API", STATUS_API_HOST, STATUS_API_PORT, status_api_routes)
+
+status_broadcaster = StatusBroadcaster()
+status_api_routes = {("GET", "/status"): status_handler, ("GET", "/events"): status_events_handler,
+    ("POST", "/doors/command"): status_door_command_handler}
 
 # Parses Tesla and MyQ credentials from the command line parameters
 def parse_input_parameters():
@@ -135,16 +1482,804 @@ def parse_input_parameters():
     except IndexError:
         print_error_and_exit("Incorrect input parameters")
 
+# Token Manager
+# Raised when a provider turns down a login or token refresh
+class AuthError(Exception):
+    pass
+
+# Holds a provider's auth token. Tokens are renewed ahead of expiry in the background, so a request only waits on a login
+# when there is no token yet or the provider rejected the current one with a 401
+class TokenManager:
+    # login() logs in with the account credentials and refresh(refresh_token) uses a refresh token, both returning the new
+    # tokens. Providers without a refresh API pass no refresh, so the token is renewed with a login
+    def __init__(self, provider, refresh_ahead_secs, login, refresh=None):
+        self.provider = provider
+        self.refresh_ahead_secs = refresh_ahead_secs
+        self.login = login
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.access_token = ""
+        self.refresh_token = ""
+        self.expires_at = 0.0
+        self.logins = 0
+        self.refreshes = 0
+        self.reauths = 0
+        self.cache_loads = 0
+        self.blocked_requests = 0
+        self.blocked_secs = 0.0
+
+    def is_valid(self):
+        return ((len(self.access_token) > 0) and (time.time() < self.expires_at))
+
+    # Returns the current token, only logging in first if there is no usable one
+    def get_token(self):
+        if (self.is_valid()):
+            return self.access_token
+        start = time.time()
+        with self.lock:
+            if (not self.is_valid()):
+                self.renew()
+        self.record_blocked(time.time() - start)
+        return self.access_token
+
+    # Renews the token if it expires soon. Called by the background refresher
+    def check_expiry(self):
+        if (time.time() >= (self.expires_at - self.refresh_ahead_secs)):
+            with self.lock:
+                if (time.time() >= (self.expires_at - self.refresh_ahead_secs)):
+                    self.renew()
+
+    # Renews a token the provider rejected. Requests that were rejected with the same token only renew it once
+    def reauthenticate(self, rejected_token):
+        start = time.time()
+        with self.lock:
+            if (self.access_token == rejected_token):
+                self.reauths += 1
+                self.renew()
+        self.record_blocked(time.time() - start)
+
+    # Uses the refresh token when there is one, falling back to a full login. Must be called with the lock held
+    def renew(self):
+        tokens = None
+        if ((self.refresh is not None) and (len(self.refresh_token) > 0)):
+            try:
+                tokens = self.refresh(self.refresh_token)
+                if (tokens is not None):
+                    self.refreshes += 1
+            except Exception as e:
+                logging.error("Failed to Refresh " + self.provider + " Auth Token, logging in again: " + str(e))
+        if (tokens is None):
+            tokens = self.login()
+            self.logins += 1
+        self.access_token = tokens["access_token"]
+        self.refresh_token = tokens["refresh_token"]
+        self.expires_at = time.time() + tokens["expires_in"]
+        token_cache_save()
+
+    def record_blocked(self, elapsed):
+        self.blocked_requests += 1
+        self.blocked_secs += elapsed
+
+    def to_cache(self):
+        return {"access_token": self.access_token, "refresh_token": self.refresh_token, "expires_at": self.expires_at}
+
+    # Takes a cached token if it has not expired yet
+    def load_cache(self, cached):
+        with self.lock:
+            if (cached["expires_at"] > time.time()):
+                self.access_token = cached["access_token"]
+                self.refresh_token = cached["refresh_token"]
+                self.expires_at = cached["expires_at"]
+                self.cache_loads += 1
+                logging.info(self.provider + " Auth Token Loaded From Cache")
+
+    # Returns a one line summary of the token renewals and the time requests spent waiting on them
+    def stats_summary(self):
+        return (self.provider + " Auth: " + str(self.logins) + " logins, " + str(self.refreshes) + " refreshes, " + str(self.reauths)
+            + " re-auths after 401, " + str(self.cache_loads) + " cache loads | " + str(self.blocked_requests) + " requests waited "
+            + str(round(1000 * self.blocked_secs)) + "ms total | Expires in " + str(round(max(self.expires_at - time.time(), 0) / 3600, 1)) + "h")
+
+# The API functions and credentials are looked up when a token is renewed, since the clients are built before either
+class TeslaTokenManager(TokenManager):
+    def __init__(self):
+        super().__init__("Tesla", TESLA_TOKEN_REFRESH_AHEAD_SECS, lambda: tesla_login(tesla_email, tesla_password),
+            lambda refresh_token: tesla_refresh_auth_token(refresh_token))
+
+class MyQTokenManager(TokenManager):
+    def __init__(self):
+        super().__init__("MyQ", MYQ_TOKEN_REFRESH_AHEAD_SECS, lambda: myq_login(myq_email, myq_password))
+
+# Token Cache
+# Derives the cache key from the account credentials, so changing a password invalidates the cache
+def token_cache_cipher(salt):
+    global token_cache_salt
+    global token_cache_fernet
+
+    if (salt != token_cache_salt):
+        secret = "\0".join([tesla_email, tesla_password, myq_email, myq_password]).encode("utf-8")
+        key = hashlib.pbkdf2_hmac("sha256", secret, salt, TOKEN_CACHE_KDF_ITERATIONS)
+        token_cache_fernet = Fernet(base64.urlsafe_b64encode(key))
+        token_cache_salt = salt
+    return token_cache_fernet
+
+# Writes every provider's tokens to the encrypted cache file, readable by the owner only
+def token_cache_save():
+    if ((Fernet is None) or (len(TOKEN_CACHE_FILE) == 0)):
+        return
+    with token_cache_lock:
+        try:
+            salt = token_cache_salt or os.urandom(16)
+            tokens = {client.tokens.provider: client.tokens.to_cache() for client in [tesla_client, myq_client]}
+            encrypted = token_cache_cipher(salt).encrypt(json.dumps(tokens).encode("utf-8"))
+            write_file_atomic(TOKEN_CACHE_FILE, json.dumps({"salt": base64.b64encode(salt).decode("ascii"), "tokens": encrypted.decode("ascii")}))
+        except Exception as e:
+            logging.error("Failed to save the token cache: " + str(e))
+
+# Loads the cached tokens that have not expired yet
+def token_cache_load():
+    if ((len(TOKEN_CACHE_FILE) == 0) or not os.path.exists(TOKEN_CACHE_FILE)):
+        return
+    if (Fernet is None):
+        logging.info("Install the cryptography package to cache auth tokens across restarts")
+        return
+    with token_cache_lock:
+        try:
+            with open(TOKEN_CACHE_FILE) as cache_file:
+                cache = json.load(cache_file)
+            salt = base64.b64decode(cache["salt"])
+            tokens = json.loads(token_cache_cipher(salt).decrypt(cache["tokens"].encode("ascii")))
+        except InvalidToken:
+            logging.info("Token cache was written with other credentials, ignoring it")
+            return
+        except Exception as e:
+            logging.error("Failed to load the token cache: " + str(e))
+            return
+    for client in [tesla_client, myq_client]:
+        if (client.tokens.provider in tokens):
+            client.tokens.load_cache(tokens[client.tokens.provider])
+
+# Renews any token close to expiring, off the request path
+async def token_refresher(worker):
+    while (True):
+        worker.beat(TOKEN_EXPIRE_CHECK_SECS + SUPERVISOR_HEARTBEAT_GRACE_SECS)
+        await asyncio.sleep(TOKEN_EXPIRE_CHECK_SECS)
+        worker.beat(SUPERVISOR_WORK_TIMEOUT_SECS)
+        for client in [tesla_client, myq_client]:
+            try:
+                await asyncio.to_thread(client.tokens.check_expiry)
+            except Exception as e:
+                logging.error("Failed to renew " + client.name + " Auth Token: " + str(e))
+
+# Warm Start Snapshot
+def vehicle_to_snapshot(vehicle):
+    return {
+        "id": vehicle.id,
+        "name": vehicle.name,
+        "has_data": vehicle.has_data,
+        "sample": None if (vehicle.sample is None) else vehicle.sample.to_dict(),
+        "distance_from_home": vehicle.distance_from_home,
+        "shift_state": vehicle.shift_state,
+        "speed": vehicle.speed,
+        "charger_connected": vehicle.charger_connected,
+        "driver_present": vehicle.driver_present,
+        "awake": vehicle.awake,
+        "online_state": vehicle.online_state,
+        "stream_id": vehicle.stream_id,
+        "poll_interval": vehicle.poll_interval,
+        "desired_poll_interval": vehicle.desired_poll_interval,
+        "door_poll_interval": vehicle.door_poll_interval,
+        "state": vehicle.state,
+        "state_since": vehicle.state_since,
+        "history": vehicle.history.to_snapshot(),
+        "motion": vehicle.motion.to_snapshot()
+    }
+
+# Restores a car's last data, decision state and trajectory if its last sample is recent enough to carry on from
+def vehicle_load_snapshot(vehicle, snapshot):
+    if ((not snapshot["has_data"]) or (snapshot["sample"] is None)
+        or ((time.time() - snapshot["sample"]["timestamp"]) > STATE_SNAPSHOT_MAX_AGE_SECS)):
+        return False
+    vehicle.sample = VehicleSample.from_dict(snapshot["sample"])
+    for key in ["has_data", "distance_from_home", "shift_state", "speed", "charger_connected", "driver_present", "awake",
+        "online_state", "poll_interval", "desired_poll_interval", "door_poll_interval", "state", "state_since"]:
+        if (key in snapshot):
+            setattr(vehicle, key, snapshot[key])
+    vehicle.history.load_snapshot(snapshot["history"])
+    vehicle.motion.load_snapshot(snapshot["motion"])
+    return True
+
+def door_to_snapshot(door):
+    return {"serial": door.serial, "name": door.name, "state": door.state, "state_changed_at": door.state_changed_at,
+        "travel_secs": door.travel_secs, "command_latency_secs": door.command_latency_secs}
+
+def door_load_snapshot(door, snapshot):
+    for key in ["state", "state_changed_at", "travel_secs", "command_latency_secs"]:
+        setattr(door, key, snapshot[key])
+
+# Writes the warm start snapshot
+def state_snapshot_save():
+    if (len(STATE_SNAPSHOT_FILE) == 0):
+        return
+    snapshot = {
+        "saved_at": time.time(),
+        "myq_account_id": myq_account_id,
+        "doors": [door_to_snapshot(door) for door in list(myq_doors.values())],
+        "vehicles": [vehicle_to_snapshot(vehicle) for vehicle in list(tesla_vehicles.values())]
+    }
+    try:
+        write_file_atomic(STATE_SNAPSHOT_FILE, json.dumps(snapshot, separators=(",", ":")))
+    except Exception as e:
+        logging.error("Failed to save the state snapshot: " + str(e))
+
+# Restores the vehicles, doors and account from the warm start snapshot. Returns whether they were restored, in which
+# case tesla_init and myq_init skip the requests that would look them up
+def state_snapshot_load():
+    global myq_account_id
+    global myq_door_thread_sleep
+
+    if ((len(STATE_SNAPSHOT_FILE) == 0) or not os.path.exists(STATE_SNAPSHOT_FILE)):
+        return False
+    try:
+        with open(STATE_SNAPSHOT_FILE) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except Exception as e:
+        logging.error("Failed to load the state snapshot: " + str(e))
+        return False
+    age = time.time() - snapshot["saved_at"]
+    if ((age > STATE_SNAPSHOT_IDENTITY_MAX_AGE_SECS) or (len(snapshot["vehicles"]) == 0)):
+        logging.info("State snapshot is too old, starting cold")
+        return False
+    myq_account_id = snapshot["myq_account_id"]
+    for door_snapshot in snapshot["doors"]:
+        door = GarageDoor(door_snapshot["serial"], door_snapshot["name"])
+        door_load_snapshot(door, door_snapshot)
+        myq_doors[door.serial] = door
+    restored = 0
+    for vehicle_snapshot in snapshot["vehicles"]:
+        vehicle = Vehicle(vehicle_snapshot["id"], vehicle_snapshot["name"])
+        vehicle.stream_id = vehicle_snapshot.get("stream_id")
+        tesla_vehicles[vehicle.id] = vehicle
+        if (vehicle_load_snapshot(vehicle, vehicle_snapshot)):
+            restored += 1
+    assign_vehicle_doors()
+    if (len(tesla_vehicles) > 0):
+        myq_door_thread_sleep = min(vehicle.door_poll_interval for vehicle in tesla_vehicles.values())
+    logging.info("Warm Start: restored " + str(len(tesla_vehicles)) + " vehicles (" + str(restored) + " with recent trajectories) and "
+        + str(len(myq_doors)) + " doors from a " + str(round(age, 1)) + "s old snapshot")
+    return True
+
+# Periodically writes the warm start snapshot
+async def state_snapshot_writer(worker):
+    while (True):
+        worker.beat(STATE_SNAPSHOT_INTERVAL_SECS + SUPERVISOR_HEARTBEAT_GRACE_SECS)
+        await asyncio.sleep(STATE_SNAPSHOT_INTERVAL_SECS)
+        worker.beat(SUPERVISOR_WORK_TIMEOUT_SECS)
+        await asyncio.to_thread(state_snapshot_save)
+
+# Request Scheduler
+# Raised instead of sending a request while its provider or endpoint is backing off
+class RequestThrottled(Exception):
+    pass
+
+# Returns the seconds a Retry-After header asks to wait, given either as seconds or as an HTTP date
+def parse_retry_after(value):
+    if (value is None):
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except Exception:
+        return None
+
+# Outbound scheduler shared by all of a provider's requests. Polls that would hit a backing off endpoint, a provider
+# paused by a 429 or an open circuit are turned away right away so the next poll can try again. Priority requests skip
+# the backoff and the circuit breaker, and only wait a short time for a Retry-After pause to end
+class RequestScheduler:
+    def __init__(self, name, rate_per_sec, burst):
+        self.name = name
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.refilled_at = time.time()
+        self.priority_waiting = 0
+        self.retry_after_until = 0.0
+        # Per request path (failures in a row, backing off until)
+        self.backoffs = {}
+        self.consecutive_failures = 0
+        # Zero while the circuit is closed
+        self.circuit_open_until = 0.0
+        # The number of the trial request let through a half open circuit, zero while no trial is in flight
+        self.circuit_trial = 0
+        self.circuit_trials = 0
+        # Trials in a row that failed, each doubling the time the circuit stays open
+        self.circuit_reopens = 0
+        self.throttled = 0
+        self.waits = 0
+        self.waited_secs = 0.0
+        self.retry_afters = 0
+        self.circuit_opens = 0
+
+    # Blocks until the request may be sent, or raises RequestThrottled if it should not be sent now. Returns the trial
+    # number to pass to record_response if the request is the trial through a half open circuit, otherwise 0
+    def acquire(self, key, priority=False):
+        trial = 0
+        with self.lock:
+            if (not priority):
+                reason, until = self.check_blocked(key, time.time())
+                if (reason is not None):
+                    self.throttled += 1
+                    raise RequestThrottled(self.name + " " + key + " held back by " + reason + " for "
+                        + str(round(until - time.time(), 1)) + "s")
+                # Every other poll is held back while a trial is in flight, so a poll let through then is the trial
+                trial = self.circuit_trial
+            else:
+                self.priority_waiting += 1
+        try:
+            if (priority):
+                self.wait_for_retry_after(key)
+            self.take_token(priority)
+        finally:
+            if (priority):
+                with self.lock:
+                    self.priority_waiting -= 1
+        return trial
+
+    # Returns why and until when a poll is blocked, and lets a single trial request through a circuit that is ready to close
+    def check_blocked(self, key, now):
+        if (now < self.retry_after_until):
+            return "Retry-After", self.retry_after_until
+        failures, backoff_until = self.backoffs.get(key, (0, 0.0))
+        if (now < backoff_until):
+            return "backoff after " + str(failures) + " failures", backoff_until
+        if (self.circuit_open_until > 0):
+            if ((now < self.circuit_open_until) or self.circuit_trial):
+                return "open circuit", max(self.circuit_open_until, now)
+            self.circuit_trials += 1
+            self.circuit_trial = self.circuit_trials
+        return None, now
+
+    def wait_for_retry_after(self, key):
+        wait = self.retry_after_until - time.time()
+        if (wait > HTTP_PRIORITY_MAX_WAIT_SECS):
+            with self.lock:
+                self.throttled += 1
+            raise RequestThrottled(self.name + " " + key + " held back by Retry-After for " + str(round(wait, 1)) + "s")
+        if (wait > 0):
+            self.record_wait(wait)
+            time.sleep(wait)
+
+    # Takes a token from the bucket, waiting for one if needed. Polls leave the reserve alone and give way to any waiting
+    # priority request
+    def take_token(self, priority):
+        while (True):
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate_per_sec)
+                self.refilled_at = now
+                needed = 1 if priority else 1 + HTTP_PRIORITY_RESERVE
+                if ((self.tokens >= needed) and (priority or (self.priority_waiting == 0))):
+                    self.tokens -= 1
+                    return
+                wait = max((needed - self.tokens) / self.rate_per_sec, 0.01)
+            self.record_wait(wait)
+            time.sleep(wait)
+
+    def record_wait(self, wait):
+        with self.lock:
+            self.waits += 1
+            self.waited_secs += wait
+
+    # Updates the backoff, Retry-After and circuit breaker state from a response, or from a failed request if it is None.
+    # A 408 only backs off its own endpoint, since it means that one car is asleep rather than the API is failing. trial
+    # is the number acquire returned for the request
+    def record_response(self, key, response, trial=0):
+        status_code = None if (response is None) else response.status_code
+        failed = ((status_code is None) or (status_code == 429) or (status_code >= 500))
+        with self.lock:
+            now = time.time()
+            if (failed or (status_code == 408)):
+                failures = self.backoffs.get(key, (0, 0.0))[0] + 1
+                delay = min(HTTP_BACKOFF_MAX_SECS, HTTP_BACKOFF_BASE_SECS * (2 ** (failures - 1))) * random.uniform(0.5, 1.0)
+                self.backoffs[key] = (failures, now + delay)
+            else:
+                self.backoffs.pop(key, None)
+            if (status_code == 429):
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                if (retry_after is None):
+                    retry_after = self.backoffs[key][1] - now
+                self.retry_after_until = max(self.retry_after_until, now + retry_after)
+                self.retry_afters += 1
+                logging.error(self.name + " API rate limited, pausing requests for " + str(round(retry_after, 1)) + "s")
+            # Only the trial request through a half open circuit settles it, not a priority request that bypassed it. Any
+            # answer from the API, a 408 included, closes it and a failure opens it again for twice as long as before
+            trial = ((trial > 0) and (trial == self.circuit_trial))
+            if (trial):
+                self.circuit_trial = 0
+            if (failed):
+                self.consecutive_failures += 1
+                if (trial or ((self.circuit_open_until == 0) and (self.consecutive_failures >= HTTP_CIRCUIT_FAILURE_THRESHOLD))):
+                    if (trial):
+                        self.circuit_reopens += 1
+                    open_secs = min(HTTP_BACKOFF_MAX_SECS, HTTP_CIRCUIT_OPEN_SECS * (2 ** self.circuit_reopens))
+                    self.circuit_open_until = now + open_secs
+                    self.circuit_opens += 1
+                    logging.error(self.name + " API failed " + str(self.consecutive_failures) + " times in a row, opening circuit for "
+                        + str(open_secs) + "s")
+            elif (trial or ((self.circuit_open_until == 0) and (status_code != 408))):
+                self.consecutive_failures = 0
+                if (self.circuit_open_until > 0):
+                    logging.info(self.name + " API recovered, closing circuit")
+                self.circuit_open_until = 0.0
+                self.circuit_reopens = 0
+
+    # Returns a one line summary of the requests held back and the time spent waiting for tokens
+    def stats_summary(self):
+        with self.lock:
+            return (self.name + " Scheduler: " + str(self.throttled) + " requests held back | " + str(self.waits) + " waits, "
+                + str(round(self.waited_secs, 1)) + "s total | " + str(self.retry_afters) + " rate limits | " + str(self.circuit_opens)
+                + " circuit opens | " + str(len(self.backoffs)) + " endpoints backing off")
+
+# HTTP Clients
+# Pooled keep-alive HTTP client with per-endpoint timeouts, retries and connection reuse stats
+class HttpClient:
+    def __init__(self, name, base_url, timeouts, requests_per_sec, request_burst):
+        self.name = name
+        self.base_url = base_url
+        self.timeouts = timeouts
+        self.scheduler = RequestScheduler(name, requests_per_sec, request_burst)
+        # Connection errors are retried for every method, but only GETs are retried after the request was sent
+        # so a door command is never sent twice
+        retries = Retry(total=HTTP_RETRY_TOTAL, backoff_factor=HTTP_RETRY_BACKOFF_FACTOR, status_forcelist=HTTP_RETRY_STATUS_CODES,
+            allowed_methods=["GET"], raise_on_status=False)
+        self.adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retries)
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self.pool_connections = {}
+        self.tokens = None
+
+    # Sends a request to an endpoint with the current auth token. A 401 renews the token and retries the request once,
+    # which is the only time a request waits on a login. Login requests themselves pass auth=False and, like door
+    # commands, go through the scheduler with priority
+    def request(self, method, endpoint, url_params={}, auth=True, priority=False, **kwargs):
+        if ((not auth) or (self.tokens is None)):
+            return self.send(method, endpoint, url_params, priority=(priority or not auth), **kwargs)
+        headers = kwargs.pop("headers", {})
+        token = self.tokens.get_token()
+        response = self.send(method, endpoint, url_params, priority, headers=dict(headers, **self.auth_headers(token)), **kwargs)
+        if (response.status_code == 401):
+            logging.info(self.name + " rejected the auth token for " + endpoint + ", re-authenticating")
+            self.tokens.reauthenticate(token)
+            response = self.send(method, endpoint, url_params, priority, headers=dict(headers, **self.auth_headers(self.tokens.get_token())),
+                **kwargs)
+        return response
+
+    # Sends a request to an endpoint once the scheduler lets it through, filling in the {placeholders} in the endpoint
+    # path from url_params
+    def send(self, method, endpoint, url_params={}, priority=False, **kwargs):
+        path = endpoint
+        for key, value in url_params.items():
+            path = path.replace("{" + key + "}", str(value))
+        try:
+            trial = self.scheduler.acquire(method + " " + path, priority)
+        except RequestThrottled:
+            metrics_http_responses.inc((self.name, method, endpoint, "throttled"))
+            raise
+        start = time.time()
+        try:
+            response = self.session.request(method, self.base_url + path, timeout=self.timeouts.get(endpoint, HTTP_DEFAULT_TIMEOUT_SECS), **kwargs)
+        except Exception:
+            self.record_request(endpoint, None, time.time() - start)
+            self.scheduler.record_response(method + " " + path, None, trial)
+            metrics_http_responses.inc((self.name, method, endpoint, "error"))
+            raise
+        self.scheduler.record_response(method + " " + path, response, trial)
+        reused = self.check_connection_reused(response)
+        self.record_request(endpoint, reused, time.time() - start)
+        metrics_http_request_seconds.observe((self.name, method, endpoint), time.time() - start)
+        metrics_http_responses.inc((self.name, method, endpoint, str(response.status_code)))
+        if (trace_recorder is not None):
+            trace_recorder.record(self.name, method, endpoint, url_params, response)
+        logging.debug("%s %s %s: %d | Connection Reused: %s | %.3fs", self.name, method, endpoint, response.status_code, reused,
+            time.time() - start)
+        return response
+
+    def get(self, endpoint, url_params={}, **kwargs):
+        return self.request("GET", endpoint, url_params, **kwargs)
+
+    def post(self, endpoint, url_params={}, **kwargs):
+        return self.request("POST", endpoint, url_params, **kwargs)
+
+    def put(self, endpoint, url_params={}, **kwargs):
+        return self.request("PUT", endpoint, url_params, **kwargs)
+
+    # A response reused a pooled connection if its pool did not have to open a new one for it
+    def check_connection_reused(self, response):
+        pool = getattr(response.raw, "_pool", None)
+        if (pool is None):
+            return False
+        with self.stats_lock:
+            previous = self.pool_connections.get(id(pool), 0)
+            self.pool_connections[id(pool)] = pool.num_connections
+        return (pool.num_connections == previous)
+
+    # Tracks request counts, connection reuse, errors and time spent per endpoint. reused is None for failed requests
+    def record_request(self, endpoint, reused, elapsed):
+        with self.stats_lock:
+            stats = self.stats.setdefault(endpoint, {"requests": 0, "reused": 0, "errors": 0, "seconds": 0.0})
+            stats["requests"] += 1
+            stats["seconds"] += elapsed
+            if (reused is None):
+                stats["errors"] += 1
+            elif (reused):
+                stats["reused"] += 1
+
+    # Returns a one line summary of the request stats for each endpoint
+    def stats_summary(self):
+        summary = []
+        with self.stats_lock:
+            for endpoint, stats in self.stats.items():
+                average_ms = round(1000 * stats["seconds"] / stats["requests"])
+                summary.append(endpoint + ": " + str(stats["requests"]) + " requests, " + str(stats["reused"]) + " reused, "
+                    + str(stats["errors"]) + " errors, " + str(average_ms) + "ms avg")
+        return self.name + " HTTP Stats: " + " | ".join(summary)
+
+# HTTP client for the Tesla Owner API
+class TeslaClient(HttpClient):
+    def __init__(self):
+        super().__init__("Tesla", TESLA_BASE_API_URL, TESLA_ENDPOINT_TIMEOUTS, TESLA_REQUESTS_PER_SEC, TESLA_REQUEST_BURST)
+        self.tokens = TeslaTokenManager()
+
+    def auth_headers(self, token):
+        return {"Authorization": "Bearer " + token, "Content-Type": "application/json"}
+
+# HTTP client for the MyQ API
+class MyQClient(HttpClient):
+    def __init__(self):
+        super().__init__("MyQ", MYQ_BASE_API_URL, MYQ_ENDPOINT_TIMEOUTS, MYQ_REQUESTS_PER_SEC, MYQ_REQUEST_BURST)
+        self.tokens = MyQTokenManager()
+
+    def auth_headers(self, token):
+        return {"SecurityToken": token, "MyQApplicationId": MYQ_APP_ID}
+
+tesla_client = TeslaClient()
+myq_client = MyQClient()
+
+# Trace Recording
+# Appends each response to the trace file as one compact JSON line
+class TraceRecorder:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.file = gzip.open(file_name, "at", encoding="utf-8")
+        self.lock = threading.Lock()
+        self.last_flush = time.time()
+        self.entries = 0
+
+    def record(self, provider, method, endpoint, url_params, response):
+        body = None
+        if (endpoint not in TRACE_REDACTED_ENDPOINTS):
+            body = response.text
+        entry = {"t": round(time.time(), 3), "p": provider, "m": method, "e": endpoint, "u": url_params,
+            "s": response.status_code, "b": body}
+        line = json.dumps(entry, separators=(",", ":"))
+        with self.lock:
+            self.file.write(line + "\n")
+            self.entries += 1
+            if ((time.time() - self.last_flush) >= TRACE_FLUSH_SECS):
+                self.file.flush()
+                self.last_flush = time.time()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+# Starts recording a trace if TRACE_RECORD_FILE is set
+def trace_init():
+    global trace_recorder
+
+    if (len(TRACE_RECORD_FILE) > 0):
+        logging.info("Recording Trace To: " + TRACE_RECORD_FILE)
+        trace_recorder = TraceRecorder(TRACE_RECORD_FILE)
+
+# Telemetry History
+# Append only store of fixed width records. Each series (a vehicle or a door) has one file per UTC day, written through a
+# buffered file that is flushed every TELEMETRY_HISTORY_FLUSH_SECS. Reads memory map the day files and search them by time
+class HistoryStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self.formats = {kind: struct.Struct("<" + "".join(HISTORY_STRUCT_CODES[numpy_type] for _, numpy_type in fields))
+            for kind, fields in TELEMETRY_HISTORY_FIELDS.items()}
+        self.lock = threading.Lock()
+        # (kind, key) -> (day, open file)
+        self.files = {}
+        self.last_flush = time.time()
+        self.pruned_day = ""
+        self.records = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, kind, key, day):
+        safe_key = "".join(c if (c.isalnum() or (c in "-_")) else "_" for c in str(key))
+        return os.path.join(self.directory, kind + "-" + safe_key + "-" + day + ".bin")
+
+    def append(self, kind, key, values):
+        record = self.formats[kind].pack(*values)
+        day = history_day(values[0])
+        with self.lock:
+            entry = self.files.get((kind, key))
+            if ((entry is None) or (entry[0] != day)):
+                if (entry is not None):
+                    entry[1].close()
+                entry = (day, self.open(kind, key, day))
+                self.files[(kind, key)] = entry
+            entry[1].write(record)
+            self.records += 1
+            if ((time.time() - self.last_flush) >= TELEMETRY_HISTORY_FLUSH_SECS):
+                self.flush_files()
+
+    # Opens a day file for appending, dropping any record a crash cut short
+    def open(self, kind, key, day):
+        path = self.path(kind, key, day)
+        if (os.path.exists(path)):
+            partial = os.path.getsize(path) % self.formats[kind].size
+            if (partial > 0):
+                os.truncate(path, os.path.getsize(path) - partial)
+        return open(path, "ab")
+
+    def flush(self):
+        with self.lock:
+            self.flush_files()
+
+    def flush_files(self):
+        for _, history_file in self.files.values():
+            history_file.flush()
+        self.last_flush = time.time()
+
+    def close(self):
+        with self.lock:
+            for _, history_file in self.files.values():
+                history_file.close()
+            self.files.clear()
+
+    # Writes out and closes a single series' day file, so another process can append to it
+    def release(self, kind, key):
+        with self.lock:
+            entry = self.files.pop((kind, key), None)
+            if (entry is not None):
+                entry[1].close()
+
+    # Returns a series' records with start <= t < end as a NumPy structured array with the TELEMETRY_HISTORY_FIELDS
+    def query(self, kind, key, start, end):
+        if (np is None):
+            raise ImportError("NumPy is required to query the telemetry history")
+        self.flush()
+        dtype = np.dtype(TELEMETRY_HISTORY_FIELDS[kind])
+        parts = []
+        day_start = start - (start % 86400)
+        while (day_start < end):
+            path = self.path(kind, key, history_day(day_start))
+            count = (os.path.getsize(path) // dtype.itemsize) if os.path.exists(path) else 0
+            if (count > 0):
+                records = np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+                first, last = np.searchsorted(records["t"], [start, end], side="left")
+                parts.append(np.array(records[first:last]))
+                del records
+            day_start += 86400
+        if (len(parts) == 0):
+            return np.zeros(0, dtype=dtype)
+        return np.concatenate(parts)
+
+    # Deletes the day files older than TELEMETRY_HISTORY_RETENTION_DAYS, once a day
+    def prune(self):
+        today = history_day(time.time())
+        if (today == self.pruned_day):
+            return
+        self.pruned_day = today
+        oldest_day = history_day(time.time() - TELEMETRY_HISTORY_RETENTION_DAYS * 86400)
+        for file_name in os.listdir(self.directory):
+            if (file_name.endswith(".bin") and (file_name[-12:-4] < oldest_day)):
+                # Fleet workers share the directory, and another one may have just removed it
+                try:
+                    os.remove(os.path.join(self.directory, file_name))
+                except FileNotFoundError:
+                    pass
+
+HISTORY_STRUCT_CODES = {"<f8": "d", "<f4": "f", "<i4": "i", "<u2": "H", "u1": "B"}
+
+# UTC day of a timestamp, as named in the history files
+def history_day(timestamp):
+    return time.strftime("%Y%m%d", time.gmtime(timestamp))
+
+# Opens the telemetry history if TELEMETRY_HISTORY_DIR is set
+def history_init():
+    global history_store
+
+    if (len(TELEMETRY_HISTORY_DIR) > 0):
+        try:
+            history_store = HistoryStore(TELEMETRY_HISTORY_DIR)
+            logging.info("Recording Telemetry History To: " + TELEMETRY_HISTORY_DIR)
+        except OSError as e:
+            logging.error("Unable to open the telemetry history: " + str(e))
+
+def history_record_vehicle_sample(vehicle, sample):
+    if (history_store is None):
+        return
+    door_state = vehicle.door.state if (vehicle.door is not None) else ""
+    history_store.append("vehicle", vehicle.id, (sample.timestamp, round(sample.latitude * 1e7), round(sample.longitude * 1e7),
+        vehicle.distance_from_home, min(max(round(sample.speed * 10), 0), 65535), round(sample.heading) % 360,
+        SHIFT_STATES.index(sample.shift_state), history_door_state_code(door_state)))
+
+def history_record_door_event(door, state, action=""):
+    if (history_store is not None):
+        history_store.append("door", door.serial, (time.time(), history_door_state_code(state), TELEMETRY_HISTORY_DOOR_ACTIONS.index(action)))
+
+def history_door_state_code(state):
+    if (state in TELEMETRY_HISTORY_DOOR_STATES):
+        return TELEMETRY_HISTORY_DOOR_STATES.index(state)
+    return TELEMETRY_HISTORY_DOOR_STATES.index("unknown")
+
+# Writes out the buffered history of cars and doors that went quiet and drops expired day files
+def history_maintain():
+    history_store.flush()
+    history_store.prune()
+
+# Returns a car's samples from start to end (epoch seconds) as NumPy arrays in degrees, MPH and feet, with the shift and
+# door states as indexes into SHIFT_STATES and TELEMETRY_HISTORY_DOOR_STATES
+def history_vehicle_samples(vehicle_id, start, end):
+    records = history_store.query("vehicle", vehicle_id, start, end)
+    return {
+        "t": records["t"],
+        "latitude": records["lat"] / 1e7,
+        "longitude": records["lon"] / 1e7,
+        "distance_ft": records["distance_ft"].astype(np.float64),
+        "speed": records["speed"] / 10,
+        "heading": records["heading"].astype(np.float64),
+        "shift": records["shift"],
+        "door": records["door"]
+    }
+
+# Returns a door's events from start to end as NumPy arrays, with the states and commands as indexes into
+# TELEMETRY_HISTORY_DOOR_STATES and TELEMETRY_HISTORY_DOOR_ACTIONS
+def history_door_events(serial, start, end):
+    records = history_store.query("door", serial, start, end)
+    return {"t": records["t"], "state": records["state"], "action": records["action"]}
+
+# Periodically logs the Tesla request savings and the HTTP client stats
+def log_request_stats():
+    global http_stats_last_log
+
+    if ((time.time() - http_stats_last_log) >= HTTP_STATS_LOG_INTERVAL_SECS):
+        http_stats_last_log = time.time()
+        logging.info("Tesla Data Requests Made: " + str(tesla_requests_made) + " | Requests Saved: " + str(tesla_requests_saved))
+        logging.info("Tesla Online Gate: " + str(tesla_requests_avoided) + " data requests avoided | " + str(tesla_408s_eliminated)
+            + " 408s eliminated | " + str(tesla_online_checks) + " listing requests | " + str(tesla_408s_received) + " 408s received")
+        logging.info(tesla_client.stats_summary())
+        logging.info(myq_client.stats_summary())
+        logging.info(tesla_client.tokens.stats_summary())
+        logging.info(myq_client.tokens.stats_summary())
+        logging.info(tesla_client.scheduler.stats_summary())
+        logging.info(myq_client.scheduler.stats_summary())
+        for vehicle in tesla_vehicles.values():
+            logging.info(tesla_poll_stats_summary(vehicle))
+        for door in myq_doors.values():
+            logging.info(myq_door_timing_summary(door))
+
+# Fast Response Decoding
+# Parses a JSON response body straight from its bytes, skipping the str decode of response.text, with orjson when it
+# is installed
+def json_from_bytes(content):
+    if (orjson is not None):
+        return orjson.loads(content)
+    return json.loads(content)
+
 # Tesla Functions
-# Gets a Tesla Auth Token
+# Gets a Tesla Auth Token with the account password
 def tesla_login(email, password):
-    global tesla_auth_token
-    global tesla_refresh_token
-    global tesla_auth_header
-    global tesla_refresh_token
-    global tesla_token_timeout
-    global tesla_token_start_time
-
     body = {
         "grant_type": "password",
         "client_id": TESLA_CLIENT_ID,
@@ -152,294 +2287,449 @@ def tesla_login(email, password):
         "email": email,
         "password": password
     }
-    try:
-        logging.info("Getting Tesla Auth Token")
-        response = requests.post(TESLA_BASE_API_URL + TESLA_AQUIRE_TOKEN, None, json=body, timeout=3)
-        resp = json.loads(response.text)
-        tesla_auth_token = resp["access_token"]
-        tesla_refresh_token = resp["refresh_token"]
-        tesla_token_timeout = resp["expires_in"]
-        tesla_auth_header = {
-            "Authorization": "Bearer " + tesla_auth_token,
-            "Content-Type": "application/json"
-        }
-        logging.info("Tesla Auth Token Aquired")
-        tesla_token_start_time = time.time()
-    except Exception as e:
-        print(e)
-        print_error_and_exit("Failed to get Tesla Auth Token " + str(response))
+    logging.info("Getting Tesla Auth Token")
+    response = tesla_client.post(TESLA_AQUIRE_TOKEN, auth=False, json=body)
+    if (response.status_code != 200):
+        raise AuthError("Failed to get Tesla Auth Token: " + str(response.status_code))
+    logging.info("Tesla Auth Token Aquired")
+    return tesla_parse_token_response(response)
 
 # Refreshes the Tesla Auth Token
-def tesla_refresh_auth_token():
-    global tesla_auth_token
-    global tesla_refresh_token
-    global tesla_auth_header
-    global tesla_refresh_token
-    global tesla_token_timeout
-    global tesla_token_start_time
-
+def tesla_refresh_auth_token(refresh_token):
     body = {
         "grant_type": "refresh_token",
         "client_id": TESLA_CLIENT_ID,
         "client_secret": TESLA_CLIENT_SECRET,
-        "refresh_token": tesla_refresh_token
+        "refresh_token": refresh_token
     }
-    try:
-        logging.info("Refreshing Tesla Auth Token")
-        response = requests.post(TESLA_BASE_API_URL + TESLA_REFRESH_TOKEN, None, json=body)
-        resp = json.loads(response.text)
-        tesla_auth_token = resp["access_token"]
-        tesla_refresh_token = resp["refresh_token"]
-        tesla_token_timeout = resp["expires_in"]
-        tesla_auth_header = {
-            "Authorization": "Bearer " + tesla_auth_token,
-            "Content-Type": "application/json"
-        }
-        logging.info("Successfully Refreshed Tesla Auth Token")
-        tesla_token_start_time = time.time()
-    except:
-        logging.error("Failed to Refresh Tesla Auth Token: " + str(response.status_code))
-
-# Checks if the Tesla Auth Token is about to expire and refreshes it if needed
-def tesla_check_token_expired():
-    while (True):
-        now = time.time()
-        elapsed = now - tesla_token_start_time
-        # Refresh if the token will expire within a day
-        if ((tesla_token_timeout - elapsed) <= 24 * 60 * 60):
-            tesla_refresh_auth_token()
-        time.sleep(TESLA_TOKEN_EXPIRE_CHECK_SECS)
-
-# Gets all the vehicle IDs for the account
+    logging.info("Refreshing Tesla Auth Token")
+    response = tesla_client.post(TESLA_REFRESH_TOKEN, auth=False, json=body)
+    if (response.status_code != 200):
+        raise AuthError("Failed to Refresh Tesla Auth Token: " + str(response.status_code))
+    logging.info("Successfully Refreshed Tesla Auth Token")
+    return tesla_parse_token_response(response)
+
+def tesla_parse_token_response(response):
+    resp = json_from_bytes(response.content)
+    return {"access_token": resp["access_token"], "refresh_token": resp["refresh_token"], "expires_in": resp["expires_in"]}
+
+# Gets all the vehicles for the account. A failed listing is tried again with backoff, since the app has nothing to do
+# without its cars
 def tesla_get_vehicles():
-    global tesla_vehicle_ids
-
-    try:
-        logging.info("Getting Tesla Vehicles...")
-        response = requests.get(TESLA_BASE_API_URL + TESLA_VEHICLES, headers=tesla_auth_header)
-        resp = json.loads(response.text)
-        for vehicle in resp['response']:
-            tesla_vehicle_ids.append(vehicle["id"])
-        logging.info("Successfully Acquired Tesla Vehicle IDs")
-    except:
-        print_error_and_exit("Failed to get Tesla Vehicle IDs: " + str(response.status_code))
-
-# Gets data indicating whether the charger is connected to the car
-def tesla_get_charger_connected():
-    global tesla_charger_connected
-
-    # Since this call returns an error fairly often, default to Disconnected in those cases so the logic to detect
-    # when the car leaves has a better chance of working
-    tesla_charger_connected = False
-    try:
-        url = TESLA_BASE_API_URL + TESLA_VEHICLE_DATA
-        #NOTE: Currently only works with a single vehicle ID
-        for id in tesla_vehicle_ids:
-            response = requests.get(url.replace("{id}", str(id)), headers=tesla_auth_header)
-            if (response.status_code == 200):
-                resp = json.loads(response.text)
-                if(tesla_is_vehicle_available(resp)):
-                    if ("Disconnected" not in resp['response']['charge_state']['charging_state']):
-                        tesla_charger_connected = True
-            else:
-                if (response.status_code != 408):
-                    logging.error("Failed to get Tesla Charging State: " + str(response.status_code))
-    except:
-        logging.info("Failed to get Tesla Charging State: " + str(response.status_code))
-
-# Gets data indicating whether the driver is present
-def tesla_get_driver_present():
-    global tesla_driver_present
-
-    try:
-        url = TESLA_BASE_API_URL + TESLA_VEHICLE_STATE
-        #NOTE: Currently only works with a single vehicle ID
-        for id in tesla_vehicle_ids:
-            response = requests.get(url.replace("{id}", str(id)), headers=tesla_auth_header)
+    logging.info("Getting Tesla Vehicles...")
+    for attempt in range(1, TESLA_GET_VEHICLES_ATTEMPTS + 1):
+        error = None
+        try:
+            response = tesla_client.get(TESLA_VEHICLES)
             if (response.status_code == 200):
-                resp = json.loads(response.text)
-                if(tesla_is_vehicle_available(resp)):
-                    tesla_driver_present = resp['response']['is_user_present']
+                resp = json_from_bytes(response.content)
+                vehicles = [(vehicle["id"], vehicle.get("display_name") or str(vehicle["id"])) for vehicle in resp['response']]
             else:
-                if (response.status_code != 408):
-                    logging.error("Failed to get Tesla Driver State: " + str(response.status_code))
-    except:
-        logging.error("Failed to get Tesla Driver State: " + str(response.status_code))
+                error = "HTTP " + str(response.status_code)
+        except (RequestThrottled, requests.RequestException, ValueError, KeyError, TypeError) as e:
+            error = str(e)
+        if (error is None):
+            for vehicle_id, name in vehicles:
+                tesla_vehicles[vehicle_id] = Vehicle(vehicle_id, name)
+            tesla_update_online_states(resp)
+            logging.info("Successfully Acquired Tesla Vehicle IDs")
+            return
+        logging.error("Failed to get Tesla Vehicle IDs (attempt " + str(attempt) + " of " + str(TESLA_GET_VEHICLES_ATTEMPTS) + "): " + error)
+        if (attempt < TESLA_GET_VEHICLES_ATTEMPTS):
+            time.sleep(min(HTTP_BACKOFF_MAX_SECS, HTTP_BACKOFF_BASE_SECS * (2 ** (attempt - 1))))
+    print_error_and_exit("Failed to get Tesla Vehicle IDs after " + str(TESLA_GET_VEHICLES_ATTEMPTS) + " attempts")
+
+# Records the online state the vehicle listing reports for every car. A car that wakes up goes straight back to fast
+# polling, and a car that falls asleep stops getting data requests
+def tesla_update_online_states(resp):
+    for listing in resp['response']:
+        vehicle = tesla_vehicles.get(listing["id"])
+        if (vehicle is None):
+            continue
+        vehicle.stream_id = listing.get("vehicle_id", vehicle.stream_id)
+        if (listing.get("state") == vehicle.online_state):
+            continue
+        previous_state = vehicle.online_state
+        vehicle.online_state = listing.get("state")
+        if (vehicle.online_state == "online"):
+            vehicle.awake = True
+            if (previous_state is not None):
+                logging.info(vehicle.name + " woke up, polling fast")
+                tesla_set_desired_poll_interval(vehicle, TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_FAST)
+        else:
+            logging.info(vehicle.name + " is " + str(vehicle.online_state))
+            vehicle.awake = False
+            tesla_set_desired_poll_interval(vehicle, TESLA_ASLEEP_POLL_INTERVAL_SECS)
+        status_publish_vehicle(vehicle)
+
+# Refreshes the online states from the vehicle listing unless another poll just did. Returns whether the states are current
+def tesla_refresh_online_states():
+    global tesla_online_checks
+    global tesla_online_checked_at
+
+    with tesla_online_state_lock:
+        if ((time.time() - tesla_online_checked_at) < TESLA_ONLINE_STATE_MAX_AGE_SECS):
+            return True
+        try:
+            response = tesla_client.get(TESLA_VEHICLES)
+            tesla_online_checks += 1
+            if (response.status_code != 200):
+                logging.error("Failed to get Tesla Vehicle States: " + str(response.status_code))
+                return False
+            tesla_update_online_states(json_from_bytes(response.content))
+            tesla_online_checked_at = time.time()
+            return True
+        except RequestThrottled as e:
+            logging.info("Skipped Tesla vehicle state check: " + str(e))
+        except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+            logging.error("Failed to get Tesla Vehicle States: " + str(e))
+        return False
 
-# Gets drive data and logs it, including previously fetched charger and driver states
-def tesla_get_drive_state():
-    global tesla_awake
-    global tests_speed
-    global tesla_shift_state
-    global tesla_last_data_update
+# Polls a car's data if it is online. Cars known to be asleep or offline only get the shared listing check
+def tesla_poll_vehicle(vehicle):
+    global tesla_requests_avoided
+    global tesla_408s_eliminated
+
+    if (tesla_is_streaming(vehicle)):
+        metrics_vehicle_polls.inc((vehicle.name, "streamed"))
+        vehicle.last_data_update = time.time()
+        return
+    if (vehicle.online_state not in (None, "online")):
+        if (not tesla_refresh_online_states()):
+            metrics_vehicle_polls.inc((vehicle.name, "listing_failed"))
+            return
+        if (vehicle.online_state != "online"):
+            metrics_vehicle_polls.inc((vehicle.name, str(vehicle.online_state)))
+            tesla_requests_avoided += 1
+            if (vehicle.online_state == "asleep"):
+                tesla_408s_eliminated += 1
+            # The listing answered for the car, so its data is not stale
+            vehicle.last_data_update = time.time()
+            return
+    metrics_vehicle_polls.inc((vehicle.name, "requested"))
+    tesla_get_vehicle_data(vehicle)
+
+# Builds the vehicle_data query parameters for the configured endpoint selection
+def tesla_vehicle_data_params():
+    if (len(TESLA_VEHICLE_DATA_ENDPOINTS) > 0):
+        return {"endpoints": ";".join(TESLA_VEHICLE_DATA_ENDPOINTS)}
+    return {}
+
+# Builds a single consistent vehicle sample from the bytes of a vehicle_data response, or returns None if the vehicle
+# is unavailable. The parsed tree is dropped as soon as the sample's fields are read out of it
+def tesla_decode_vehicle_data(content):
+    resp = json_from_bytes(content)
+    if (not tesla_is_vehicle_available(resp)):
+        return None
+    data = resp['response']
+    drive_state = data['drive_state']
+    # Sections left out of the endpoint selection fall back to the same defaults used when their calls failed
+    vehicle_state = data.get('vehicle_state') or {}
+    charge_state = data.get('charge_state') or {}
+    return VehicleSample(
+        bool(vehicle_state.get('is_user_present', False)),
+        ("Disconnected" not in str(charge_state.get('charging_state', "Disconnected"))),
+        shift_state(drive_state['shift_state']),
+        drive_state['speed'] or 0,
+        drive_state.get('heading') or 0,
+        drive_state['latitude'],
+        drive_state['longitude'],
+        time.time())
+
+# Applies one sample, polled or streamed, to a car's state and logs it
+def tesla_apply_sample(vehicle, sample):
+    if ((vehicle.sample is not None) and (sample.timestamp < vehicle.sample.timestamp)):
+        return
+    vehicle.sample = sample
+    vehicle.awake = True
+    vehicle.driver_present = sample.driver_present
+    vehicle.charger_connected = sample.charger_connected
+    vehicle.shift_state = sample.shift_state
+    vehicle.speed = sample.speed
+    calculate_current_distance_from_home_feet(vehicle, sample.latitude, sample.longitude)
+    tesla_update_motion(vehicle, sample)
+    vehicle.has_data = True
+    closing_speed = tesla_closing_speed(vehicle)
+    if (logging.getLogger().isEnabledFor(logging.INFO)):
+        logging.info("Tesla State (%s): %s | Driver Present: %s | Charger: %s | Speed: %sMPH | Location: %s | %sFT from Home"
+            + " | Closing: %.1fFT/S", vehicle.name, vehicle.shift_state, "YES" if vehicle.driver_present else "NO",
+            "Connected" if vehicle.charger_connected else "Disconnected", sample.speed, tesla_get_relative_location(vehicle),
+            vehicle.distance_from_home, closing_speed)
+    telemetry_log("vehicle_sample", vehicle=vehicle.name, shift=vehicle.shift_state, driver=vehicle.driver_present,
+        charger=vehicle.charger_connected, speed=sample.speed, heading=sample.heading, lat=sample.latitude,
+        lon=sample.longitude, distance_ft=vehicle.distance_from_home, closing_fps=round(closing_speed, 1),
+        sampled_at=sample.timestamp)
+    history_record_vehicle_sample(vehicle, sample)
+    status_publish_vehicle(vehicle)
+
+# Gets the driver, charger and drive data for a car in one request and logs it
+def tesla_get_vehicle_data(vehicle):
+    global tesla_requests_made
+    global tesla_requests_saved
+    global tesla_408s_received
 
     try:
-        url = TESLA_BASE_API_URL + TESLA_DRIVE_STATE
-        #NOTE: Currenlty only works with a single vehicle ID
-        for id in tesla_vehicle_ids:
-            response = requests.get(url.replace("{id}", str(id)), headers=tesla_auth_header)
-            resp = json.loads(response.text)
-            if (tesla_is_vehicle_available(resp) and response.status_code == 200):
-                tesla_latitude = 0.0
-                tesla_longitude = 0.0
-                tesla_speed = 0
-                tesla_awake = True
-                if (resp['response']['speed']):
-                    tesla_speed = resp['response']['speed']
-                tesla_shift_state = shift_state(resp['response']['shift_state'])
-                tesla_latitude = resp['response']['latitude']
-                tesla_longitude = resp['response']['longitude']
-                calculate_current_distance_from_home_feet(tesla_latitude, tesla_longitude)
-                relative_location = tesla_get_relative_location()
-                    
-                charger = "Disconnected"
-                if (tesla_charger_connected):
-                    charger = "Connected"
-                driver_present = "NO"
-                if (tesla_driver_present):
-                    driver_present = "YES"
-
-                logging.info("Tesla State: " + tesla_shift_state + " | Driver Present: " + driver_present + " | " + "Charger: " + charger + " | Speed: "
-                    + str(tesla_speed) + "MPH | " + " Location: " + relative_location + " | " + str(distance_from_home) + "FT from Home")
-            else:
-                if (response.status_code == 408):
-                    logging.info("Unable to get drive state. Car is likely asleep")
-                    tesla_awake = False
-                else:
-                    logging.error("Failed to get Tesla Drive State: " + str(response.status_code))
-            tesla_last_data_update = time.time()
+        response = tesla_client.get(TESLA_VEHICLE_DATA, {"id": vehicle.id}, params=tesla_vehicle_data_params())
+        tesla_requests_made += 1
+        if (response.status_code == 200):
+            # The per-state requests this one replaced would have stopped at the first one that failed
+            tesla_requests_saved += TESLA_LEGACY_REQUESTS_PER_TICK - 1
+            sample = tesla_decode_vehicle_data(response.content)
+            if (sample is not None):
+                tesla_apply_sample(vehicle, sample)
+        elif (response.status_code == 408):
+            logging.info("Unable to get vehicle data for " + vehicle.name + ". Car is likely asleep")
+            vehicle.awake = False
+            vehicle.online_state = "asleep"
+            tesla_408s_received += 1
+            status_publish_vehicle(vehicle)
+        else:
+            logging.error("Failed to get Tesla Vehicle Data for " + vehicle.name + ": " + str(response.status_code))
+        vehicle.last_data_update = time.time()
+    except RequestThrottled as e:
+        logging.info("Skipped vehicle data poll for " + vehicle.name + ": " + str(e))
     except Exception as e:
-        print(e)
-        logging.exception("Failed to get Tesla Drive State: " + str(e))
+        logging.exception("Failed to get Tesla Vehicle Data for " + vehicle.name + ": " + str(e))
 
-# If the app gets into a state where new data is not being captured, force a restart
-def tesla_check_for_stale_data():
-    if ((time.time() - tesla_last_data_update) > TESLA_STALE_DATA_THRESHOLD_SECS):
-        print_error_and_exit("Stale data detected that is older than " + str(TESLA_STALE_DATA_THRESHOLD_SECS)
-            + " seconds. Exiting...")
+# Determines whether a car's data has stopped coming in, so its poller can be restarted
+def tesla_check_for_stale_data(vehicle):
+    if ((time.time() - vehicle.last_data_update) > TESLA_STALE_DATA_THRESHOLD_SECS):
+        logging.error("Stale data detected for " + vehicle.name + " that is older than " + str(TESLA_STALE_DATA_THRESHOLD_SECS) + " seconds")
+        return True
+    return False
 
 # Determines whether the response from Tesla indicates the data is unavailable
 def tesla_is_vehicle_available(message):
     return not ("vehicle unavailable" in message)
 
-# Determines if the data fetch interval should decrease
-def tesla_check_if_fetch_interval_should_change_to_slow():
-    # Car is asleep, far away, or at home with no driver, slow vehicle data interval to prevent keeping the car awake
-    return ((not tesla_awake) or tesla_is_far_away() or (tesla_is_vehicle_home() and not tesla_driver_present))
-
-# Determines if the data fetch interval should increase
-def tesla_check_if_fetch_interval_should_change_to_fast():
-    # Car is driver is present and the car is nearby or the door is open
-    return ((tesla_driver_present and not tesla_is_far_away()) or myq_door_open())
-
 # Returns the distance in feet the GPS coordinates are from Home
-def calculate_current_distance_from_home_feet(latitude, longitude):
-    global distance_from_home
+def calculate_current_distance_from_home_feet(vehicle, latitude, longitude):
     if ((latitude == 0.0) or (longitude == 0.0)):
-        print_error_and_exit("Tesla Location Data Invalid")
-    tesla_location = (latitude, longitude)
-    distance_from_home = round(distance.distance(HOME_LOCATION, tesla_location).feet, 2)
+        raise ValueError("Tesla Location Data Invalid")
+    vehicle.distance_from_home = round(tesla_vehicle_home(vehicle).distance_feet(latitude, longitude), 2)
 
 # Returns relative distance from home - HOME
-def tesla_is_vehicle_home():
-    return (distance_from_home <= HOME_GEO_FENCE_FT)
+def tesla_is_vehicle_home(vehicle):
+    return (vehicle.distance_from_home <= HOME_GEO_FENCE_FT)
 
 # Returns relative distance from home - NEARBY
-def tesla_is_vehicle_nearby():
-    return (distance_from_home >= HOME_GEO_FENCE_FT) and (distance_from_home <= AWAY_GEO_FENCE_FT)
+def tesla_is_vehicle_nearby(vehicle):
+    return (vehicle.distance_from_home >= HOME_GEO_FENCE_FT) and (vehicle.distance_from_home <= AWAY_GEO_FENCE_FT)
 
 # Returns relative distance from home - AWAY
-def tesla_is_vehicle_away():
-    return (distance_from_home >= AWAY_GEO_FENCE_FT) and (distance_from_home <= FAR_AWAY_GEO_FENCE_FT)
+def tesla_is_vehicle_away(vehicle):
+    return (vehicle.distance_from_home >= AWAY_GEO_FENCE_FT) and (vehicle.distance_from_home <= FAR_AWAY_GEO_FENCE_FT)
 
 # Returns relative distance from home - FAR AWAY
-def tesla_is_far_away():
-    return (distance_from_home >= FAR_AWAY_GEO_FENCE_FT)
+def tesla_is_far_away(vehicle):
+    return (vehicle.distance_from_home >= FAR_AWAY_GEO_FENCE_FT)
 
 # Returns relatice location string for logging purposes
-def tesla_get_relative_location():
-    if tesla_is_vehicle_home():
+def tesla_get_relative_location(vehicle):
+    if tesla_is_vehicle_home(vehicle):
         return "HOME"
-    elif tesla_is_far_away():
+    elif tesla_is_far_away(vehicle):
         return "FAR AWAY"
-    elif tesla_is_vehicle_nearby():
+    elif tesla_is_vehicle_nearby(vehicle):
         return "NEARBY"
-    elif (tesla_is_vehicle_away()):
+    elif (tesla_is_vehicle_away(vehicle)):
         return "AWAY"
     else:
         return "UNKNOWN"
 
-# Determines if the car is arriving home
-def tesla_is_arriving_home():
-    if ((distance_from_home >= HOME_GEO_FENCE_FT) and (distance_from_home <= ARRIVING_GEO_FENCE_FT)):
-        change_vehicle_data_thread_interval(TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_FAST)
-        change_myq_door_thread_interval(MYQ_DOOR_STATE_POLL_INTERVAL_SECS)
-        start_distance = distance_from_home
-        time.sleep(TESLA_LOCATION_DELAY_SECS)
-        # Leaving from the west can give the impression the car is arriving due to the roads, so also check the speed
-        if ((distance_from_home < start_distance) and (tests_speed <= 25)):
-            logging.info("Car is arriving home")
-            return True
-    return False
+# Moves a car through its arrival/departure states on each new sample. This never waits on follow-up samples,
+# the next sample simply moves the car on from wherever it is
+def tesla_update_vehicle_state(vehicle):
+    timed_out = ((time.time() - vehicle.state_since) >= TESLA_MONITOR_TIMEOUT_SECS)
 
-# Determines if the car is leaving home    
-def tesla_is_leaving_home():
-    # The gps location can be vary by up to 15 feet, so first try to catch the car backing out of the garage,
-    # then fallback on trying to get the relative location in case the car did not back out of the garage
-    if (tesla_is_vehicle_home() and myq_door_open() and (tesla_shift_state == "REVERSE")):
-        # There's a 5 second warning built into the garage opener before it starts to close, so only a short delay is needed
-        # for the car the pull out of the garage
-        change_vehicle_data_thread_interval(TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_FAST)
-        change_myq_door_thread_interval(MYQ_DOOR_STATE_POLL_INTERVAL_SECS)
-        #time.sleep(TESLA_PULL_OUT_GARAGE_DELAY_SECS)
-        logging.info("Car is leaving home")
+    if (vehicle.state is None):
+        if (tesla_is_vehicle_home(vehicle)):
+            tesla_change_vehicle_state(vehicle, VEHICLE_STATE_PARKED_HOME)
+        else:
+            tesla_change_vehicle_state(vehicle, VEHICLE_STATE_AWAY)
+    elif (vehicle.state == VEHICLE_STATE_PARKED_HOME):
+        # The gps location can be vary by up to 15 feet, so first try to catch the car backing out of the garage,
+        # then fallback on the relative location in case the car did not back out of the garage
+        if (tesla_is_vehicle_home(vehicle) and myq_door_open(vehicle.door) and (vehicle.shift_state == "REVERSE")):
+            tesla_change_vehicle_state(vehicle, VEHICLE_STATE_LEAVING)
+        elif (tesla_is_vehicle_nearby(vehicle) and tesla_is_moving_away(vehicle)):
+            tesla_change_vehicle_state(vehicle, VEHICLE_STATE_LEAVING)
+        elif (not tesla_is_vehicle_home(vehicle) and not tesla_is_vehicle_nearby(vehicle)):
+            tesla_change_vehicle_state(vehicle, VEHICLE_STATE_AWAY)
+    elif (vehicle.state == VEHICLE_STATE_LEAVING):
+        if (tesla_is_vehicle_away(vehicle) or tesla_is_far_away(vehicle) or timed_out):
+            tesla_change_vehicle_state(vehicle, VEHICLE_STATE_AWAY)
+        elif (tesla_is_vehicle_home(vehicle) and (vehicle.shift_state == "PARKED")):
+            tesla_change_vehicle_state(vehicle, VEHICLE_STATE_PARKED_HOME)
+    elif (vehicle.state == VEHICLE_STATE_AWAY):
+        if (tesla_is_arriving_home(vehicle)):
+            tesla_change_vehicle_state(vehicle, VEHICLE_STATE_APPROACHING)
+        elif (tesla_is_vehicle_home(vehicle)):
+            tesla_change_vehicle_state(vehicle, VEHICLE_STATE_PARKED_HOME)
+    elif (vehicle.state == VEHICLE_STATE_APPROACHING):
+        if (tesla_should_open_door(vehicle)):
+            tesla_change_vehicle_state(vehicle, VEHICLE_STATE_ARRIVING)
+        # Catch, in case the car is actually leaving home
+        elif (tesla_is_vehicle_away(vehicle) or tesla_is_far_away(vehicle) or timed_out):
+            tesla_change_vehicle_state(vehicle, VEHICLE_STATE_AWAY)
+    elif (vehicle.state == VEHICLE_STATE_ARRIVING):
+        if ((vehicle.shift_state == "PARKED") or tesla_is_vehicle_home(vehicle)):
+            myq_record_vehicle_arrival(vehicle.door)
+            tesla_change_vehicle_state(vehicle, VEHICLE_STATE_PARKED_HOME)
+        elif (tesla_is_vehicle_away(vehicle) or tesla_is_far_away(vehicle) or timed_out):
+            tesla_change_vehicle_state(vehicle, VEHICLE_STATE_AWAY)
+
+# Determines if an approaching car's door should be opened now. In predictive mode the command goes out when the
+# predicted arrival is only the door's command latency and travel time away. When that falls between samples a timer
+# sends it on time
+def tesla_should_open_door(vehicle):
+    if (not MYQ_PREDICTIVE_OPEN):
+        return (vehicle.distance_from_home <= OPEN_DOOR_GEO_FENCE_FT)
+    if (vehicle.distance_from_home <= MYQ_PREDICTIVE_FALLBACK_FT):
         return True
-    elif ((distance_from_home >= HOME_GEO_FENCE_FT) and (distance_from_home <= AWAY_GEO_FENCE_FT)):
-        change_vehicle_data_thread_interval(TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_FAST)
-        change_myq_door_thread_interval(MYQ_DOOR_STATE_POLL_INTERVAL_SECS)
-        start_distance = distance_from_home
-        time.sleep(TESLA_LOCATION_DELAY_SECS)
-        if (distance_from_home > start_distance):
-            logging.info("Car is leaving home")
-            return True
-    else:
-        change_myq_door_thread_interval(MYQ_DOOR_STATE_CHECK_SECS)
-        return False
+    time_to_arrival = tesla_time_to_geofence(vehicle, HOME_GEO_FENCE_FT) - (time.time() - vehicle.motion.timestamp)
+    open_in_secs = time_to_arrival - myq_door_open_lead_secs(vehicle.door)
+    if (open_in_secs <= 0):
+        logging.info("Opening door for " + vehicle.name + " with predicted arrival in " + str(round(time_to_arrival, 1)) + "s")
+        return True
+    if ((open_in_secs < vehicle.poll_interval) and (event_loop is not None)):
+        if (vehicle.open_door_timer is not None):
+            vehicle.open_door_timer.cancel()
+        vehicle.open_door_timer = event_loop.call_later(open_in_secs, tesla_open_door_timer_expired, vehicle)
+    return False
 
-# Closes the garage door and waits for it to leave the area to prevent hysteresis
-def tesla_monitor_car_leaving_home():
-    myq_close_door()
-    start_distance = distance_from_home
-    iterations = 20
-    for i in range(iterations):
-        if (tesla_is_vehicle_away()):
-            logging.info("Car has left home")
-            break
+# Opens the door for a car whose predicted open time fell between two samples
+def tesla_open_door_timer_expired(vehicle):
+    vehicle.open_door_timer = None
+    if (vehicle.state == VEHICLE_STATE_APPROACHING):
+        logging.info("Opening door for " + vehicle.name + " ahead of predicted arrival")
+        tesla_change_vehicle_state(vehicle, VEHICLE_STATE_ARRIVING)
+
+# Records a state transition, logs how long after the sample it was decided and starts any door command it needs
+def tesla_change_vehicle_state(vehicle, new_state):
+    now = time.time()
+    logging.info("Vehicle State (" + vehicle.name + "): " + str(vehicle.state) + " -> " + new_state + " | Decided "
+        + str(round(1000 * (now - vehicle.sample.timestamp))) + "ms after sample | " + str(round(now - vehicle.state_since, 1))
+        + "s in previous state")
+    telemetry_log("vehicle_state", vehicle=vehicle.name, previous=vehicle.state, state=new_state, distance_ft=vehicle.distance_from_home)
+    vehicle.state = new_state
+    vehicle.state_since = now
+    if (vehicle.open_door_timer is not None):
+        vehicle.open_door_timer.cancel()
+        vehicle.open_door_timer = None
+    if (new_state in (VEHICLE_STATE_LEAVING, VEHICLE_STATE_APPROACHING, VEHICLE_STATE_ARRIVING)):
+        change_myq_door_thread_interval(vehicle, MYQ_DOOR_STATE_POLL_INTERVAL_SECS)
+    else:
+        change_myq_door_thread_interval(vehicle, MYQ_DOOR_STATE_CHECK_SECS)
+    # There's a 5 second warning built into the garage opener before it starts to close, so the door can be
+    # closed as soon as the car starts leaving
+    if (new_state == VEHICLE_STATE_LEAVING):
+        myq_dispatch_door_command(myq_close_door, vehicle.door)
+    elif (new_state == VEHICLE_STATE_ARRIVING):
+        myq_dispatch_door_command(myq_open_door, vehicle.door)
+    status_publish_vehicle(vehicle)
+
+# Adaptive Poll Scheduler
+# Returns how long a car can go before its next poll. Cars in the middle of arriving or leaving, or at home with a
+# driver or an open door, are polled as fast as allowed. Every other car is polled again well before it could reach
+# the arriving geofence at the faster of its closing speed and its current speed, since it could turn towards home
+def tesla_next_poll_interval(vehicle):
+    if (not vehicle.awake):
+        return TESLA_ASLEEP_POLL_INTERVAL_SECS
+    if ((vehicle.state in (VEHICLE_STATE_LEAVING, VEHICLE_STATE_APPROACHING, VEHICLE_STATE_ARRIVING)) or myq_door_open(vehicle.door)):
+        return TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_FAST
+    if (tesla_is_vehicle_home(vehicle)):
+        if (vehicle.driver_present):
+            return TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_FAST
+        return TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_SLOW
+    moving = ((vehicle.speed > 0) or vehicle.driver_present)
+    if ((vehicle.distance_from_home <= ARRIVING_GEO_FENCE_FT) and moving):
+        return TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_FAST
+    if (vehicle.distance_from_home > ARRIVING_GEO_FENCE_FT):
+        boundary_gap = vehicle.distance_from_home - ARRIVING_GEO_FENCE_FT
+    else:
+        boundary_gap = vehicle.distance_from_home - HOME_GEO_FENCE_FT
+    speed_towards = max(tesla_closing_speed(vehicle), vehicle.speed * FEET_PER_SECOND_PER_MPH,
+        TESLA_POLL_IDLE_SPEED_MPH * FEET_PER_SECOND_PER_MPH)
+    interval = TESLA_POLL_BOUNDARY_FRACTION * boundary_gap / speed_towards
+    return min(max(interval, TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_FAST), TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_SLOW)
+
+# Returns what a desired poll interval adds to the fleet's (urgent, relaxed) polls per minute
+def tesla_poll_budget_share(interval):
+    if (interval <= TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_FAST):
+        return 60 / interval, 0.0
+    return 0.0, 60 / interval
+
+# Counts the polls per minute of every car's desired interval
+def tesla_count_poll_budget():
+    global tesla_poll_budget_fleet, tesla_poll_budget_count, tesla_urgent_polls_per_minute, tesla_relaxed_polls_per_minute
+
+    tesla_urgent_polls_per_minute = 0.0
+    tesla_relaxed_polls_per_minute = 0.0
+    for vehicle in tesla_vehicles.values():
+        urgent, relaxed = tesla_poll_budget_share(vehicle.desired_poll_interval)
+        tesla_urgent_polls_per_minute += urgent
+        tesla_relaxed_polls_per_minute += relaxed
+    tesla_poll_budget_fleet = tesla_vehicles
+    tesla_poll_budget_count = len(tesla_vehicles)
+
+# Returns how much the intervals of cars that are not arriving or leaving have to be stretched to keep the fleet within
+# TESLA_POLL_BUDGET_PER_MINUTE, rounded up to a power of TESLA_POLL_BUDGET_STRETCH_STEP
+def tesla_poll_budget_stretch_needed():
+    if ((tesla_urgent_polls_per_minute + tesla_relaxed_polls_per_minute) <= TESLA_POLL_BUDGET_PER_MINUTE):
+        return 1.0
+    remaining_budget = max(TESLA_POLL_BUDGET_PER_MINUTE - tesla_urgent_polls_per_minute, 1.0)
+    stretch = max(tesla_relaxed_polls_per_minute / remaining_budget, 1.0)
+    return TESLA_POLL_BUDGET_STRETCH_STEP ** math.ceil(math.log(stretch, TESLA_POLL_BUDGET_STRETCH_STEP))
+
+# Sets a car's poll interval from its desired interval and the fleet's stretch
+def tesla_apply_vehicle_poll_budget(vehicle):
+    interval = vehicle.desired_poll_interval
+    if (interval > TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_FAST):
+        interval = min(interval * tesla_poll_budget_stretch, TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_SLOW)
+    change_vehicle_data_thread_interval(vehicle, interval)
+
+# Counts the budget again and sets every car's poll interval from its desired interval, for when the cars change
+def tesla_apply_poll_budget():
+    global tesla_poll_budget_stretch
+
+    with tesla_poll_budget_lock:
+        tesla_count_poll_budget()
+        tesla_poll_budget_stretch = tesla_poll_budget_stretch_needed()
+        for vehicle in tesla_vehicles.values():
+            tesla_apply_vehicle_poll_budget(vehicle)
+
+# Changes a car's desired poll interval, updating the fleet's totals by the difference. Only this car's poll interval
+# changes unless the stretch does, so a decision takes the same time however many cars there are
+def tesla_set_desired_poll_interval(vehicle, interval):
+    global tesla_urgent_polls_per_minute, tesla_relaxed_polls_per_minute
+
+    with tesla_poll_budget_lock:
+        counted = ((tesla_poll_budget_fleet is tesla_vehicles) and (tesla_poll_budget_count == len(tesla_vehicles))
+            and (tesla_vehicles.get(vehicle.id) is vehicle))
+        if (counted):
+            old_urgent, old_relaxed = tesla_poll_budget_share(vehicle.desired_poll_interval)
+            new_urgent, new_relaxed = tesla_poll_budget_share(interval)
+            tesla_urgent_polls_per_minute += new_urgent - old_urgent
+            tesla_relaxed_polls_per_minute += new_relaxed - old_relaxed
+        vehicle.desired_poll_interval = interval
+        if ((not counted) or (tesla_poll_budget_stretch_needed() != tesla_poll_budget_stretch)):
+            tesla_apply_poll_budget()
         else:
-            logging.info("Monitoring the car leaving home...")
-            time.sleep(TESLA_LOCATION_DELAY_SECS)
+            tesla_apply_vehicle_poll_budget(vehicle)
 
-# Opens the garage door and waits for it to arrive home to prevent hysteresis
-def tesla_monitor_car_arriving_home():
-    iterations = 20
-    for i in range(iterations):
-        if (distance_from_home <= OPEN_DOOR_GEO_FENCE_FT):
-            logging.info("Car is getting close to home...")
-            break
-        # Catch, in case the car is actually leaving home
-        elif (tesla_is_vehicle_away() or tesla_is_far_away()):
-            break
-        else:
-            logging.info("Monitoring the car arriving home...")
-            time.sleep(TESLA_LOCATION_DELAY_SECS)
-    myq_open_door()
-    for j in range(iterations):
-        if ((tesla_shift_state == "PARKED") or tesla_is_vehicle_home()):
-            logging.info("Car has arrived Home")
-            break
-        else:
-            logging.info("Monitoring the car arriving home...")
-            time.sleep(TESLA_LOCATION_DELAY_SECS)
+# Works out when a car should next be polled after a decision
+def tesla_schedule_next_poll(vehicle):
+    tesla_set_desired_poll_interval(vehicle, tesla_next_poll_interval(vehicle))
+
+# Returns a one line summary of a car's polling
+def tesla_poll_stats_summary(vehicle):
+    elapsed_minutes = max((time.time() - vehicle.first_poll_at) / 60, 1 / 60)
+    average_interval = 0.0
+    if (vehicle.poll_count > 1):
+        average_interval = (vehicle.last_poll - vehicle.first_poll_at) / (vehicle.poll_count - 1)
+    return ("Poll Stats (" + vehicle.name + "): " + str(vehicle.poll_count) + " polls | " + str(round(vehicle.poll_count / elapsed_minutes, 2))
+        + " polls/min | Avg Interval " + str(round(average_interval, 1)) + "s | Current Interval " + str(round(vehicle.poll_interval, 1)) + "s")
 
 # Converts shift state data to human readable
 def shift_state(state):
@@ -455,40 +2745,123 @@ def shift_state(state):
     else:
         return "PARKED"
 
-# Fetches relevant vehicle data
-def tesla_get_current_vehicle_state():
-    global vehicle_thread_interval_changed
-
-    tick_seconds = 0
+# Fetches a car's data every interval on the bounded poll pool and wakes up its decision loop with it
+async def tesla_vehicle_poller(vehicle, worker):
     while (True):
-        if ((vehicle_thread_interval_changed) or (tick_seconds >= tesla_vehicle_thread_sleep)):
-            vehicle_thread_interval_changed = False
-            tick_seconds = 0
-            tesla_get_driver_present()
-            tesla_get_charger_connected()
-            tesla_get_drive_state()
-        else:
-            time.sleep(1)
-            tick_seconds += 1
+        worker.beat(SUPERVISOR_WORK_TIMEOUT_SECS)
+        tesla_start_poll(vehicle)
+        await event_loop.run_in_executor(tesla_poll_executor, tesla_poll_vehicle, vehicle)
+        metrics_loop_seconds.observe(("vehicle_poller",), time.time() - vehicle.last_poll)
+        vehicle.new_data_event.set()
+        await wait_for_next_poll(vehicle.interval_changed_event, lambda: vehicle.last_poll + vehicle.poll_interval, worker)
+
+# Whether a car's stream has delivered a sample recently enough to stand in for its polls
+def tesla_is_streaming(vehicle):
+    return ((time.time() - vehicle.streamed_at) < TESLA_STREAMING_QUIET_SECS)
+
+# Builds a vehicle sample from the value of a streaming data:update, a comma separated line of the time in milliseconds
+# followed by TESLA_STREAMING_COLUMNS. The stream has no driver or charger fields, so a car out of park or drawing power
+# after its last sample said the driver was in keeps the driver, and the charger carries over from the last poll
+def tesla_decode_stream_update(vehicle, value):
+    columns = dict(zip(TESLA_STREAMING_COLUMNS, value.split(",")[1:]))
+    fields = {column: (float(data) if (column != "shift_state") else data) for column, data in columns.items() if (len(data) > 0)}
+    state = shift_state(fields.get("shift_state"))
+    power = fields.get("power", 0)
+    return VehicleSample(
+        (state != "PARKED") or ((power > 0) and vehicle.driver_present),
+        vehicle.charger_connected,
+        state,
+        int(fields.get("speed", 0)),
+        int(fields.get("heading", 0)),
+        fields["est_lat"],
+        fields["est_lng"],
+        time.time())
+
+# Subscribes to a car's stream and applies its samples until the car disconnects or the stream goes quiet
+async def tesla_stream_vehicle(vehicle, worker):
+    token = await asyncio.to_thread(tesla_client.tokens.get_token)
+    async with websockets.connect(TESLA_STREAMING_URL, open_timeout=TESLA_STREAMING_CONNECT_TIMEOUT_SECS) as connection:
+        await connection.send(json.dumps({"msg_type": "data:subscribe_oauth", "token": token,
+            "value": ",".join(TESLA_STREAMING_COLUMNS), "tag": str(vehicle.stream_id)}))
+        metrics_vehicle_stream_connects.inc((vehicle.name, "subscribed"))
+        while (True):
+            worker.beat(TESLA_STREAMING_QUIET_SECS + SUPERVISOR_HEARTBEAT_GRACE_SECS)
+            try:
+                message = json.loads(await asyncio.wait_for(connection.recv(), TESLA_STREAMING_QUIET_SECS))
+            except asyncio.TimeoutError:
+                logging.info("Tesla Stream (" + vehicle.name + ") went quiet, falling back to polling")
+                metrics_vehicle_stream_connects.inc((vehicle.name, "quiet"))
+                return
+            if (message.get("msg_type") == "data:update"):
+                try:
+                    tesla_apply_sample(vehicle, tesla_decode_stream_update(vehicle, message["value"]))
+                except (KeyError, ValueError) as e:
+                    logging.error("Invalid Tesla Stream sample for " + vehicle.name + ": " + str(e))
+                    continue
+                vehicle.streamed_at = time.time()
+                vehicle.last_data_update = vehicle.streamed_at
+                metrics_vehicle_stream_samples.inc((vehicle.name,))
+                vehicle.new_data_event.set()
+            elif (message.get("msg_type") == "data:error"):
+                if (message.get("error_type") == "vehicle_disconnected"):
+                    logging.info("Tesla Stream (" + vehicle.name + ") disconnected")
+                    metrics_vehicle_stream_connects.inc((vehicle.name, "disconnected"))
+                    return
+                if ("token" in str(message.get("value")).lower()):
+                    await asyncio.to_thread(tesla_client.tokens.reauthenticate, token)
+                raise RuntimeError(str(message.get("error_type")) + ": " + str(message.get("value")))
+
+# Keeps an awake car subscribed to its stream, reconnecting with a jittered backoff after errors. Polling covers the car
+# whenever it is asleep, disconnected or quiet
+async def tesla_vehicle_streamer(vehicle, worker):
+    failures = 0
+    while (True):
+        if ((not vehicle.awake) or (vehicle.stream_id is None)):
+            worker.beat(TESLA_STREAMING_IDLE_CHECK_SECS + SUPERVISOR_HEARTBEAT_GRACE_SECS)
+            await asyncio.sleep(TESLA_STREAMING_IDLE_CHECK_SECS)
+            continue
+        worker.beat(TESLA_STREAMING_CONNECT_TIMEOUT_SECS + SUPERVISOR_WORK_TIMEOUT_SECS)
+        try:
+            await tesla_stream_vehicle(vehicle, worker)
+            failures = 0
+            # A parked car's stream soon disconnects again, so it is only checked now and then while polls cover it
+            delay = TESLA_STREAMING_RECONNECT_BASE_SECS if (vehicle.shift_state != "PARKED") else TESLA_STREAMING_IDLE_CHECK_SECS
+        except Exception as e:
+            failures += 1
+            delay = min(TESLA_STREAMING_RECONNECT_BASE_SECS * (2 ** (failures - 1)), TESLA_STREAMING_RECONNECT_MAX_SECS)
+            logging.error("Tesla Stream (" + vehicle.name + ") failed, reconnecting within " + str(delay) + "s: " + str(e))
+            metrics_vehicle_stream_connects.inc((vehicle.name, "failed"))
+        delay = random.uniform(delay / 2, delay)
+        worker.beat(delay + SUPERVISOR_HEARTBEAT_GRACE_SECS)
+        await asyncio.sleep(delay)
+
+# Notes the start of a vehicle data poll for the scheduler and its stats
+def tesla_start_poll(vehicle):
+    vehicle.last_poll = time.time()
+    if (vehicle.poll_count == 0):
+        vehicle.first_poll_at = vehicle.last_poll
+    vehicle.poll_count += 1
 
 # Main logic to see if a door trigger event is needed
-def tesla_check_arriving_leaving():
-    # Leaving or Left Home?
-    if (tesla_is_leaving_home()):
-        tesla_monitor_car_leaving_home()
-    # Arriving Home?
-    elif (tesla_is_arriving_home()):
-        tesla_monitor_car_arriving_home()
+def tesla_check_arriving_leaving(vehicle):
+    # Doors are matched to vehicles on the first door poll, nothing can be triggered before that
+    if (vehicle.door is None):
+        return
+    tesla_update_vehicle_state(vehicle)
 
 # Tesla initialization
 def tesla_init():
-    tesla_login(tesla_email, tesla_password)
-    tesla_get_vehicles()
+    if (TESLA_STREAMING and (websockets is None)):
+        print_error_and_exit("The websockets package is required for TESLA_STREAMING")
+    try:
+        tesla_client.tokens.get_token()
+    except Exception as e:
+        print_error_and_exit(str(e))
+    if (len(tesla_vehicles) == 0):
+        tesla_get_vehicles()
 
 # Gets the MyQ Auth Token
 def myq_login(email, password):
-    global myq_auth_token
-    global myq_auth_header
     headers = {
         "MyQApplicationId": MYQ_APP_ID
     }
@@ -497,209 +2870,417 @@ def myq_login(email, password):
         "password": password
     }
     logging.info("Getting MyQ Auth Token")
-    try:
-        response = requests.post(MYQ_BASE_API_URL + MYQ_LOGIN, headers=headers, json=body)
-        if (response.status_code == 200):
-            resp = json.loads(response.text)
-            myq_auth_token = resp['SecurityToken']
-            myq_auth_header = {
-                "SecurityToken": myq_auth_token,
-                "MyQApplicationId": MYQ_APP_ID
-            }
-            logging.info("MyQ Auth Token Aquired")
-            myq_last_login = time.time()
-        else:
-            print_error_and_exit("Failed to get MyQ Auth Token: " + str(response.status_code))
-    except Exception as e:
-        print(e)
-        print_error_and_exit("Failed to get MyQ Auth Token: " + str(response.status_code))
+    response = myq_client.post(MYQ_LOGIN, auth=False, headers=headers, json=body)
+    if (response.status_code != 200):
+        raise AuthError("Failed to get MyQ Auth Token: " + str(response.status_code))
+    resp = json_from_bytes(response.content)
+    logging.info("MyQ Auth Token Aquired")
+    return {"access_token": resp['SecurityToken'], "refresh_token": "", "expires_in": MYQ_LOGIN_TIMEOUT_SECS}
 
 # Gets the MyQ Account ID
 def myq_get_account_id():
     global myq_account_id
 
     try:
-        response = requests.get(MYQ_BASE_API_URL + MYQ_ACCOUNT_ID, headers=myq_auth_header)
+        response = myq_client.get(MYQ_ACCOUNT_ID)
         if (response.status_code == 200):
-            resp = json.loads(response.text)
+            resp = json_from_bytes(response.content)
             myq_account_id = resp['Account']['Id']
             logging.info("MyQ Account ID Aquired")
         else:
             print_error_and_exit("Failed to get MyQ Account ID: " + str(response.status_code))
     except Exception as e:
-        print(e)
-        print_error_and_exit("Failed to get MyQ Account ID: " + str(response.status_code))
+        print_error_and_exit("Failed to get MyQ Account ID: " + str(e))
 
-# Gets the current state of the MyQ garage door
-def myq_get_door_state():
-    global myq_device_id
-    global myq_door_state
+# Determines whether a MyQ device is a garage door opener
+def myq_is_garage_door(device):
+    return ((device.get("device_family") == "garagedoor") or ("Garage Door Opener" in device["name"]))
+
+# Builds the door sample for a MyQ garage door device
+def myq_door_sample(device):
+    return DoorSample(str(device["serial_number"]), device["name"], device['state']['door_state'])
+
+# Decodes the garage doors from the bytes of a device list response, skipping every other device
+def myq_decode_doors(content):
+    return [myq_door_sample(device) for device in json_from_bytes(content)["items"] if myq_is_garage_door(device)]
+
+# Decodes a garage door from the bytes of a single device response
+def myq_decode_door(content):
+    return myq_door_sample(json_from_bytes(content))
+
+# Device Registry
+# Fetches the whole device list to find the garage doors, registering new doors by serial number and dropping ones
+# that left the account. After this only the doors the cars open are polled, one device each
+def myq_discover_doors():
+    global myq_doors_stale
+
+    response = myq_client.get(MYQ_DEVICE_LIST, {"account_id": myq_account_id})
+    if (response.status_code != 200):
+        logging.error("Failed to get MyQ Device List: " + str(response.status_code))
+        return False
+    door_samples = myq_decode_doors(response.content)
+    if (len(door_samples) == 0):
+        logging.error("No MyQ Garage Doors Found")
+        return False
+    serials = set()
+    for sample in door_samples:
+        serials.add(sample.serial)
+        if (sample.serial not in myq_doors):
+            myq_doors[sample.serial] = GarageDoor(sample.serial, sample.name)
+            logging.info("Found MyQ Garage Door: " + sample.name)
+        myq_apply_door_sample(sample)
+    for serial in list(myq_doors):
+        if (serial not in serials):
+            logging.info("MyQ Garage Door Removed: " + myq_doors.pop(serial).name)
+            status_broadcaster.publish("door", serial, None)
+    myq_doors_stale = False
+    assign_vehicle_doors()
+    return True
+
+# Returns the doors worth polling: the ones the cars open and any a door command is waiting on
+def myq_doors_of_interest():
+    doors = {}
+    for vehicle in tesla_vehicles.values():
+        if (vehicle.door is not None):
+            doors[vehicle.door.serial] = vehicle.door
+    for door in myq_doors.values():
+        if (door.state_waiters > 0):
+            doors[door.serial] = door
+    return list(doors.values())
+
+# Fetches a single door's device, marking the registry stale if the door is no longer on the account
+def myq_poll_door(door):
+    global myq_doors_stale
+
+    response = myq_client.get(MYQ_DEVICE, {"account_id": myq_account_id, "device_id": door.serial})
+    if (response.status_code == 200):
+        myq_apply_door_sample(myq_decode_door(response.content))
+        return True
+    logging.error("Failed to get MyQ Door State (" + door.name + "): " + str(response.status_code))
+    if (response.status_code == 404):
+        myq_doors_stale = True
+    return False
+
+# Records a door sample against its registered door
+def myq_apply_door_sample(sample):
+    door = myq_doors.get(sample.serial)
+    if (door is None):
+        return
+    myq_update_door_state(door, sample.door_state)
+    # Only log the door state if one of its cars is near home
+    for vehicle in tesla_vehicles.values():
+        if ((vehicle.door is door) and not tesla_is_far_away(vehicle)):
+            logging.info("MyQ Door State (%s): %s", door.name, door.state)
+            break
 
+# Gets the current state of the MyQ garage doors, discovering them first if the registry is empty or stale
+def myq_get_door_state():
     try:
-        url = MYQ_BASE_API_URL + MYQ_DEVICE_LIST
-        response = requests.get(url.replace("{account_id}", str(myq_account_id)), headers=myq_auth_header)
-        if (response.status_code == 200):
-            resp = json.loads(response.text)
-            for device in resp["items"]:
-                if ("Garage Door Opener" in device["name"]):
-                    myq_device_id = str(device["serial_number"])
-                    myq_door_state = device['state']['door_state']
-                    # Only log the door state if the car is near home
-                    if (not tesla_is_far_away()):
-                        logging.info("MyQ Door State: " + myq_door_state)
-                    return True
-        else:
-            logging.error("Failed to get MyQ Door State: " + str(response.status_code))
+        if ((len(myq_doors) == 0) or myq_doors_stale):
+            metrics_door_polls.inc(("discovery",))
+            return myq_discover_doors()
+        updated = False
+        for door in myq_doors_of_interest():
+            metrics_door_polls.inc(("device",))
+            updated = myq_poll_door(door) or updated
+        return updated
+    except RequestThrottled as e:
+        logging.info("Skipped MyQ door state poll: " + str(e))
     except:
             logging.exception("Failed to get MyQ Door State")
     return False
-        
-def myq_get_door_state_with_auth_check():
-    global myq_door_thread_interval_changed
 
-    tick_seconds = 0
+# Fetches the door states every interval and wakes up the decision loops of the cars with data
+async def myq_door_poller(worker):
     while (True):
-        if ((myq_door_thread_interval_changed) or (tick_seconds >= myq_door_thread_sleep)):
-            myq_door_thread_interval_changed = False
-            tick_seconds = 0
-             # Retry in case there's an auth error since MyQ doesn't have a token refresh API
-            if (not myq_get_door_state()):
-                myq_init()
-                myq_get_door_state()
-        else:
-            time.sleep(1)
-            tick_seconds += 1
+        worker.beat(SUPERVISOR_WORK_TIMEOUT_SECS)
+        last_poll = time.time()
+        await asyncio.to_thread(myq_get_door_state)
+        metrics_loop_seconds.observe(("door_poller",), time.time() - last_poll)
+        for vehicle in tesla_vehicles.values():
+            if (vehicle.has_data):
+                vehicle.new_data_event.set()
+        await wait_for_next_poll(myq_door_interval_changed_event, lambda: last_poll + myq_door_thread_sleep, worker)
 
 # Changes the MyQ door to "open" or "close"
-def myq_change_door_state(state):
+def myq_change_door_state(door, state):
     # Action to close the door and a closed door state differ slightly
-    if ((state == "close") and (myq_door_state == "closed")):
+    if ((state == "close") and (door.state == "closed")):
         return False
 
-    myq_init()
     body = {
         "action_type": state,
     }
-    if (state != myq_door_state):
-        url = MYQ_BASE_API_URL + MYQ_DEVICE_SET
+    if (state != door.state):
         try:
-            logging.info("Changing MyQ Door State to " + state)
-            response = requests.put(url.replace("{account_id}", myq_account_id).replace("{device_id}", myq_device_id), headers=myq_auth_header, json=body)
+            logging.info("Changing MyQ Door State (" + door.name + ") to " + state)
+            start = time.time()
+            response = myq_client.put(MYQ_DEVICE_SET, {"account_id": myq_account_id, "device_id": door.serial}, priority=True, json=body)
             if (response.status_code == 204):
+                door.command_latency_secs = myq_smooth_timing(door.command_latency_secs, time.time() - start)
+                telemetry_log("door_command", door=door.name, action=state, latency_secs=round(time.time() - start, 3))
+                history_record_door_event(door, door.state, state)
+                door.pending_action = state
+                if (door.command_decided_at == 0):
+                    door.command_decided_at = start
+                if (state == "open"):
+                    door.open_command_at = start
                 return True
             else:
                 logging.error("Unable to Change MyQ Door State: " + str(response.status_code))
+        except RequestThrottled as e:
+            logging.error("Unable to Change MyQ Door State: " + str(e))
         except:
             logging.error("Unable to Change MyQ Door State")
     else:
         logging.error("Tried to change door state to current door state: " + state)
     return False
 
+# Records a new door state along with the timings of opening -> open transitions, waking anyone waiting on the door
+def myq_update_door_state(door, state):
+    if (state == door.state):
+        return
+    with door.state_changed:
+        now = time.time()
+        if ((door.state == "opening") and (state == "open")):
+            door.travel_secs = myq_smooth_timing(door.travel_secs, now - door.state_changed_at)
+        if (state == "open"):
+            door.opened_at = now
+            # The car got home before the door finished opening
+            if (door.vehicle_arrived_at > 0):
+                myq_record_door_timing(door, now - door.vehicle_arrived_at, 0.0)
+                door.vehicle_arrived_at = 0.0
+        telemetry_log("door_state", door=door.name, previous=door.state, state=state)
+        history_record_door_event(door, state)
+        if ((len(door.pending_action) > 0) and (state in MYQ_DOOR_MOVING_STATES[door.pending_action])):
+            metrics_door_command_seconds.observe((door.name, door.pending_action), now - door.command_decided_at)
+            door.pending_action = ""
+            door.command_decided_at = 0.0
+        door.state = state
+        door.state_changed_at = now
+        door.state_changed.notify_all()
+    status_publish_door(door)
+
+# Waits until the door reaches one of the states, returning as soon as a door poll reports it. Returns False if the
+# door is still somewhere else after timeout seconds. The door poller runs at its fast interval while anyone waits
+def myq_wait_for_door_state(door, states, timeout):
+    deadline = time.time() + timeout
+    with door.state_changed:
+        door.state_waiters += 1
+    update_myq_door_thread_interval()
+    try:
+        with door.state_changed:
+            while (door.state not in states):
+                remaining = deadline - time.time()
+                if (remaining <= 0):
+                    return False
+                door.state_changed.wait(remaining)
+            return True
+    finally:
+        with door.state_changed:
+            door.state_waiters -= 1
+        update_myq_door_thread_interval()
+
+# Blends a new measurement into a smoothed door timing
+def myq_smooth_timing(current, measured):
+    return (1 - MYQ_TIMING_SMOOTHING) * current + MYQ_TIMING_SMOOTHING * measured
+
+# Seconds before a car reaches home that the open command has to go out for the door to be fully open in time
+def myq_door_open_lead_secs(door):
+    return door.command_latency_secs + door.travel_secs + MYQ_PREDICTIVE_OPEN_MARGIN_SECS
+
+# Records how well an open command lined up with the car getting home
+def myq_record_vehicle_arrival(door):
+    if (door.open_command_at == 0):
+        return
+    now = time.time()
+    if ((door.state == "open") and (door.opened_at >= door.open_command_at)):
+        myq_record_door_timing(door, 0.0, now - door.opened_at)
+    else:
+        # The wait is recorded once the door reports open
+        door.vehicle_arrived_at = now
+    door.open_command_at = 0.0
+
+def myq_record_door_timing(door, car_waited_secs, open_early_secs):
+    door.arrivals += 1
+    door.car_waited_secs += car_waited_secs
+    door.open_early_secs += open_early_secs
+    logging.info("Door Timing (" + door.name + "): Car Waited " + str(round(car_waited_secs, 1)) + "s | Door Open Early "
+        + str(round(open_early_secs, 1)) + "s")
+
+# Returns a one line summary of a door's measured timings and arrival stats
+def myq_door_timing_summary(door):
+    arrivals = max(door.arrivals, 1)
+    return ("Door Timing (" + door.name + "): Travel " + str(round(door.travel_secs, 1)) + "s | Command Latency "
+        + str(round(door.command_latency_secs, 2)) + "s | Arrivals: " + str(door.arrivals) + " | Avg Car Waited "
+        + str(round(door.car_waited_secs / arrivals, 1)) + "s | Avg Door Open Early " + str(round(door.open_early_secs / arrivals, 1)) + "s")
+
 # Determine if the door is open or opening
-def myq_door_open():
-    return ((myq_door_state == "open") or (myq_door_state == "opening"))
+def myq_door_open(door):
+    return ((door is not None) and ((door.state == "open") or (door.state == "opening")))
 
-# Keeps trying to close the door in case the sensor is momentarily blocked
-def myq_door_close_retry():
+# Keeps trying to close the door in case the sensor is momentarily blocked, returning whether it started closing
+def myq_door_close_retry(door):
     start = time.time()
     iterations = 15
     for i in range(iterations):
-        if ((myq_door_state == "closing") or (myq_door_state == "closed")):
-            break
+        if (myq_wait_for_door_state(door, ("closing", "closed"), MYQ_DOOR_STATE_POLL_INTERVAL_SECS)):
+            return True
         elif ((time.time() - start) >= MYQ_DOOR_CLOSE_RETRY_SECS):
-            logging.error("Timed out trying to close the garage door")
             break
         else:
             logging.info("Trying to close the garage door, try " + str(i) + " of " + str(iterations))
-            myq_change_door_state("close")
-            time.sleep(MYQ_DOOR_STATE_POLL_INTERVAL_SECS)
+            myq_change_door_state(door, "close")
+    logging.error("Timed out trying to close the garage door")
+    return False
 
-# Polls the door state while it opens or closes
-def myq_poll_door_state():
-    start = time.time()
-    iterations = 15
-    for i in range(iterations):
-        if ((time.time() - start) >= MYQ_DOOR_STATE_POLL_TIMEOUT_SECS):
-            break
-        else:
-            logging.info("Polling door state...")
-            time.sleep(MYQ_DOOR_STATE_POLL_INTERVAL_SECS)
+# Runs a door command on the door pool so the decision loop never waits on the door
+def myq_dispatch_door_command(command, door):
+    door.command_decided_at = time.time()
+    future = myq_door_executor.submit(command, door)
+    future.add_done_callback(myq_log_door_command_error)
+
+# Logs a door command that failed on the door pool, since nothing else waits on its result
+def myq_log_door_command_error(future):
+    if (future.exception() is not None):
+        logging.error("Door Command Failed: " + repr(future.exception()))
 
 # Open the garage door
-def myq_open_door():
-    if(myq_change_door_state("open")):
-        myq_poll_door_state()
+def myq_open_door(door):
+    with door.command_lock:
+        if(myq_change_door_state(door, "open")):
+            if (not myq_wait_for_door_state(door, ("open",), MYQ_DOOR_STATE_POLL_TIMEOUT_SECS)):
+                logging.error("Timed out waiting for the garage door (" + door.name + ") to open")
 
 # Close the garage door
-def myq_close_door():
-    if(myq_change_door_state("close")):
-        myq_door_close_retry()
-        myq_poll_door_state()
+def myq_close_door(door):
+    with door.command_lock:
+        if(myq_change_door_state(door, "close") and myq_door_close_retry(door)):
+            if (not myq_wait_for_door_state(door, ("closed",), MYQ_DOOR_STATE_POLL_TIMEOUT_SECS)):
+                logging.error("Timed out waiting for the garage door (" + door.name + ") to close")
 
 # MyQ initialization
 def myq_init():
-    if ((time.time() - myq_last_login) >= MYQ_LOGIN_TIMEOUT_SECS):
-        myq_login(myq_email, myq_password)
+    try:
+        myq_client.tokens.get_token()
+    except Exception as e:
+        print_error_and_exit(str(e))
+    if (len(myq_account_id) == 0):
         myq_get_account_id()
 
-# Initialize and start background threads
-def threading_init():
-    tesla_vehicle_thread = threading.Thread(name='tesla_vehicle_data', target=tesla_get_current_vehicle_state)
-    myq_door_thread = threading.Thread(name='myq_door_data', target=myq_get_door_state_with_auth_check)
-    tesla_check_token_expiration_thread = threading.Thread(name='tesla_check_token_expired', target=tesla_check_token_expired)
-    watchdog_thread = threading.Thread(name='watchdog', target=watchdog)
-
-    watchdog_thread.daemon = True
-    watchdog_thread.start()
-    tesla_vehicle_thread.daemon = True
-    tesla_vehicle_thread.start()
-    myq_door_thread.daemon = True
-    myq_door_thread.start()
-    tesla_check_token_expiration_thread.daemon = True
-    tesla_check_token_expiration_thread.start()
-
- # Update the sleep interval for the vehicle data thread
-def change_vehicle_data_thread_interval(new_interval):
-    global vehicle_thread_interval_changed
-    global tesla_vehicle_thread_sleep
-
-    if (new_interval != tesla_vehicle_thread_sleep):
-        logging.info("Changing Vehicle Data Thread Interval to: " + str(new_interval) + " seconds")
-        vehicle_thread_interval_changed = True
-        tesla_vehicle_thread_sleep = new_interval
-
- # Update the sleep interval for the MyQ door thread
-def change_myq_door_thread_interval(new_interval):
-    global myq_door_thread_interval_changed
+# Matches each vehicle to its garage door from VEHICLE_DOOR_MAP, defaulting to the first door found
+def assign_vehicle_doors():
+    if (len(myq_doors) == 0):
+        return
+    doors_by_name = {door.name: door for door in myq_doors.values()}
+    default_door = next(iter(myq_doors.values()))
+    for vehicle in tesla_vehicles.values():
+        door_name = VEHICLE_DOOR_MAP.get(vehicle.name, VEHICLE_DOOR_MAP.get(vehicle.id))
+        door = doors_by_name.get(door_name, default_door)
+        if (vehicle.door is not door):
+            logging.info(vehicle.name + " opens garage door: " + door.name)
+            vehicle.door = door
+
+# Update the sleep interval for a car's data poller, waking it up right away
+def change_vehicle_data_thread_interval(vehicle, new_interval):
+    if (new_interval != vehicle.poll_interval):
+        logging.debug("Changing Vehicle Data Poll Interval for %s to: %.1f seconds", vehicle.name, new_interval)
+        vehicle.poll_interval = new_interval
+        wake_event(vehicle.interval_changed_event)
+
+# Update the interval a car needs for the MyQ door poller. The poller runs at the fastest interval any car needs
+def change_myq_door_thread_interval(vehicle, new_interval):
+    vehicle.door_poll_interval = new_interval
+    update_myq_door_thread_interval()
+
+# Sets the MyQ door poller to the fastest interval any car needs, or the fast interval while a door command waits
+def update_myq_door_thread_interval():
     global myq_door_thread_sleep
 
-    if (new_interval != myq_door_thread_sleep):
-        logging.info("Changing Door State Thread Interval to: " + str(new_interval) + " seconds")
-        myq_door_thread_interval_changed = True
-        myq_door_thread_sleep = new_interval
+    fastest_interval = min((vehicle.door_poll_interval for vehicle in tesla_vehicles.values()), default=MYQ_DOOR_STATE_CHECK_SECS)
+    if (any(door.state_waiters > 0 for door in list(myq_doors.values()))):
+        fastest_interval = min(fastest_interval, MYQ_DOOR_STATE_POLL_INTERVAL_SECS)
+    if (fastest_interval != myq_door_thread_sleep):
+        logging.info("Changing Door State Poll Interval to: " + str(fastest_interval) + " seconds")
+        myq_door_thread_sleep = fastest_interval
+        wake_event(myq_door_interval_changed_event)
+
+# Decides for a car on its latest data and schedules its next poll
+def tesla_decide(vehicle):
+    start = time.perf_counter()
+    tesla_check_arriving_leaving(vehicle)
+    metrics_decision_seconds.observe((vehicle.name,), time.perf_counter() - start)
+    tesla_schedule_next_poll(vehicle)
+
+# Runs the decision logic for a car as soon as new vehicle or door data comes in
+async def tesla_decision_loop(vehicle, worker):
+    while (True):
+        # Waiting on data is never a stall, that is up to the car's poller
+        worker.beat(math.inf)
+        await vehicle.new_data_event.wait()
+        worker.beat(SUPERVISOR_WORK_TIMEOUT_SECS)
+        vehicle.new_data_event.clear()
+        if (vehicle.has_data):
+            tesla_decide(vehicle)
+
+# Runs the stale data and stats checks that don't depend on new data. A car whose data went stale has its poller restarted
+async def housekeeping_loop(worker):
+    while (True):
+        worker.beat(DECISION_IDLE_CHECK_SECS + SUPERVISOR_HEARTBEAT_GRACE_SECS)
+        await asyncio.sleep(DECISION_IDLE_CHECK_SECS)
+        worker.beat(SUPERVISOR_WORK_TIMEOUT_SECS)
+        start = time.time()
+        for vehicle in tesla_vehicles.values():
+            poller = supervisor_workers.get(tesla_vehicle_poller_name(vehicle))
+            if (tesla_check_for_stale_data(vehicle) and (poller is not None)):
+                poller.restart("stale_data")
+        log_request_stats()
+        if (history_store is not None):
+            await asyncio.to_thread(history_maintain)
+        metrics_loop_seconds.observe(("housekeeping",), time.time() - start)
+
+# The workers that poll a car and decide for it
+def tesla_vehicle_workers(vehicle):
+    workers = [Worker(tesla_vehicle_poller_name(vehicle), tesla_vehicle_poller, (vehicle,)),
+        Worker("decision_loop[" + vehicle.name + "]", tesla_decision_loop, (vehicle,))]
+    if (TESLA_STREAMING):
+        workers.append(Worker("streamer[" + vehicle.name + "]", tesla_vehicle_streamer, (vehicle,)))
+    return workers
 
 # Main Application Flow
-def main_loop():
-    threading_init()
-    # Add small delay to allow the data to come in
-    time.sleep(TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_FAST * 2)
-    while (True):
-        if (tesla_check_if_fetch_interval_should_change_to_fast()):
-            change_vehicle_data_thread_interval(TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_FAST)
-        elif (tesla_check_if_fetch_interval_should_change_to_slow()):
-            change_vehicle_data_thread_interval(TESLA_FETCH_VEHICLE_DATA_INTERVAL_SECS_SLOW)
-        tesla_check_arriving_leaving()
-        tesla_check_for_stale_data()
-        check_log_file_size()
-        time.sleep(1.5)
+async def main_loop():
+    global event_loop
+
+    event_loop = asyncio.get_running_loop()
+    profiler_install()
+    workers = [Worker("door_poller", myq_door_poller), Worker("token_refresher", token_refresher),
+        Worker("housekeeping", housekeeping_loop), Worker("state_snapshot_writer", state_snapshot_writer)]
+    if (METRICS_PORT > 0):
+        workers.append(Worker("metrics_server", metrics_server, heartbeats=False))
+    if (STATUS_API_PORT > 0):
+        workers.append(Worker("status_api", status_api_server, heartbeats=False))
+    for vehicle in tesla_vehicles.values():
+        workers.extend(tesla_vehicle_workers(vehicle))
+    await supervisor(workers)
 
 # Main
 def main():
     logging_init()
     logging.info("Starting Magic Garage...")
     parse_input_parameters()
+    trace_init()
+    history_init()
+    corridor_init()
+    token_cache_load()
+    state_snapshot_load()
     tesla_init()
     myq_init()
-    main_loop()
-  
-main()
+    try:
+        asyncio.run(main_loop())
+    finally:
+        if (history_store is not None):
+            history_store.close()
+        logging_shutdown()
+
+if __name__ == "__main__":
+    main()
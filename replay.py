@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+# Replays a recorded Tesla and MyQ trace through the Magic Garage decision code on a virtual clock
+# To Record: set TRACE_RECORD_FILE in magic_garage.py and run the app as usual
+# To Run: python3 replay.py <trace file> [--verbose]
+import sys
+import json
+import gzip
+import time
+import heapq
+import bisect
+import logging
+import threading
+import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import magic_garage
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+REPLAY_HOST = "127.0.0.1"
+REPLAY_MAX_DOOR_THREADS = 4
+# Doors the replay sends commands to report opening or closing for this long before they finish
+REPLAY_DOOR_TRAVEL_SECS = magic_garage.MYQ_DEFAULT_DOOR_TRAVEL_SECS
+# Token responses are not recorded, so the stand-in servers hand out these instead
+REPLAY_TESLA_TOKEN = {"access_token": "replay", "refresh_token": "replay", "expires_in": 45 * 24 * 60 * 60}
+REPLAY_MYQ_TOKEN = {"SecurityToken": "replay"}
+# The stand-in streaming server checks each subscribed car's data this often and pushes it when it changes
+REPLAY_STREAM_CHECK_SECS = 0.05
+
+# Fills in an endpoint's {placeholders} and drops its query string, giving the path the stand-in servers see
+def trace_path(endpoint, url_params):
+    for key, value in url_params.items():
+        endpoint = endpoint.replace("{" + key + "}", str(value))
+    return endpoint.split("?")[0]
+
+# Recorded responses, keyed by (provider, method, path) with their times sorted for lookup
+class Trace:
+    def __init__(self, name, entries):
+        self.name = name
+        self.responses = {}
+        self.start = None
+        self.end = None
+        self.entries = 0
+        for entry in entries:
+            key = (entry["p"], entry["m"], trace_path(entry["e"], entry["u"]))
+            self.responses.setdefault(key, []).append((entry["t"], entry["s"], entry["b"]))
+            self.start = entry["t"] if (self.start is None) else min(self.start, entry["t"])
+            self.end = entry["t"] if (self.end is None) else max(self.end, entry["t"])
+            self.entries += 1
+        self.times = {}
+        for key, responses in self.responses.items():
+            responses.sort(key=lambda response: response[0])
+            self.times[key] = [response[0] for response in responses]
+
+    # Returns the (status, body) last recorded for a request at or before now, or the first one if none was yet
+    def lookup(self, key, now):
+        if (key not in self.responses):
+            return None, None
+        index = max(bisect.bisect_right(self.times[key], now) - 1, 0)
+        _, status, body = self.responses[key][index]
+        return status, body
+
+# Reads the entries of a trace file written by magic_garage's TraceRecorder
+def load_trace(file_name):
+    entries = []
+    with gzip.open(file_name, "rt", encoding="utf-8") as trace_file:
+        for line in trace_file:
+            if (len(line.strip()) > 0):
+                entries.append(json.loads(line))
+    return Trace(file_name, entries)
+
+# Stands in for the time module inside magic_garage. Time only moves when the replay advances it, and a thread that
+# sleeps blocks until the replay reaches its wake up time. The replay only advances once every worker is asleep or done
+class VirtualClock:
+    def __init__(self, start):
+        self.now = start
+        self.condition = threading.Condition()
+        self.running = 0
+        self.sleepers = {}
+        self.waiting = {}
+        self.notified = set()
+        self.sleeper_ids = itertools.count()
+        self.owner = threading.current_thread()
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, secs):
+        with self.condition:
+            wake_time = self.now + max(secs, 0)
+            if (threading.current_thread() is self.owner):
+                self.advance_to(wake_time)
+                return
+            sleeper_id = next(self.sleeper_ids)
+            self.sleepers[sleeper_id] = wake_time
+            self.running -= 1
+            self.condition.notify_all()
+            while (sleeper_id in self.sleepers):
+                self.condition.wait()
+
+    # Blocks a worker on a VirtualCondition until it is notified or its timeout passes on the virtual clock, releasing
+    # the condition's lock while it waits. Returns whether it was notified
+    def wait(self, condition, timeout):
+        with self.condition:
+            sleeper_id = next(self.sleeper_ids)
+            self.sleepers[sleeper_id] = float("inf") if (timeout is None) else self.now + max(timeout, 0)
+            self.waiting[sleeper_id] = condition
+            self.running -= 1
+            self.condition.notify_all()
+            condition.lock.release()
+            while (sleeper_id in self.sleepers):
+                self.condition.wait()
+            notified = (sleeper_id in self.notified)
+            self.notified.discard(sleeper_id)
+        condition.lock.acquire()
+        return notified
+
+    def notify(self, condition):
+        with self.condition:
+            for sleeper_id, waiting_on in list(self.waiting.items()):
+                if (waiting_on is condition):
+                    self.release(sleeper_id)
+                    self.notified.add(sleeper_id)
+            self.condition.notify_all()
+
+    def release(self, sleeper_id):
+        del self.sleepers[sleeper_id]
+        self.waiting.pop(sleeper_id, None)
+        self.running += 1
+
+    # Anything else, like perf_counter or strftime, comes from the real time module
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def task_started(self):
+        with self.condition:
+            self.running += 1
+
+    def task_finished(self):
+        with self.condition:
+            self.running -= 1
+            self.condition.notify_all()
+
+    def wait_until_idle(self):
+        with self.condition:
+            while (self.running > 0):
+                self.condition.wait()
+
+    def next_wake_time(self):
+        with self.condition:
+            return min(self.sleepers.values(), default=float("inf"))
+
+    # Moves time forward and releases the sleepers that are due, counting them as running before they wake
+    def advance_to(self, new_time):
+        with self.condition:
+            self.now = max(self.now, new_time)
+            for sleeper_id, wake_time in list(self.sleepers.items()):
+                if (wake_time <= self.now):
+                    self.release(sleeper_id)
+            self.condition.notify_all()
+
+# Stands in for threading.Condition inside magic_garage, waiting on the virtual clock
+class VirtualCondition:
+    def __init__(self, clock, lock=None):
+        self.clock = clock
+        self.lock = threading.RLock() if (lock is None) else lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.lock.release()
+
+    def wait(self, timeout=None):
+        return self.clock.wait(self, timeout)
+
+    def notify_all(self):
+        self.clock.notify(self)
+
+    notify = notify_all
+
+# Stands in for the threading module inside magic_garage, handing out conditions that wait on the virtual clock
+class VirtualThreading:
+    def __init__(self, clock):
+        self.clock = clock
+
+    def Condition(self, lock=None):
+        return VirtualCondition(self.clock, lock)
+
+    def __getattr__(self, name):
+        return getattr(threading, name)
+
+# Timer handle returned by VirtualLoop.call_at and call_later
+class VirtualTimer:
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+# Stands in for the asyncio event loop, running timers on the virtual clock from the replay thread
+class VirtualLoop:
+    def __init__(self, clock):
+        self.clock = clock
+        self.timers = []
+        self.timer_ids = itertools.count()
+
+    def call_at(self, when, callback, *args):
+        timer = VirtualTimer(when, callback, args)
+        heapq.heappush(self.timers, (when, next(self.timer_ids), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.clock.time() + delay, callback, *args)
+
+    # The replay drives the pollers itself, so the engine's wake ups have nothing to do
+    def call_soon_threadsafe(self, callback, *args):
+        return None
+
+    # Stays up for the whole replay, like the engine's loop while the app runs
+    def is_running(self):
+        return True
+
+    def is_closed(self):
+        return False
+
+    def next_time(self):
+        while ((len(self.timers) > 0) and self.timers[0][2].cancelled):
+            heapq.heappop(self.timers)
+        return self.timers[0][0] if (len(self.timers) > 0) else float("inf")
+
+    # Runs every timer that is due, letting the workers each one starts settle before the next
+    def run_due(self):
+        while (self.next_time() <= self.clock.time()):
+            _, _, timer = heapq.heappop(self.timers)
+            timer.callback(*timer.args)
+            self.clock.wait_until_idle()
+
+# Door command pool whose workers are tracked by the virtual clock
+class VirtualExecutor:
+    def __init__(self, clock):
+        self.clock = clock
+        self.executor = ThreadPoolExecutor(max_workers=REPLAY_MAX_DOOR_THREADS, thread_name_prefix="replay_door")
+
+    def submit(self, function, *args):
+        self.clock.task_started()
+        return self.executor.submit(self.run, function, *args)
+
+    def run(self, function, *args):
+        try:
+            return function(*args)
+        finally:
+            self.clock.task_finished()
+
+# Serves a provider's recorded responses
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def do_GET(self):
+        self.server.replay.handle(self, self.server.provider, "GET")
+
+    def do_POST(self):
+        self.server.replay.handle(self, self.server.provider, "POST")
+
+    def do_PUT(self):
+        self.server.replay.handle(self, self.server.provider, "PUT")
+
+    def send(self, status, body):
+        data = b"" if (body is None) else body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+# Converts a vehicle_data body to the value of a streaming data:update, or returns None if it has no drive data
+def stream_value(body, timestamp):
+    drive_state = json.loads(body).get("response", {}).get("drive_state")
+    if (drive_state is None):
+        return None
+    fields = {"speed": drive_state.get("speed"), "est_lat": drive_state.get("latitude"), "est_lng": drive_state.get("longitude"),
+        "heading": drive_state.get("heading"), "power": drive_state.get("power"), "shift_state": drive_state.get("shift_state")}
+    return ",".join([str(int(timestamp * 1000))] + ["" if (fields[column] is None) else str(fields[column])
+        for column in magic_garage.TESLA_STREAMING_COLUMNS])
+
+# Stands in for the Tesla streaming websocket on its own event loop thread. A subscribed car is pushed the drive data of
+# its vehicle_data response whenever that changes, after the replay's stand-in latency. A car without a vehicle_data
+# response, or whose tag is not in the vehicle listing, is sent vehicle_disconnected
+class ReplayStreamingServer:
+    def __init__(self, replay):
+        self.replay = replay
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+        self.subscriptions = 0
+        self.updates = 0
+
+    def start(self):
+        if (websockets is None):
+            raise ImportError("The websockets package is required for the stand-in streaming server")
+        started = threading.Event()
+
+        async def serve():
+            self.server = await websockets.serve(self.serve_connection, REPLAY_HOST, 0)
+            started.set()
+            await self.server.serve_forever()
+        threading.Thread(target=self.loop.run_until_complete, args=(serve(),), daemon=True).start()
+        started.wait()
+        return "ws://" + REPLAY_HOST + ":" + str(self.server.sockets[0].getsockname()[1]) + "/streaming/"
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.server.close)
+
+    # Returns the vehicle ID the listing gives a streaming tag, or None
+    def vehicle_for_tag(self, tag):
+        status, body = self.replay.trace.lookup(("Tesla", "GET", trace_path(magic_garage.TESLA_VEHICLES, {})), self.replay.clock.time())
+        if (status != 200):
+            return None
+        for listing in json.loads(body)["response"]:
+            if (str(listing.get("vehicle_id")) == tag):
+                return listing["id"]
+        return None
+
+    # Returns the current stream value for a car, or None if it has no drive data
+    def current_value(self, vehicle_id):
+        key = ("Tesla", "GET", trace_path(magic_garage.TESLA_VEHICLE_DATA, {"id": vehicle_id}))
+        status, body = self.replay.trace.lookup(key, self.replay.clock.time())
+        if (status != 200):
+            return None
+        return stream_value(body, time.time())
+
+    # A client closing its stream is how a drive ends for it, so that is not an error
+    async def serve_connection(self, connection):
+        try:
+            await self.stream_updates(connection)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def stream_updates(self, connection):
+        message = json.loads(await connection.recv())
+        tag = message.get("tag")
+        if (message.get("msg_type") != "data:subscribe_oauth"):
+            return
+        self.subscriptions += 1
+        vehicle_id = self.vehicle_for_tag(tag)
+        last_fields = None
+        while (True):
+            value = None if (vehicle_id is None) else self.current_value(vehicle_id)
+            if (value is None):
+                await connection.send(json.dumps({"msg_type": "data:error", "tag": tag, "error_type": "vehicle_disconnected",
+                    "value": "disconnected"}))
+                return
+            fields = value.split(",", 1)[1]
+            if (fields != last_fields):
+                last_fields = fields
+                if (self.replay.latency_secs > 0):
+                    await asyncio.sleep(self.replay.latency_secs)
+                await connection.send(json.dumps({"msg_type": "data:update", "tag": tag, "value": value}))
+                self.updates += 1
+            await asyncio.sleep(REPLAY_STREAM_CHECK_SECS)
+
+# Runs the decision code against a trace, the same way the engine's pollers and decision loops would
+class Replay:
+    def __init__(self, trace, latency_secs=0.0):
+        self.trace = trace
+        self.latency_secs = latency_secs
+        self.clock = VirtualClock(trace.start)
+        self.loop = VirtualLoop(self.clock)
+        self.stats_lock = threading.Lock()
+        self.api_calls = {}
+        self.door_commands = []
+        self.door_overrides = {}
+        self.decision_latencies = []
+        self.state_changes = []
+        self.servers = []
+        self.vehicle_timers = {}
+        self.door_timer = None
+        self.last_door_poll = trace.start
+        self.token_responses = {
+            ("Tesla", "POST", trace_path(magic_garage.TESLA_AQUIRE_TOKEN, {})): json.dumps(REPLAY_TESLA_TOKEN),
+            ("Tesla", "POST", trace_path(magic_garage.TESLA_REFRESH_TOKEN, {})): json.dumps(REPLAY_TESLA_TOKEN),
+            ("MyQ", "POST", trace_path(magic_garage.MYQ_LOGIN, {})): json.dumps(REPLAY_MYQ_TOKEN)
+        }
+
+    def start_server(self, provider):
+        server = ThreadingHTTPServer((REPLAY_HOST, 0), ReplayHandler)
+        server.daemon_threads = True
+        server.replay = self
+        server.provider = provider
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.servers.append(server)
+        return "http://" + REPLAY_HOST + ":" + str(server.server_address[1])
+
+    # Answers a request from the trace after the stand-in latency, applying the door commands sent during the replay to
+    # the door states
+    def handle(self, handler, provider, method):
+        if (self.latency_secs > 0):
+            time.sleep(self.latency_secs)
+        path = handler.path.split("?")[0]
+        request_body = handler.rfile.read(int(handler.headers.get("Content-Length", 0)))
+        with self.stats_lock:
+            self.api_calls[(provider, method)] = self.api_calls.get((provider, method), 0) + 1
+        key = (provider, method, path)
+        if (key in self.token_responses):
+            handler.send(200, self.token_responses[key])
+        elif (method == "PUT"):
+            self.record_door_command(path, json.loads(request_body))
+            handler.send(204, None)
+        else:
+            status, body = self.trace.lookup(key, self.clock.time())
+            if ((status is None) and (provider == "MyQ") and ("/Devices/" in path)):
+                status, body = self.device_from_list(path)
+            if (status is None):
+                handler.send(404, "{}")
+            else:
+                if ((provider == "MyQ") and ("/Devices" in path) and (status == 200)):
+                    body = self.apply_door_commands(body)
+                handler.send(status, body)
+
+    # Traces recorded before doors were polled one device at a time only hold device lists, so a single device is
+    # answered from the list recorded at the time
+    def device_from_list(self, path):
+        list_path, serial = path.rsplit("/", 1)
+        status, body = self.trace.lookup(("MyQ", "GET", list_path), self.clock.time())
+        if (status != 200):
+            return status, body
+        for device in json.loads(body).get("items", []):
+            if (str(device.get("serial_number")) == serial):
+                return 200, json.dumps(device)
+        return 404, "{}"
+
+    def record_door_command(self, path, body):
+        serial = path.split("/Devices/")[1].split("/")[0]
+        with self.stats_lock:
+            self.door_commands.append((self.clock.time(), serial, body["action_type"]))
+            self.door_overrides[serial] = (body["action_type"], self.clock.time())
+
+    # Applies the door commands to a device list or a single device
+    def apply_door_commands(self, body):
+        devices = json.loads(body)
+        for device in devices.get("items", [devices]):
+            override = self.door_overrides.get(str(device.get("serial_number")))
+            if (override is None):
+                continue
+            action, sent_at = override
+            moving = ((self.clock.time() - sent_at) < REPLAY_DOOR_TRAVEL_SECS)
+            if (action == "open"):
+                device.setdefault("state", {})["door_state"] = "opening" if moving else "open"
+            else:
+                device.setdefault("state", {})["door_state"] = "closing" if moving else "closed"
+        return json.dumps(devices)
+
+    # Points magic_garage at the stand-in servers and the virtual clock
+    def install(self):
+        magic_garage.time = self.clock
+        magic_garage.threading = VirtualThreading(self.clock)
+        magic_garage.event_loop = self.loop
+        magic_garage.myq_door_executor = VirtualExecutor(self.clock)
+        magic_garage.tesla_client.base_url = self.start_server("Tesla")
+        magic_garage.myq_client.base_url = self.start_server("MyQ")
+        # The schedulers' token buckets start from the virtual clock
+        for client in [magic_garage.tesla_client, magic_garage.myq_client]:
+            client.scheduler = magic_garage.RequestScheduler(client.name, client.scheduler.rate_per_sec, client.scheduler.burst)
+        magic_garage.tesla_email = magic_garage.tesla_password = "replay"
+        magic_garage.myq_email = magic_garage.myq_password = "replay"
+        magic_garage.TOKEN_CACHE_FILE = ""
+        magic_garage.STATE_SNAPSHOT_FILE = ""
+        change_vehicle_state = magic_garage.tesla_change_vehicle_state
+
+        # Notes every state change, including the ones made from the predictive open timer
+        def record_state_change(vehicle, new_state):
+            self.state_changes.append((self.clock.time(), vehicle.name, vehicle.state, new_state))
+            change_vehicle_state(vehicle, new_state)
+        magic_garage.tesla_change_vehicle_state = record_state_change
+
+    # Runs a car's decision logic and reschedules the pollers, since it can change their intervals
+    def decide(self, vehicle):
+        start = time.perf_counter()
+        magic_garage.tesla_check_arriving_leaving(vehicle)
+        magic_garage.tesla_schedule_next_poll(vehicle)
+        self.decision_latencies.append(time.perf_counter() - start)
+        self.schedule_vehicle_poll(vehicle)
+        self.schedule_door_poll()
+
+    def schedule_vehicle_poll(self, vehicle):
+        if (vehicle.id in self.vehicle_timers):
+            self.vehicle_timers[vehicle.id].cancel()
+        next_poll = max(vehicle.last_poll + vehicle.poll_interval, self.clock.time())
+        self.vehicle_timers[vehicle.id] = self.loop.call_at(next_poll, self.poll_vehicle, vehicle)
+
+    def schedule_door_poll(self):
+        if (self.door_timer is not None):
+            self.door_timer.cancel()
+        next_poll = max(self.last_door_poll + magic_garage.myq_door_thread_sleep, self.clock.time())
+        self.door_timer = self.loop.call_at(next_poll, self.poll_doors)
+
+    def poll_vehicle(self, vehicle):
+        magic_garage.tesla_start_poll(vehicle)
+        magic_garage.tesla_poll_vehicle(vehicle)
+        if (vehicle.has_data):
+            self.decide(vehicle)
+        else:
+            self.schedule_vehicle_poll(vehicle)
+
+    def poll_doors(self):
+        self.last_door_poll = self.clock.time()
+        magic_garage.myq_get_door_state()
+        for vehicle in magic_garage.tesla_vehicles.values():
+            if (vehicle.has_data):
+                self.decide(vehicle)
+        self.schedule_door_poll()
+
+    def housekeeping(self):
+        for vehicle in magic_garage.tesla_vehicles.values():
+            magic_garage.tesla_check_for_stale_data(vehicle)
+        self.loop.call_later(magic_garage.DECISION_IDLE_CHECK_SECS, self.housekeeping)
+
+    # Replays the whole trace, returning the wall clock time it took
+    def run(self):
+        wall_start = time.perf_counter()
+        self.install()
+        magic_garage.tesla_init()
+        magic_garage.myq_init()
+        for vehicle in magic_garage.tesla_vehicles.values():
+            self.vehicle_timers[vehicle.id] = self.loop.call_at(self.trace.start, self.poll_vehicle, vehicle)
+        self.door_timer = self.loop.call_at(self.trace.start, self.poll_doors)
+        self.loop.call_later(magic_garage.DECISION_IDLE_CHECK_SECS, self.housekeeping)
+        while (True):
+            self.clock.wait_until_idle()
+            next_time = min(self.loop.next_time(), self.clock.next_wake_time())
+            if (next_time > self.trace.end):
+                break
+            self.clock.advance_to(next_time)
+            self.clock.wait_until_idle()
+            self.loop.run_due()
+        for server in self.servers:
+            server.shutdown()
+        return time.perf_counter() - wall_start
+
+    def report(self, wall_secs):
+        trace_secs = self.trace.end - self.trace.start
+        print("Replay: " + self.trace.name + " | " + str(self.trace.entries) + " recorded responses | "
+            + str(round(trace_secs)) + "s of trace in " + str(round(wall_secs, 2)) + "s ("
+            + str(round(trace_secs / max(wall_secs, 1e-9))) + "x real time)")
+        calls = [provider + " " + method + ": " + str(count) for (provider, method), count in sorted(self.api_calls.items())]
+        print("API Calls: " + str(sum(self.api_calls.values())) + " | " + " | ".join(calls))
+        latencies = sorted(self.decision_latencies)
+        if (len(latencies) > 0):
+            p99 = latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))]
+            print("Decisions: " + str(len(latencies)) + " | Latency avg " + str(round(1e6 * sum(latencies) / len(latencies)))
+                + "us, p99 " + str(round(1e6 * p99)) + "us, max " + str(round(1e6 * latencies[-1])) + "us")
+        for changed_at, name, previous_state, new_state in self.state_changes:
+            print("  +" + str(round(changed_at - self.trace.start, 1)) + "s " + name + ": " + str(previous_state) + " -> " + new_state)
+        print("Door Commands: " + str(len(self.door_commands)))
+        for sent_at, serial, action in self.door_commands:
+            print("  +" + str(round(sent_at - self.trace.start, 1)) + "s " + serial + ": " + action)
+
+# Tags log lines with the virtual time since the start of the trace
+class ReplayTimeFilter(logging.Filter):
+    def __init__(self, replay):
+        super().__init__()
+        self.replay = replay
+
+    def filter(self, record):
+        record.replay_time = "+" + str(round(self.replay.clock.time() - self.replay.trace.start, 1)) + "s"
+        return True
+
+def main():
+    paths = [arg for arg in sys.argv[1:] if (not arg.startswith("-"))]
+    options = [arg for arg in sys.argv[1:] if arg.startswith("-")]
+    if ((len(paths) != 1) or any((option != "--verbose") for option in options)):
+        print("Usage: python3 replay.py <trace file> [--verbose]")
+        sys.exit(0 if (("--help" in options) or ("-h" in options)) else 1)
+    try:
+        trace = load_trace(paths[0])
+    except (OSError, ValueError, KeyError) as e:
+        print("Unable to load the trace " + paths[0] + ": " + str(e))
+        sys.exit(1)
+    replay = Replay(trace)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(replay_time)s %(levelname)s: %(message)s"))
+    handler.addFilter(ReplayTimeFilter(replay))
+    logging.basicConfig(level=logging.INFO if ("--verbose" in sys.argv) else logging.WARNING, handlers=[handler])
+    wall_secs = replay.run()
+    replay.report(wall_secs)
+
+if __name__ == "__main__":
+    main()
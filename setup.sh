@@ -5,3 +5,7 @@ pip3 install requests
 pip3 install schedule
 pip3 install geopy
 pip3 install pytz
+pip3 install numpy
+pip3 install cryptography
+pip3 install orjson
+pip3 install websockets